@@ -1,29 +1,43 @@
 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, abort
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, abort, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import make_transient_to_detached
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta, timezone, time
+from datetime import datetime, date, timedelta, timezone, time
 from itsdangerous import URLSafeTimedSerializer
 import json
 import csv
 import io
 import os
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
+import shutil
+import hashlib
+import threading
+import atexit
+import click
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
 import resend
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
-from reportlab.lib import colors
-from reportlab.lib.units import cm
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
-from pywebpush import webpush, WebPushException
 from zoneinfo import ZoneInfo
 from functools import wraps
 
 # === Discord logger (nuevo) ===
-from utils.discord_logger import log_event, log_clock, log_record, log_schedule
+from utils.discord_logger import log_event, log_clock, log_record, log_schedule, shipper_stats, register_sink
+from utils.batch_writer import BatchWriter
+from utils.projection import estimate_end_date
+from utils.snapshot_cache import SnapshotCache
+from utils.identity_cache import IdentityCache
+from utils.presence_stream import PresenceBroker
+from utils.presence import PresenceTracker
+from utils.keyset import keyset_paginate
+from utils.pdf_report import render_pdf_report_file
+from utils.report_cache import ReportCache
+from utils.push_sender import PushSender, PushMessage, VapidSigner
+from utils.scheduler import EmbeddedScheduler
+from utils.push_outbox import OutboxWorker, backoff_delay
 
 # ==========================
 # App & Config
@@ -135,6 +149,10 @@ def jinja_localdt_filter(value, fmt="%d/%m/%Y %H:%M"):
     dt = to_local(value)
     return dt.strftime(fmt) if dt else ""
 
+@app.template_filter('fromjson')
+def jinja_fromjson_filter(value):
+    return json.loads(value) if value else {}
+
 # ==========================
 # Auth helpers y settings
 # ==========================
@@ -163,11 +181,43 @@ def active_record_for_today(user):
     return TimeRecord.query.filter_by(user_id=user.id, date=today, exit_time=None).first()
 
 def hours_worked_total(user):
-    recs = TimeRecord.query.filter(TimeRecord.user_id==user.id, TimeRecord.exit_time.isnot(None)).all()
-    total = 0.0
-    for r in recs:
-        total += (as_utc_naive(r.exit_time) - as_utc_naive(r.entry_time)).total_seconds()/3600
-    return total
+    return ledger_total_seconds(user.id) / 3600
+
+def weekly_schedule_hours(schedules):
+    """Horas del horario fijo por día de la semana (0=Lunes)."""
+    hours = [0.0] * 7
+    for s in schedules:
+        if s.is_active and s.hours_required:
+            hours[s.day_of_week] = s.hours_required
+    return hours
+
+def project_hours(required, worked, weekly_hours, extras, today, today_hours):
+    """Proyección con los datos ya cargados (horas, no segundos)."""
+    required = required or 0.0
+    remaining = max(required - worked, 0.0)
+    end_date = None
+    if remaining > 0:
+        end_date = estimate_end_date(remaining, weekly_hours, extras, today=today, today_hours=today_hours)
+    return {
+        "total_hours_required": required,
+        "total_hours_worked": worked,
+        "hours_remaining": remaining,
+        "estimated_end_date": end_date,
+    }
+
+def user_projection(user, today=None):
+    """Horas hechas/restantes y fecha estimada de fin para un usuario."""
+    today = today or now_local().date()
+    worked = ledger_total_seconds(user.id) / 3600
+    weekly_hours, extras, today_hours = [0.0] * 7, [], 0.0
+    if (user.total_hours_required or 0.0) > worked:
+        schedules = Schedule.query.filter_by(user_id=user.id, is_active=True).all()
+        extras = (db.session.query(ExtraWorkDay.date, ExtraWorkDay.hours_planned)
+                  .filter(ExtraWorkDay.user_id == user.id, ExtraWorkDay.date >= today)
+                  .all())
+        weekly_hours = weekly_schedule_hours(schedules)
+        today_hours = worked_seconds(user.id, today, today) / 3600
+    return project_hours(user.total_hours_required, worked, weekly_hours, extras, today, today_hours)
 
 # ======= Helper visual para logs de horarios (nuevo) =======
 DAYS_ES = ['Lunes','Martes','Miércoles','Jueves','Viernes','Sábado','Domingo']
@@ -179,6 +229,82 @@ def _slot_resumen(s):
     dia = DAYS_ES[getattr(s, 'day_of_week', 0)] if isinstance(getattr(s, 'day_of_week', 0), int) else str(getattr(s, 'day_of_week'))
     return f"{dia}: {base} ({'activo' if getattr(s, 'is_active', False) else 'inactivo'})"
 
+# ======= Presencia en vivo (feed SSE del panel admin) =======
+# "En línea" sale de presence (login y latidos de la PWA, en memoria) y "Fichando"
+# del fichaje abierto: ni login, ni logout, ni fichar escriben un estado en la BD.
+# last_seen_at/last_login_at se guardan por lotes cada PRESENCE_FLUSH segundos.
+# Cada stream SSE ocupa un hilo de gunicorn mientras dura: el tope se deriva de
+# --threads (WEB_THREADS, 8 como en render.yaml) dejando siempre hilos libres para
+# logins y fichajes. Los streams cortan a los PRESENCE_STREAM_SECONDS; si no hay
+# hueco al reconectar (503) el panel pasa a polling.
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 8))
+PRESENCE_MAX_STREAMS = max(0, min(int(os.environ.get('PRESENCE_MAX_STREAMS', 4)), WEB_THREADS - 2))
+PRESENCE_STREAM_SECONDS = int(os.environ.get('PRESENCE_STREAM_SECONDS', 120))
+presence_broker = PresenceBroker(max_subscribers=PRESENCE_MAX_STREAMS)
+PRESENCE_HEARTBEAT = int(os.environ.get('PRESENCE_HEARTBEAT', 60))  # cada cuánto late la PWA
+
+def _presence_dt(ts):
+    return datetime.fromtimestamp(ts, timezone.utc) if ts is not None else None
+
+def _write_presence(rows):
+    """Un UPDATE por lote (executemany) con la última marca de cada usuario."""
+    t = User.__table__
+    seen = [{"uid": uid, "seen": _presence_dt(ts)} for uid, ts, _ in rows]
+    logins = [{"uid": uid, "login": _presence_dt(login)} for uid, _, login in rows if login is not None]
+    with app.app_context():
+        db.session.execute(t.update().where(t.c.id == db.bindparam("uid"))
+                           .values(last_seen_at=db.bindparam("seen")), seen)
+        if logins:
+            db.session.execute(t.update().where(t.c.id == db.bindparam("uid"))
+                               .values(last_login_at=db.bindparam("login")), logins)
+        db.session.commit()
+
+def _presence_expired(user_ids):
+    """Usuarios que dejaron de mandar latidos: se avisa al panel (quizá siguen fichando)."""
+    with app.app_context():
+        users = User.query.filter(User.id.in_(user_ids)).all()
+        open_records = {r.user_id: r for r in
+                        TimeRecord.query.filter(TimeRecord.user_id.in_(user_ids), TimeRecord.exit_time.is_(None))}
+        for user in users:
+            publish_presence(user, open_records.get(user.id))
+
+presence = PresenceTracker(_write_presence, on_expire=_presence_expired,
+                           online_ttl=int(os.environ.get('PRESENCE_TTL', PRESENCE_HEARTBEAT * 5 // 2)),
+                           flush_interval=int(os.environ.get('PRESENCE_FLUSH', 30)))
+atexit.register(presence.flush_now)
+
+def _epoch_or_none(dt):
+    if dt is None:
+        return None
+    return (dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp()
+
+def presence_status(user, is_clocked_in):
+    if is_clocked_in:
+        return "Fichando"
+    if presence.is_online(user.id, persisted=_epoch_or_none(user.last_seen_at)):
+        return "En línea"
+    return "Desconectado"
+
+def presence_payload(user, active_record):
+    last_seen = presence.last_seen(user.id) or _epoch_or_none(user.last_seen_at)
+    return {
+        "user_id": user.id,
+        "status": presence_status(user, active_record is not None),
+        "is_clocked_in": active_record is not None,
+        "entry_time": active_record.entry_time.isoformat() if active_record else None,
+        "last_seen": _presence_dt(last_seen).isoformat() if last_seen else None,
+    }
+
+def publish_presence(user, active_record=None, lookup=False):
+    """Emite el estado del usuario a los admins conectados (sólo si cambió).
+    Con lookup=True se busca su fichaje abierto."""
+    try:
+        if lookup:
+            active_record = TimeRecord.query.filter_by(user_id=user.id, exit_time=None).first()
+        presence_broker.publish(user.id, presence_payload(user, active_record))
+    except Exception as e:
+        print(f"⚠️ presence publish: {e}")
+
 # ==========================
 # Modelos
 # ==========================
@@ -194,9 +320,10 @@ class User(UserMixin, db.Model):
     schedules = db.relationship('Schedule', backref='user', lazy=True)
     time_records = db.relationship('TimeRecord', backref='user', lazy=True)
     last_login_at = db.Column(db.DateTime(timezone=True), nullable=True)
-    
-    # Agregar el nuevo campo 'status'
-    status = db.Column(db.String(50), default="Desconectado")  # En línea, Fichando, Desconectado
+    last_seen_at = db.Column(db.DateTime(timezone=True), nullable=True)  # último latido guardado (None tras logout)
+
+    # Obsoleto: el estado se deriva de presence y del fichaje abierto (ya no se escribe)
+    status = db.Column(db.String(50), default="Desconectado")
 
     # 🔹 NUEVO: días extra planificados
     extra_days = db.relationship('ExtraWorkDay', backref='user', lazy=True)
@@ -225,6 +352,15 @@ class TimeRecord(db.Model):
     longitude = db.Column(db.Float, nullable=True)
     notes = db.Column(db.String(500), nullable=True)
     is_active = db.Column(db.Boolean, default=True)
+    updated_at = db.Column(db.DateTime(timezone=True), default=utcnow, onupdate=utcnow, nullable=True)
+
+    # Índices para listados por clave (fecha, entrada, id) y filtro de abiertos
+    __table_args__ = (
+        db.Index('ix_time_record_user_date_entry_id', 'user_id', 'date', 'entry_time', 'id'),
+        db.Index('ix_time_record_user_open', 'user_id',
+                 sqlite_where=db.text('exit_time IS NULL'),
+                 postgresql_where=db.text('exit_time IS NULL')),
+    )
 
 
 # 🔹 NUEVO: días extra puntuales que NO cambian el horario fijo
@@ -250,6 +386,9 @@ class NotificationSettings(db.Model):
     last_weekly_sent = db.Column(db.Date, nullable=True)
     last_missed_entry_sent_1 = db.Column(db.Date, nullable=True)  # turno 1
     last_missed_entry_sent_2 = db.Column(db.Date, nullable=True)  # turno 2
+    # Próximo instante (UTC) en que el tick debe evaluar a este usuario; cualquier
+    # cambio de fichajes/horarios/suscripciones lo adelanta a "ahora"
+    next_due_at = db.Column(db.DateTime(timezone=True), default=utcnow, nullable=True, index=True)
 
 class PushSubscription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -261,9 +400,438 @@ class PushSubscription(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime(timezone=True), default=utcnow)
 
+
+# 🔹 NUEVO: bandeja de salida de push (una fila por notificación y suscripción)
+class PushOutbox(db.Model):
+    __tablename__ = 'push_outbox'
+    __table_args__ = (
+        db.UniqueConstraint('dedupe_key', 'subscription_id', name='uq_push_outbox_dedupe_sub'),
+        db.Index('ix_push_outbox_status_next', 'status', 'next_attempt_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    subscription_id = db.Column(db.Integer, db.ForeignKey('push_subscription.id'), nullable=False)
+    kind = db.Column(db.String(30), nullable=False)         # missed_entry_1, open_record, weekly...
+    dedupe_key = db.Column(db.String(100), nullable=True)   # p. ej. "open_record:7:2025-03-10"; None = sin deduplicar
+    payload = db.Column(db.Text, nullable=False)
+    headers = db.Column(db.Text, nullable=True)             # JSON
+    status = db.Column(db.String(10), nullable=False, default='pending')  # pending/sending/sent/gone/failed/expired/dropped
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime(timezone=True), nullable=False, default=utcnow)
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=utcnow)
+    sent_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    last_status = db.Column(db.Integer, nullable=True)      # código HTTP del último intento
+    last_error = db.Column(db.String(255), nullable=True)
+
+
+# 🔹 NUEVO: ledger de horas (totales mantenidos al escribir fichajes)
+class HoursLedger(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), unique=True, nullable=False)
+    total_seconds = db.Column(db.Float, nullable=False, default=0.0)  # suma de fichajes cerrados
+
+
+class HoursLedgerDay(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)  # fecha LOCAL del fichaje
+    seconds = db.Column(db.Float, nullable=False, default=0.0)
+    __table_args__ = (db.UniqueConstraint('user_id', 'date', name='uq_hours_ledger_day_user_date'),)
+
+
+# 🔹 NUEVO: registro de cambios de fichajes (sincronización incremental)
+class RecordChange(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    record_id = db.Column(db.Integer, nullable=False)  # sin FK: sobrevive al borrado (tombstone)
+    user_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)  # upsert, delete
+    changed_at = db.Column(db.DateTime(timezone=True), default=utcnow, nullable=False)
+    seq = db.Column(db.BigInteger, nullable=True)  # cursor en orden de commit (ver assign_change_seqs)
+    __table_args__ = (
+        db.Index('ix_record_change_user_id', 'user_id', 'id'),
+        db.Index('ix_record_change_seq', 'seq', unique=True),
+        db.Index('ix_record_change_user_seq', 'user_id', 'seq'),
+        {'sqlite_autoincrement': True},  # ids nunca reutilizados
+    )
+
+
+# 🔹 NUEVO: auditoría local (append-only; la escribe audit_writer por lotes)
+class AuditLog(db.Model):
+    __tablename__ = 'audit_log'
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False)  # momento del evento (UTC)
+    actor_id = db.Column(db.Integer, nullable=True)  # sin FK: sobrevive al borrado del usuario
+    actor = db.Column(db.String(255), nullable=True)
+    action = db.Column(db.String(200), nullable=False)
+    level = db.Column(db.String(10), nullable=True)
+    entity_type = db.Column(db.String(30), nullable=True)  # record, schedule...
+    entity_id = db.Column(db.Integer, nullable=True)
+    ip = db.Column(db.String(64), nullable=True)
+    method = db.Column(db.String(10), nullable=True)
+    path = db.Column(db.String(255), nullable=True)
+    details = db.Column(db.Text, nullable=True)  # JSON con los campos del evento
+    __table_args__ = (
+        db.Index('ix_audit_log_created', 'created_at', 'id'),
+        db.Index('ix_audit_log_actor', 'actor_id', 'created_at', 'id'),
+        db.Index('ix_audit_log_entity', 'entity_type', 'entity_id', 'created_at', 'id'),
+    )
+
+
+# 🔹 NUEVO: informes generados en segundo plano
+class ReportJob(db.Model):
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    kind = db.Column(db.String(10), nullable=False, default='pdf')
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='queued')  # queued, running, done, error
+    created_at = db.Column(db.DateTime(timezone=True), default=utcnow)
+    started_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    finished_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    duration_ms = db.Column(db.Integer, nullable=True)  # desde que empieza hasta que el fichero está listo
+    render_ms = db.Column(db.Integer, nullable=True)    # sólo la maquetación (proceso aparte)
+    rows = db.Column(db.Integer, nullable=True)
+    file_path = db.Column(db.String(500), nullable=True)
+    error = db.Column(db.String(500), nullable=True)
+
+# Identidad del usuario logueado cacheada unos segundos por proceso: cada petición
+# autenticada (páginas, sondeos de /api/active_record...) se ahorra el SELECT del
+# usuario. Las rutas que modifican un usuario llaman a identity_cache.invalidate().
+identity_cache = IdentityCache(ttl=int(os.environ.get('IDENTITY_CACHE_TTL', 60)))
+
+def _detached_user_copy(user):
+    """Copia sin sesión de las columnas del usuario (la original sigue en la petición)."""
+    copy = User(**{attr.key: getattr(user, attr.key) for attr in User.__mapper__.column_attrs})
+    make_transient_to_detached(copy)
+    return copy
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    uid = int(user_id)
+    cached = identity_cache.get(uid)
+    if cached is not None:
+        # merge sin SELECT: instancia propia de esta sesión (relaciones y plantillas funcionan)
+        return db.session.merge(cached, load=False)
+    version = identity_cache.version(uid)
+    user = db.session.get(User, uid)
+    if user is not None:
+        identity_cache.put(uid, version, _detached_user_copy(user))
+    return user
+
+# ============================================
+# Ledger de horas trabajadas
+# ============================================
+# Cada escritura de fichajes aplica su diferencia de duración al ledger dentro de la
+# misma transacción, así el dashboard y los jobs leen un total sin recorrer el histórico.
+def _dialect_insert():
+    """insert() con soporte ON CONFLICT según el motor activo."""
+    if _db_dialect() == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+def record_seconds(r):
+    """Duración en segundos de un fichaje cerrado (0 si sigue abierto)."""
+    if r is None or not r.entry_time or not r.exit_time:
+        return 0.0
+    return (as_utc_naive(r.exit_time) - as_utc_naive(r.entry_time)).total_seconds()
+
+def record_state(r):
+    """Foto (user_id, fecha, segundos) de un fichaje; tomar ANTES de modificarlo."""
+    return (int(r.user_id), r.date, record_seconds(r))
+
+def _ledger_add(user_id, day, delta):
+    if not delta:
+        return
+    # Upserts: la fila del total existe desde el alta del usuario (o el backfill de
+    # upgrade_db), pero si faltara se crea aquí en vez de perder el delta
+    insert = _dialect_insert()
+    stmt = insert(HoursLedger).values(user_id=user_id, total_seconds=delta)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id'],
+        set_={'total_seconds': HoursLedger.total_seconds + stmt.excluded.total_seconds},
+    ))
+    stmt = insert(HoursLedgerDay).values(user_id=user_id, date=day, seconds=delta)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'date'],
+        set_={'seconds': HoursLedgerDay.seconds + stmt.excluded.seconds},
+    )
+    db.session.execute(stmt)
+
+# Snapshot calculado del dashboard por usuario; se invalida en cada escritura que le afecte
+dashboard_cache = SnapshotCache(max_entries=int(os.environ.get('DASHBOARD_CACHE_SIZE', 512)))
+
+def _record_changed(before, record):
+    """Aplica al ledger el cambio de un fichaje. `before` es record_state() previo
+    (None si es nuevo) y `record` el fichaje ya modificado (None si se borra).
+    Llamar antes del commit."""
+    after = record_state(record) if record is not None else None
+    db.session.info.setdefault('dirty_users', set()).update(st[0] for st in (before, after) if st)
+    if before and after and before[:2] == after[:2]:
+        _ledger_add(after[0], after[1], after[2] - before[2])
+        return
+    if before:
+        _ledger_add(before[0], before[1], -before[2])
+    if after:
+        _ledger_add(after[0], after[1], after[2])
+
+@db.event.listens_for(db.session, 'after_commit')
+def _invalidate_dirty_users(session):
+    # Se invalida tras el commit para que ningún cálculo concurrente cachee datos previos
+    for uid in session.info.pop('dirty_users', ()):
+        dashboard_cache.bump(uid)
+    notify_uids = session.info.pop('notify_dirty', None)
+    if notify_uids:
+        embedded_scheduler_poke(notify_uids)
+    if session.info.pop('outbox_new', False):
+        push_outbox_worker.wake()
+
+# Cursor del feed de cambios en orden de COMMIT. El id de record_change se asigna al
+# insertar: una transacción lenta puede confirmar un id menor que otro ya entregado
+# y el cliente se lo saltaría. Por eso el cursor es `seq`, que se numera después del
+# commit con un único numerador a la vez (lock del proceso + advisory lock en
+# PostgreSQL) que confirma cada tanda antes de soltarlo: cuando un seq es visible,
+# todos los menores también lo son.
+CHANGES_SEQ_LOCK_KEY = 20130001  # clave del pg_advisory_xact_lock
+_change_seq_lock = threading.Lock()
+
+def assign_change_seqs():
+    """Numera los cambios ya confirmados que aún no tienen seq. Devuelve cuántos."""
+    t = RecordChange.__table__
+    with _change_seq_lock, db.engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            conn.execute(db.text("SELECT pg_advisory_xact_lock(:k)"), {"k": CHANGES_SEQ_LOCK_KEY})
+        ids = conn.execute(db.select(t.c.id).where(t.c.seq.is_(None)).order_by(t.c.id)).scalars().all()
+        if not ids:
+            return 0
+        last = conn.execute(db.select(db.func.coalesce(db.func.max(t.c.seq), 0))).scalar()
+        conn.execute(t.update().where(t.c.id == db.bindparam('cid')).values(seq=db.bindparam('next_seq')),
+                     [{"cid": cid, "next_seq": last + i} for i, cid in enumerate(ids, 1)])
+        return len(ids)
+
+@db.event.listens_for(db.session, 'after_commit')
+def _number_record_changes(session):
+    if session.info.pop('record_changes', False):
+        try:
+            assign_change_seqs()
+        except Exception as e:  # el feed vuelve a numerar antes de leer
+            print(f"⚠️ assign_change_seqs: {e!r}")
+
+@db.event.listens_for(db.session, 'after_rollback')
+def _discard_dirty_users(session):
+    session.info.pop('dirty_users', None)
+    session.info.pop('notify_dirty', None)
+    session.info.pop('outbox_new', None)
+    session.info.pop('record_changes', None)
+
+@db.event.listens_for(db.session, 'after_flush')
+def _log_record_changes(session, flush_context):
+    # Cualquier alta/edición/borrado de TimeRecord por el ORM deja su entrada en
+    # RecordChange dentro de la misma transacción (los borrados masivos, aparte).
+    now = utcnow()
+    rows = []
+    for obj in session.new:
+        if isinstance(obj, TimeRecord):
+            rows.append({"record_id": obj.id, "user_id": obj.user_id, "op": "upsert", "changed_at": now})
+    for obj in session.dirty:
+        if isinstance(obj, TimeRecord) and session.is_modified(obj, include_collections=False):
+            rows.append({"record_id": obj.id, "user_id": obj.user_id, "op": "upsert", "changed_at": now})
+    for obj in session.deleted:
+        if isinstance(obj, TimeRecord):
+            rows.append({"record_id": obj.id, "user_id": obj.user_id, "op": "delete", "changed_at": now})
+    if rows:
+        session.connection().execute(RecordChange.__table__.insert(), rows)
+        session.info['record_changes'] = True
+
+# Cambios que pueden alterar cuándo toca notificar a un usuario
+NOTIFY_DIRTY_MODELS = ('TimeRecord', 'Schedule', 'PushSubscription')
+
+@db.event.listens_for(db.session, 'after_flush')
+def _mark_notifications_due(session, flush_context):
+    user_ids = {obj.user_id for obj in (*session.new, *session.dirty, *session.deleted)
+                if type(obj).__name__ in NOTIFY_DIRTY_MODELS and obj.user_id is not None}
+    if user_ids:
+        session.connection().execute(
+            NotificationSettings.__table__.update()
+            .where(NotificationSettings.user_id.in_(user_ids))
+            .values(next_due_at=utcnow()))
+        session.info.setdefault('notify_dirty', set()).update(user_ids)
+
+def _tombstone_user_records(user_id):
+    """Tombstones para un borrado masivo (query.delete() no pasa por el flush)."""
+    db.session.info['record_changes'] = True
+    db.session.execute(
+        db.insert(RecordChange).from_select(
+            ['record_id', 'user_id', 'op', 'changed_at'],
+            db.select(TimeRecord.id, TimeRecord.user_id, db.literal('delete'),
+                      db.literal(utcnow(), RecordChange.changed_at.type))
+            .where(TimeRecord.user_id == user_id)
+            .order_by(TimeRecord.id)))
+
+@db.event.listens_for(User, 'after_insert')
+def _create_user_ledger(mapper, connection, target):
+    # Todo usuario nace con su fila de ledger (a cero), en la misma transacción
+    connection.execute(HoursLedger.__table__.insert().values(user_id=target.id, total_seconds=0.0))
+
+def _backfill_ledger():
+    """Usuarios sin ledger (anteriores a él): se construye una vez desde sus fichajes."""
+    missing = [uid for (uid,) in db.session.query(User.id)
+               .outerjoin(HoursLedger, HoursLedger.user_id == User.id)
+               .filter(HoursLedger.id.is_(None))]
+    if missing:
+        rebuild_ledger(missing)
+
+def _ledger_forget_user(user_id):
+    HoursLedgerDay.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+    HoursLedger.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+
+def _ledger_recompute(user_ids=None):
+    """Recalcula desde los fichajes {user_id: {fecha: segundos}}."""
+    q = (db.session.query(TimeRecord.user_id, TimeRecord.date, db.func.sum(_duration_seconds_expr()))
+         .filter(TimeRecord.exit_time.isnot(None)))
+    if user_ids is not None:
+        q = q.filter(TimeRecord.user_id.in_(user_ids))
+    per_user = {}
+    for uid, day, secs in q.group_by(TimeRecord.user_id, TimeRecord.date):
+        per_user.setdefault(uid, {})[_as_date(day)] = float(secs or 0.0)
+    return per_user
+
+def rebuild_ledger(user_ids=None):
+    """Reconstruye el ledger desde cero (todos los usuarios o los indicados). No hace commit."""
+    if user_ids is None:
+        user_ids = [uid for (uid,) in db.session.query(User.id)]
+    user_ids = list(user_ids)
+    if not user_ids:
+        return 0
+    per_user = _ledger_recompute(user_ids)
+    HoursLedgerDay.query.filter(HoursLedgerDay.user_id.in_(user_ids)).delete(synchronize_session=False)
+    # Upserts: dos peticiones que reconstruyen a la vez el mismo usuario no chocan con el UNIQUE
+    insert = _dialect_insert()
+    stmt = insert(HoursLedger.__table__)
+    db.session.execute(
+        stmt.on_conflict_do_update(index_elements=['user_id'],
+                                   set_={'total_seconds': stmt.excluded.total_seconds}),
+        [{"user_id": uid, "total_seconds": sum(per_user.get(uid, {}).values())} for uid in user_ids])
+    days = [{"user_id": uid, "date": d, "seconds": secs}
+            for uid in user_ids for d, secs in per_user.get(uid, {}).items()]
+    if days:
+        stmt = insert(HoursLedgerDay.__table__)
+        db.session.execute(
+            stmt.on_conflict_do_update(index_elements=['user_id', 'date'],
+                                       set_={'seconds': stmt.excluded.seconds}),
+            days)
+    return len(user_ids)
+
+def verify_ledger(user_ids=None, tolerance=1.0):
+    """Compara ledger y fichajes. Devuelve lista de (user_id, fecha|None, ledger, real);
+    fecha None indica discrepancia en el total."""
+    totals = dict(db.session.query(HoursLedger.user_id, HoursLedger.total_seconds))
+    ledger_days = {}
+    for uid, day, secs in db.session.query(HoursLedgerDay.user_id, HoursLedgerDay.date, HoursLedgerDay.seconds):
+        ledger_days.setdefault(uid, {})[day] = secs
+    if user_ids is None:
+        user_ids = list(totals)
+    per_user = _ledger_recompute(user_ids)
+    mismatches = []
+    for uid in user_ids:
+        real_days = per_user.get(uid, {})
+        real_total = sum(real_days.values())
+        if uid not in totals or abs(totals[uid] - real_total) > tolerance:
+            mismatches.append((uid, None, totals.get(uid, 0.0), real_total))
+        got_days = ledger_days.get(uid, {})
+        for day in set(real_days) | set(got_days):
+            got, real = got_days.get(day, 0.0), real_days.get(day, 0.0)
+            if abs(got - real) > tolerance:
+                mismatches.append((uid, day, got, real))
+    return mismatches
+
+def ledger_total_seconds(user_id):
+    """Total de segundos trabajados (fichajes cerrados) leído del ledger."""
+    total = db.session.query(HoursLedger.total_seconds).filter_by(user_id=user_id).scalar()
+    return total or 0.0
+
+# ============================================
+# Agregados de horas en SQL
+# ============================================
+# Las sumas de duraciones se calculan en la base de datos y devuelven números,
+# no objetos ORM. Las expresiones dependen del motor (SQLite local / PostgreSQL).
+def _duration_seconds_expr():
+    """Duración en segundos (exit - entry) de un fichaje, como expresión SQL."""
+    if _db_dialect() == "postgresql":
+        return db.func.extract('epoch', TimeRecord.exit_time - TimeRecord.entry_time)
+    # SQLite guarda los DateTime como texto UTC 'YYYY-MM-DD HH:MM:SS.ffffff'
+    return (db.func.julianday(TimeRecord.exit_time) - db.func.julianday(TimeRecord.entry_time)) * 86400.0
+
+def _week_start_expr(col):
+    """Lunes de la semana de una columna Date."""
+    if _db_dialect() == "postgresql":
+        return db.cast(db.func.date_trunc('week', col), db.Date)
+    return db.func.date(col, 'weekday 0', '-6 days')
+
+def _as_date(value):
+    """Normaliza lo que devuelve el driver (date, datetime o texto ISO) a date."""
+    if value is None or type(value) is date:
+        return value
+    if isinstance(value, datetime):
+        return value.date()
+    return date.fromisoformat(str(value)[:10])
+
+def _closed_records_filter(user_id, start=None, end=None):
+    conds = [TimeRecord.exit_time.isnot(None)]
+    if user_id is not None:
+        conds.append(TimeRecord.user_id == user_id)
+    if start is not None:
+        conds.append(TimeRecord.date >= start)
+    if end is not None:
+        conds.append(TimeRecord.date <= end)
+    return conds
+
+def worked_seconds(user_id, start=None, end=None):
+    """Segundos trabajados (fichajes cerrados) en [start, end] por fecha local."""
+    total = (db.session.query(db.func.sum(_duration_seconds_expr()))
+             .filter(*_closed_records_filter(user_id, start, end))
+             .scalar())
+    return float(total or 0.0)
+
+def worked_seconds_by_day(user_id, start=None, end=None):
+    """{fecha: segundos} de los días con fichajes cerrados."""
+    rows = (db.session.query(TimeRecord.date, db.func.sum(_duration_seconds_expr()))
+            .filter(*_closed_records_filter(user_id, start, end))
+            .group_by(TimeRecord.date))
+    return {_as_date(d): float(secs or 0.0) for d, secs in rows}
+
+def worked_seconds_by_week(user_id, start=None, end=None):
+    """{lunes: segundos} agrupado por semana en la base de datos."""
+    week = _week_start_expr(TimeRecord.date)
+    rows = (db.session.query(week, db.func.sum(_duration_seconds_expr()))
+            .filter(*_closed_records_filter(user_id, start, end))
+            .group_by(week))
+    return {_as_date(w): float(secs or 0.0) for w, secs in rows}
+
+def worked_seconds_by_user(user_ids=None, start=None, end=None):
+    """{user_id: segundos} para varios usuarios en una sola consulta."""
+    q = (db.session.query(TimeRecord.user_id, db.func.sum(_duration_seconds_expr()))
+         .filter(*_closed_records_filter(None, start, end)))
+    if user_ids is not None:
+        q = q.filter(TimeRecord.user_id.in_(list(user_ids)))
+    return {uid: float(secs or 0.0) for uid, secs in q.group_by(TimeRecord.user_id)}
+
+def report_summary(user_id, start, end):
+    """Resumen de un periodo: sesiones cerradas/abiertas, total y días con fichajes."""
+    closed = db.func.sum(db.case((TimeRecord.exit_time.isnot(None), 1), else_=0))
+    opened = db.func.sum(db.case((TimeRecord.exit_time.is_(None), 1), else_=0))
+    total = db.func.sum(db.case((TimeRecord.exit_time.isnot(None), _duration_seconds_expr()), else_=0))
+    row = (db.session.query(closed, opened, total, db.func.count(db.distinct(TimeRecord.date)))
+           .filter(TimeRecord.user_id == user_id, TimeRecord.date >= start, TimeRecord.date <= end)
+           .one())
+    return {
+        "closed": int(row[0] or 0),
+        "open": int(row[1] or 0),
+        "total_seconds": float(row[2] or 0.0),
+        "days": int(row[3] or 0),
+    }
 
 # ============================================
 # Tokens para correo
@@ -375,11 +943,20 @@ body {{ font-family: -apple-system,BlinkMacSystemFont,'Segoe UI',Roboto,sans-ser
 import uuid
 from datetime import datetime  # (duplicado benigno; mantiene compatibilidad)
 
-def send_push_to_user(user, title, body, data=None, actions=None):
-    if not (VAPID_PUBLIC_KEY and VAPID_PRIVATE_KEY and VAPID_EMAIL):
-        print("❌ VAPID keys/email no configurados.")
-        return False
+PUSH_TTL_SECONDS = 1800  # 30 min de ventana de entrega; ajusta a tu gusto
+PUSH_GONE_STATUSES = (404, 410)  # la suscripción ya no existe: sólo entonces se desactiva
+push_sender = PushSender(max_workers=int(os.environ.get('PUSH_WORKERS', 8)),
+                         timeout=float(os.environ.get('PUSH_TIMEOUT', 10)))
+
+# Clave VAPID cargada una vez al arrancar; las cabeceras firmadas se reutilizan por servicio push
+vapid_signer = None
+if VAPID_PUBLIC_KEY and VAPID_PRIVATE_KEY and VAPID_EMAIL:
+    try:
+        vapid_signer = VapidSigner(VAPID_PRIVATE_KEY, f"mailto:{VAPID_EMAIL}")
+    except Exception as e:
+        print(f"❌ VAPID_PRIVATE_KEY no válida: {e}")
 
+def _push_message_parts(user, title, body, data=None, actions=None):
     nid = int(datetime.now().timestamp())  # id simple por timestamp
     payload = {
         "title": title,
@@ -395,27 +972,218 @@ def send_push_to_user(user, title, body, data=None, actions=None):
         "Urgency": "high",                                  # entrega prioritaria
         "Topic": f"user-{user.id}-{nid}"                    # único => no se colapsa
     }
-    ttl_seconds = 1800  # 30 min de ventana de entrega; ajusta a tu gusto
+    return json.dumps(payload), headers
+
+def send_push_batch(notifications):
+    """Envía varias notificaciones a la vez (todas sus suscripciones en paralelo).
+
+    notifications: lista de (user, title, body, data, actions, subs); subs=None las consulta.
+    Devuelve, por notificación, True si llegó al menos a una suscripción.
+    """
+    if vapid_signer is None:
+        print("❌ VAPID keys/email no configurados.")
+        return [False] * len(notifications)
+
+    messages, owners = [], []
+    for i, (user, title, body, data, actions, subs) in enumerate(notifications):
+        if subs is None:
+            subs = PushSubscription.query.filter_by(user_id=user.id, is_active=True).all()
+        payload, headers = _push_message_parts(user, title, body, data, actions)
+        for s in subs:
+            messages.append(PushMessage(s, s.endpoint, s.p256dh, s.auth, payload, headers, ttl=PUSH_TTL_SECONDS))
+            owners.append(i)
+
+    results = push_sender.send_many(messages, vapid_signer)
+    delivered = [False] * len(notifications)
+    deactivated = False
+    for i, r in zip(owners, results):
+        if r.ok:
+            delivered[i] = True
+        elif r.status in PUSH_GONE_STATUSES:
+            r.key.is_active = False
+            deactivated = True
+            print("❌ WebPush suscripción caducada:", r.status, r.error)
+        elif r.rejected:
+            print("❌ WebPush error:", r.status, r.error)
+        else:
+            print(f"⚠️ WebPush sin respuesta ({r.elapsed_ms} ms): {r.error}")
+    if deactivated:
+        db.session.commit()
+    return delivered
+
+def send_push_to_user(user, title, body, data=None, actions=None, subs=None):
+    return send_push_batch([(user, title, body, data, actions, subs)])[0]
 
-    subs = PushSubscription.query.filter_by(user_id=user.id, is_active=True).all()
-    ok_any = False
-    for s in subs:
-        try:
-            webpush(
-                subscription_info={"endpoint": s.endpoint, "keys": {"p256dh": s.p256dh, "auth": s.auth}},
-                data=json.dumps(payload),
-                vapid_private_key=VAPID_PRIVATE_KEY,
-                vapid_claims={"sub": f"mailto:{VAPID_EMAIL}"},
-                ttl=ttl_seconds,
-                headers=headers,   # ← aquí la magia
-            )
-            ok_any = True
-        except WebPushException as e:
-            s.is_active = False
-            db.session.commit()
-            print("❌ WebPush error:", e)
-    return ok_any
 
+# ============================================
+# Bandeja de salida push (entrega en segundo plano con reintentos)
+# ============================================
+# Los jobs encolan y marcan last_*_sent en la misma transacción; el hilo
+# push_outbox_worker entrega después. Errores transitorios (5xx, timeouts,
+# 429...) se reintentan con backoff exponencial hasta PUSH_MAX_ATTEMPTS o hasta
+# que caduca la notificación (PUSH_TTL_SECONDS); sólo 404/410 desactivan la
+# suscripción. La dedupe_key (tipo:usuario:fecha) evita encolar dos veces el
+# mismo aviso aunque el tick se ejecute desde el cron y el planificador a la vez.
+PUSH_MAX_ATTEMPTS = int(os.environ.get('PUSH_MAX_ATTEMPTS', 6))
+PUSH_RETRY_BASE = 30          # s; 30, 60, 120, 240... (con tope de 15 min)
+PUSH_OUTBOX_BATCH = 100
+PUSH_LEASE_SECONDS = push_sender.batch_timeout + 30  # si el proceso muere enviando, se reintenta tras esto
+PUSH_OUTBOX_RETENTION_DAYS = 7
+PUSH_OUTBOX_FINAL = ('sent', 'gone', 'failed', 'expired', 'dropped')
+
+def enqueue_push_batch(items):
+    """Encola notificaciones para todas las suscripciones de cada usuario (sin red).
+
+    items: lista de (user, kind, dedupe_key, title, body, data, actions, subs); subs=None
+    las consulta. Devuelve, por notificación, True si quedó encolada (ahora o antes,
+    con la misma dedupe_key). Llamar antes del commit.
+    """
+    now = utcnow()
+    queued, rows = [], []
+    for user, kind, dedupe_key, title, body, data, actions, subs in items:
+        if subs is None:
+            subs = PushSubscription.query.filter_by(user_id=user.id, is_active=True).all()
+        payload, headers = _push_message_parts(user, title, body, data, actions)
+        ok = False
+        for sub in subs:
+            ok = True
+            rows.append({"user_id": user.id, "subscription_id": sub.id, "kind": kind, "dedupe_key": dedupe_key,
+                         "payload": payload, "headers": json.dumps(headers), "next_attempt_at": now,
+                         "expires_at": now + timedelta(seconds=PUSH_TTL_SECONDS)})
+        queued.append(ok)
+    if rows:  # un solo INSERT (executemany) para todo el lote
+        # ON CONFLICT DO NOTHING: si el cron y el planificador embebido encolan lo
+        # mismo a la vez, el segundo no revienta con IntegrityError (ni pierde su tick)
+        stmt = (_dialect_insert()(PushOutbox.__table__)
+                .on_conflict_do_nothing(index_elements=['dedupe_key', 'subscription_id']))
+        db.session.execute(stmt, rows)
+        db.session.info['outbox_new'] = True
+    return queued
+
+def enqueue_push(user, kind, title, body, data=None, actions=None, subs=None, dedupe_key=None):
+    return enqueue_push_batch([(user, kind, dedupe_key, title, body, data, actions, subs)])[0]
+
+def deliver_push_outbox(limit=PUSH_OUTBOX_BATCH):
+    """Entrega un lote de filas vencidas. Devuelve cuántas ha tratado (0 = nada pendiente)."""
+    if vapid_signer is None:
+        return 0
+    now = utcnow()
+    q = (PushOutbox.query
+         .filter(PushOutbox.status.in_(('pending', 'sending')), PushOutbox.next_attempt_at <= now)
+         .order_by(PushOutbox.next_attempt_at, PushOutbox.id)
+         .limit(limit))
+    if _db_dialect() == 'postgresql':
+        q = q.with_for_update(skip_locked=True)  # varios workers: cada uno su lote
+    rows = q.all()
+    if not rows:
+        return 0
+    subs = {sub.id: sub for sub in
+            PushSubscription.query.filter(PushSubscription.id.in_({r.subscription_id for r in rows}))}
+
+    messages = []
+    for row in rows:
+        sub = subs.get(row.subscription_id)
+        left = (as_utc_naive(row.expires_at) - as_utc_naive(now)).total_seconds()
+        if left <= 0:
+            row.status = 'expired'
+        elif not (sub and sub.is_active):
+            row.status = 'dropped'
+        else:
+            row.status = 'sending'
+            row.next_attempt_at = now + timedelta(seconds=PUSH_LEASE_SECONDS)
+            messages.append(PushMessage((row.id, sub.id), sub.endpoint, sub.p256dh, sub.auth, row.payload,
+                                        json.loads(row.headers or '{}'), ttl=int(left)))
+    db.session.commit()  # lote reclamado antes de salir a la red
+    if not messages:
+        return len(rows)
+
+    results = push_sender.send_many(messages, vapid_signer)
+    ids = [r.key[0] for r in results]
+    rows = {row.id: row for row in PushOutbox.query.filter(PushOutbox.id.in_(ids))}
+    subs = {sub.id: sub for sub in
+            PushSubscription.query.filter(PushSubscription.id.in_({r.key[1] for r in results}))}
+    done = utcnow()
+    for r in results:
+        row, sub = rows.get(r.key[0]), subs.get(r.key[1])
+        if row is None:
+            continue  # purgada mientras se enviaba
+        if sub is None:
+            row.status = 'dropped'  # suscripción borrada mientras se enviaba
+            continue
+        row.attempts += 1
+        row.last_status = r.status
+        row.last_error = r.error[:255] if r.error else None
+        if r.ok:
+            row.status, row.sent_at = 'sent', done
+        elif r.status in PUSH_GONE_STATUSES:
+            row.status = 'gone'
+            sub.is_active = False
+        elif row.attempts >= PUSH_MAX_ATTEMPTS:
+            row.status = 'failed'
+            print(f"❌ WebPush sin entregar tras {row.attempts} intentos:", r.status, r.error)
+        else:
+            row.status = 'pending'
+            row.next_attempt_at = done + timedelta(seconds=backoff_delay(row.attempts, PUSH_RETRY_BASE))
+    db.session.commit()
+    return len(rows)
+
+def _purge_push_outbox():
+    cutoff = utcnow() - timedelta(days=PUSH_OUTBOX_RETENTION_DAYS)
+    PushOutbox.query.filter(PushOutbox.status.in_(PUSH_OUTBOX_FINAL),
+                            PushOutbox.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+_push_outbox_purged_at = None
+
+def _push_outbox_drain():
+    global _push_outbox_purged_at
+    with app.app_context():
+        if _push_outbox_purged_at is None or utcnow() - _push_outbox_purged_at > timedelta(hours=1):
+            _push_outbox_purged_at = utcnow()
+            _purge_push_outbox()
+        return deliver_push_outbox()
+
+push_outbox_worker = OutboxWorker(_push_outbox_drain, interval=int(os.environ.get('PUSH_OUTBOX_INTERVAL', 30)))
+
+def push_outbox_stats():
+    by_status = dict(db.session.query(PushOutbox.status, db.func.count(PushOutbox.id))
+                     .group_by(PushOutbox.status).all())
+    oldest = (db.session.query(db.func.min(PushOutbox.created_at))
+              .filter(PushOutbox.status.in_(('pending', 'sending'))).scalar())
+    return {
+        "by_status": by_status,
+        "oldest_pending": oldest.isoformat() if oldest else None,
+        "worker": push_outbox_worker.stats(),
+        "sender": push_sender.stats(),
+    }
+
+
+# Índices de tablas ya existentes (create_all sólo los crea en tablas nuevas)
+INDEX_STMTS = [
+    "CREATE INDEX IF NOT EXISTS ix_time_record_user_date_entry_id ON time_record (user_id, date, entry_time, id)",
+    "CREATE INDEX IF NOT EXISTS ix_time_record_user_open ON time_record (user_id) WHERE exit_time IS NULL",
+    "CREATE INDEX IF NOT EXISTS ix_notification_settings_next_due_at ON notification_settings (next_due_at)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_record_change_seq ON record_change (seq)",
+    "CREATE INDEX IF NOT EXISTS ix_record_change_user_seq ON record_change (user_id, seq)",
+    "CREATE INDEX IF NOT EXISTS ix_record_change_unassigned ON record_change (id) WHERE seq IS NULL",
+]
+
+def _backfill_next_due_at():
+    """Ajustes sin next_due_at (creados antes de la columna): se evalúan en el próximo tick."""
+    db.session.execute(NotificationSettings.__table__.update()
+                       .where(NotificationSettings.next_due_at.is_(None))
+                       .values(next_due_at=utcnow()))
+
+def _backfill_record_changes():
+    """Primera vez: un 'upsert' por fichaje existente para que since=0 devuelva todo."""
+    if db.session.query(RecordChange.id).first() is not None:
+        return
+    db.session.execute(
+        db.insert(RecordChange).from_select(
+            ['record_id', 'user_id', 'op', 'changed_at'],
+            db.select(TimeRecord.id, TimeRecord.user_id, db.literal('upsert'),
+                      db.literal(utcnow(), RecordChange.changed_at.type))
+            .order_by(TimeRecord.id)))
 
 # Pequeñas migraciones automáticas (SQLite/PostgreSQL)
 def upgrade_db():
@@ -434,6 +1202,8 @@ def upgrade_db():
 
             cols = db.session.execute(text("PRAGMA table_info(notification_settings);")).fetchall()
             names = {c[1] for c in cols}
+            if "next_due_at" not in names:
+                db.session.execute(text("ALTER TABLE notification_settings ADD COLUMN next_due_at DATETIME NULL"))
             if "last_missed_entry_sent_1" not in names:
                 db.session.execute(text("ALTER TABLE notification_settings ADD COLUMN last_missed_entry_sent_1 DATE NULL"))
             if "last_missed_entry_sent_2" not in names:
@@ -445,9 +1215,29 @@ def upgrade_db():
             # AÑADIR CAMPO last_login_at
             if "last_login_at" not in names:
                 db.session.execute(text("ALTER TABLE user ADD COLUMN last_login_at DATETIME")) # Tipo DATETIME para SQLite
+            if "last_seen_at" not in names:
+                db.session.execute(text("ALTER TABLE user ADD COLUMN last_seen_at DATETIME NULL"))
+
+            cols = db.session.execute(text("PRAGMA table_info(time_record);")).fetchall()
+            names = {c[1] for c in cols}
+            if "updated_at" not in names:
+                db.session.execute(text("ALTER TABLE time_record ADD COLUMN updated_at DATETIME NULL"))
+
+            cols = db.session.execute(text("PRAGMA table_info(record_change);")).fetchall()
+            names = {c[1] for c in cols}
+            if "seq" not in names:
+                # Sólo al crear la columna: los cursores ya entregados eran ids
+                db.session.execute(text("ALTER TABLE record_change ADD COLUMN seq BIGINT NULL"))
+                db.session.execute(text("UPDATE record_change SET seq = id"))
 
             # En SQLite el tamaño de VARCHAR no se aplica realmente, así que no hace falta ALTER para password/email
+            for s in INDEX_STMTS:
+                db.session.execute(text(s))
+            _backfill_record_changes()
+            _backfill_next_due_at()
+            _backfill_ledger()
             db.session.commit()
+            assign_change_seqs()
 
         elif dialect == "postgresql":
             # --- PostgreSQL ---
@@ -457,25 +1247,41 @@ def upgrade_db():
                 'ALTER TABLE "user" ALTER COLUMN email TYPE VARCHAR(255)',
                 # AÑADIR CAMPO last_login_at
                 "ALTER TABLE \"user\" ADD COLUMN IF NOT EXISTS last_login_at TIMESTAMP WITH TIME ZONE NULL",
+                "ALTER TABLE \"user\" ADD COLUMN IF NOT EXISTS last_seen_at TIMESTAMP WITH TIME ZONE NULL",
                 
                 "ALTER TABLE schedule ADD COLUMN IF NOT EXISTS start_time_2 TIME NULL",
                 "ALTER TABLE schedule ADD COLUMN IF NOT EXISTS end_time_2 TIME NULL",
                 "ALTER TABLE notification_settings ADD COLUMN IF NOT EXISTS last_missed_entry_sent_1 DATE NULL",
                 "ALTER TABLE notification_settings ADD COLUMN IF NOT EXISTS last_missed_entry_sent_2 DATE NULL",
+                "ALTER TABLE time_record ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE NULL",
+                "ALTER TABLE notification_settings ADD COLUMN IF NOT EXISTS next_due_at TIMESTAMP WITH TIME ZONE NULL",
             ]
+            has_seq = db.session.execute(text(
+                "SELECT 1 FROM information_schema.columns WHERE table_name = 'record_change' AND column_name = 'seq'"
+            )).first() is not None
+            if not has_seq:
+                # Sólo al crear la columna: los cursores ya entregados eran ids
+                stmts += ["ALTER TABLE record_change ADD COLUMN IF NOT EXISTS seq BIGINT NULL",
+                          "UPDATE record_change SET seq = id"]
+            stmts += INDEX_STMTS
             for s in stmts:
                 try:
                     db.session.execute(text(s))
                 except Exception as e:
                     print(f"⚠️ upgrade_db postgres: {e}")
             db.session.commit()
+            _backfill_record_changes()
+            _backfill_next_due_at()
+            _backfill_ledger()
+            db.session.commit()
+            assign_change_seqs()
 
 # ==========================
 # Contexto Jinja
 # ==========================
 @app.context_processor
 def inject_now():
-    return {'now': now_local()}
+    return {'now': now_local(), 'presence_heartbeat': PRESENCE_HEARTBEAT}
 
 # ==========================
 # Rutas principales
@@ -494,11 +1300,9 @@ def login():
 
         if user and check_password_hash(user.password, password):
             login_user(user)
-            # NUEVO: Actualizar last_login_at
-            user.last_login_at = utcnow()
-            # NUEVO: Actualizar estado a "En línea"
-            user.status = "En línea"
-            db.session.commit()
+            # last_login_at y "En línea" van a presence (se guardan por lotes, sin commit aquí)
+            presence.seen(user.id, login=True)
+            publish_presence(user, lookup=True)
 
             # NUEVO: Log Discord de login
             log_event(
@@ -554,6 +1358,7 @@ def set_first_password_token(token):
         user.password = generate_password_hash(password)
         user.is_first_login = False
         db.session.commit()
+        identity_cache.invalidate(user.id)
         flash('✅ Contraseña configurada correctamente. Ya puedes iniciar sesión', 'success')
         return redirect(url_for('login'))
 
@@ -581,6 +1386,7 @@ def set_first_password(user_id):
         user.password = generate_password_hash(password)
         user.is_first_login = False
         db.session.commit()
+        identity_cache.invalidate(user.id)
         flash('Contraseña configurada correctamente. Ya puedes iniciar sesión', 'success')
         return redirect(url_for('login'))
 
@@ -623,98 +1429,64 @@ def dashboard():
 
     active_record = next((record for record in today_records if not record.exit_time), None)
 
-    # Semana actual (desde lunes)
-    week_start = today - timedelta(days=today.weekday())
-    week_records = (TimeRecord.query
-                    .filter(TimeRecord.user_id == current_user.id,
-                            TimeRecord.date >= week_start,
-                            TimeRecord.exit_time.isnot(None))
-                    .all())
-
-    weekly_hours = sum((r.exit_time - r.entry_time).total_seconds() / 3600 for r in week_records)
-    today_hours = sum((r.exit_time - r.entry_time).total_seconds() / 3600
-                      for r in today_records if r.exit_time)
-
-    # Total de horas trabajadas (todas las prácticas ya fichadas)
-    all_records = (TimeRecord.query
-                   .filter(TimeRecord.user_id == current_user.id,
-                           TimeRecord.exit_time.isnot(None))
-                   .all())
-    total_hours_worked = sum((r.exit_time - r.entry_time).total_seconds() / 3600 for r in all_records)
-
-    # Horarios semanales activos
-    schedules = Schedule.query.filter_by(user_id=current_user.id, is_active=True).all()
-    weekly_required_hours = 0
-    for i in range(7):
-        day = week_start + timedelta(days=i)
-        day_of_week = day.weekday()
-        day_schedule = next((s for s in schedules if s.day_of_week == day_of_week), None)
-        if day_schedule:
-            weekly_required_hours += day_schedule.hours_required
-
-    total_hours_required = current_user.total_hours_required or 0.0
-
     # ==== DÍAS EXTRA PLANIFICADOS (no cambian el horario) ====
     extra_days = ExtraWorkDay.query.filter(
         ExtraWorkDay.user_id == current_user.id,
         ExtraWorkDay.date >= today
     ).order_by(ExtraWorkDay.date.asc()).all()
 
-    # ==== CÁLCULO DE HORAS RESTANTES Y FECHA ESTIMADA DE FIN ====
-    hours_remaining = max(total_hours_required - total_hours_worked, 0.0)
-    estimated_end_date = None
-
-    if hours_remaining > 0 and (schedules or extra_days):
-        remaining = hours_remaining
-
-        # Índices rápidos
-        schedules_by_day = {s.day_of_week: s for s in schedules if s.is_active}
-        extras_by_date = {}
-        for e in extra_days:
-            extras_by_date.setdefault(e.date, 0.0)
-            extras_by_date[e.date] += (e.hours_planned or 0.0)
+    # Cifras calculadas: se sirven de la caché mientras no haya escrituras del usuario
+    snapshot = dashboard_cache.get(current_user.id, today)
+    if snapshot is None:
+        version = dashboard_cache.version(current_user.id)
+        snapshot = _compute_dashboard_snapshot(current_user, today, today_records, extra_days)
+        dashboard_cache.put(current_user.id, version, today, snapshot)
 
-        day_cursor = today
-        # Seguridad: recorremos como máximo 3 años hacia delante
-        for _ in range(365 * 3):
-            dow = day_cursor.weekday()
-            hours_for_day = 0.0
+    return render_template(
+        'dashboard.html',
+        active_record=active_record,
+        today_records=today_records,
+        extra_days=extra_days,
+        **snapshot
+    )
 
-            # Horas del horario fijo
-            sch = schedules_by_day.get(dow)
-            if sch and sch.hours_required:
-                hours_for_day += sch.hours_required
 
-            # Horas extra planificadas para ese día concreto (por ejemplo, un lunes suelto)
-            extra_hours = extras_by_date.get(day_cursor, 0.0)
-            hours_for_day += extra_hours
+def _compute_dashboard_snapshot(user, today, today_records, extra_days):
+    # Semana actual (desde lunes), sumada en la base de datos
+    week_start = today - timedelta(days=today.weekday())
+    weekly_hours = worked_seconds(user.id, start=week_start) / 3600
+    # Los registros de hoy ya están cargados para la tabla: se suman aquí
+    today_hours = sum(record_seconds(r) for r in today_records) / 3600
 
-            # Evitar contar dos veces lo ya fichado hoy
-            if day_cursor == today and today_hours > 0:
-                hours_for_day = max(hours_for_day - today_hours, 0.0)
+    # Total de horas trabajadas (todas las prácticas ya fichadas), desde el ledger
+    total_hours_worked = ledger_total_seconds(user.id) / 3600
 
-            if hours_for_day > 0:
-                remaining -= hours_for_day
-                if remaining <= 0:
-                    estimated_end_date = day_cursor
-                    break
+    # Horarios semanales activos
+    schedules = Schedule.query.filter_by(user_id=user.id, is_active=True).all()
+    weekly_required_hours = sum(weekly_schedule_hours(schedules))
 
-            day_cursor += timedelta(days=1)
+    total_hours_required = user.total_hours_required or 0.0
 
-    return render_template(
-        'dashboard.html',
-        active_record=active_record,
-        today_records=today_records,
-        weekly_hours=weekly_hours,
+    # ==== CÁLCULO DE HORAS RESTANTES Y FECHA ESTIMADA DE FIN ====
+    hours_remaining = max(total_hours_required - total_hours_worked, 0.0)
+    estimated_end_date = estimate_end_date(
+        hours_remaining,
+        weekly_schedule_hours(schedules),
+        [(e.date, e.hours_planned) for e in extra_days],
+        today=today,
         today_hours=today_hours,
-        weekly_required_hours=weekly_required_hours,
-        total_hours_worked=total_hours_worked,
-        total_hours_required=total_hours_required,
-        hours_remaining=hours_remaining,
-        estimated_end_date=estimated_end_date,
-        extra_days=extra_days
     )
 
+    return {
+        "weekly_hours": weekly_hours,
+        "today_hours": today_hours,
+        "weekly_required_hours": weekly_required_hours,
+        "total_hours_worked": total_hours_worked,
+        "total_hours_required": total_hours_required,
+        "hours_remaining": hours_remaining,
+        "estimated_end_date": estimated_end_date,
+    }
+
 
 @app.route('/extra_day/add', methods=['POST'])
 @login_required
@@ -749,6 +1521,7 @@ def add_extra_day():
             msg = 'Día extra añadido correctamente.'
 
         db.session.commit()
+        dashboard_cache.bump(current_user.id)
         flash(msg, 'success')
     except Exception as e:
         db.session.rollback()
@@ -770,6 +1543,7 @@ def delete_extra_day(id):
     try:
         db.session.delete(extra)
         db.session.commit()
+        dashboard_cache.bump(extra.user_id)
         flash('Día extra eliminado correctamente.', 'success')
     except Exception as e:
         db.session.rollback()
@@ -803,11 +1577,10 @@ def clock_in():
         is_active=True
     )
     db.session.add(new_record)
+    _record_changed(None, new_record)
     db.session.commit()
-
-    # Cambiar el estado a "Fichando"
-    current_user.status = "Fichando"
-    db.session.commit()
+    presence.seen(current_user.id)
+    publish_presence(current_user, new_record)  # "Fichando" sale del fichaje abierto
 
     # Log Discord (nuevo)
     log_clock("in", new_record, user=current_user)
@@ -827,13 +1600,17 @@ def clock_out():
         flash('No hay una sesión activa para cerrar', 'error')
         return redirect(url_for('dashboard'))
 
+    before = record_state(active_record)
     location = request.form.get('location', 'Córdoba Ecuestre')
     if location != active_record.location:
         active_record.location = f"{active_record.location} | Salida: {location}"
 
     active_record.exit_time = now_loc.astimezone(timezone.utc)  # UTC
     active_record.is_active = False
+    _record_changed(before, active_record)
     db.session.commit()
+    presence.seen(current_user.id)
+    publish_presence(current_user, lookup=True)
     # Log Discord (nuevo)
     log_clock("out", active_record, user=current_user)
 
@@ -893,6 +1670,7 @@ def add_schedule():
         flash('Horario añadido correctamente', 'success')
 
     db.session.commit()
+    dashboard_cache.bump(current_user.id)
 
     # Log Discord (nuevo)
     if action and obj:
@@ -909,6 +1687,7 @@ def toggle_schedule(id):
         return redirect(url_for('schedule'))
     schedule.is_active = not schedule.is_active
     db.session.commit()
+    dashboard_cache.bump(current_user.id)
     # Log Discord (nuevo)
     log_schedule("update", schedule, user=current_user, extra={"Estado": "Activo" if schedule.is_active else "Inactivo"})
 
@@ -927,6 +1706,7 @@ def delete_schedule(id):
 
     db.session.delete(schedule)
     db.session.commit()
+    dashboard_cache.bump(current_user.id)
     flash('Horario eliminado correctamente', 'success')
     return redirect(url_for('schedule'))
 
@@ -963,6 +1743,7 @@ def copy_week():
             db.session.add(new_schedule)
 
     db.session.commit()
+    dashboard_cache.bump(current_user.id)
 
     # Log Discord (nuevo) resumen único
     try:
@@ -981,21 +1762,59 @@ def update_total_hours():
     total_hours = float(request.form.get('total_hours', 150))
     current_user.total_hours_required = total_hours
     db.session.commit()
+    dashboard_cache.bump(current_user.id)
+    identity_cache.invalidate(current_user.id)
     flash('Horas totales actualizadas correctamente', 'success')
     return redirect(url_for('schedule'))
 
 # =============================
 # CRUD de fichajes para usuario
 # =============================
+def _parse_date_arg(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+    except ValueError:
+        return None
+
+def records_listing(user_id, args):
+    """Página de fichajes por clave (date, entry_time, id) con filtros opcionales.
+    Devuelve (página, filtros) para reconstruir los enlaces en la plantilla."""
+    date_from = _parse_date_arg(args.get('date_from'))
+    date_to = _parse_date_arg(args.get('date_to'))
+    open_only = args.get('open') == '1'
+    location = (args.get('location') or '').strip()
+    per_page = min(max(args.get('per_page', 10, type=int), 1), 100)
+
+    q = TimeRecord.query.filter(TimeRecord.user_id == user_id)
+    if date_from:
+        q = q.filter(TimeRecord.date >= date_from)
+    if date_to:
+        q = q.filter(TimeRecord.date <= date_to)
+    if open_only:
+        q = q.filter(TimeRecord.exit_time.is_(None))
+    if location:
+        # Subcadena sin índice propio: se evalúa sobre los fichajes del usuario ya acotados
+        q = q.filter(TimeRecord.location.ilike(f"%{location}%"))
+
+    page = keyset_paginate(q, [TimeRecord.date, TimeRecord.entry_time, TimeRecord.id],
+                           after=args.get('after'), before=args.get('before'), per_page=per_page)
+    if args.get('count') == '1':
+        page.total = q.order_by(None).count()
+
+    filters = {k: v for k, v in {
+        'date_from': date_from.isoformat() if date_from else None,
+        'date_to': date_to.isoformat() if date_to else None,
+        'open': '1' if open_only else None,
+        'location': location or None,
+        'per_page': per_page if per_page != 10 else None,
+    }.items() if v is not None}
+    return page, filters
+
 @app.route('/records')
 @login_required
 def records():
-    page = request.args.get('page', 1, type=int)
-    records = (TimeRecord.query
-               .filter_by(user_id=current_user.id)
-               .order_by(TimeRecord.date.desc(), TimeRecord.entry_time.desc())
-               .paginate(page=page, per_page=10))
-    return render_template('records.html', records=records)
+    records, filters = records_listing(current_user.id, request.args)
+    return render_template('records.html', records=records, filters=filters)
 
 @app.route('/records/new', methods=['GET', 'POST'])
 @login_required
@@ -1026,6 +1845,7 @@ def user_add_record():
                 notes=request.form.get('notes', '')
             )
             db.session.add(record)
+            _record_changed(None, record)
             db.session.commit()
             # Log Discord (nuevo)
             log_record("create", record, user=current_user)
@@ -1048,6 +1868,7 @@ def user_edit_record(record_id):
         return redirect(url_for('records'))
 
     if request.method == 'POST':
+        before = record_state(record)
         try:
             entry_time_str = request.form.get('entry_time')
             exit_time_str = request.form.get('exit_time')
@@ -1073,6 +1894,7 @@ def user_edit_record(record_id):
                 record.longitude = float(request.form.get('longitude'))
             record.location = request.form.get('location', '')
             record.notes = request.form.get('notes', '')
+            _record_changed(before, record)
             db.session.commit()
             # Log Discord (nuevo)
             log_record("update", record, user=current_user)
@@ -1099,6 +1921,7 @@ def user_delete_record(record_id):
     try:
         # Log Discord (nuevo) antes de borrar
         log_record("delete", record, user=current_user)
+        _record_changed(record_state(record), None)
         db.session.delete(record)
         db.session.commit()
         flash('Fichaje eliminado correctamente', 'success')
@@ -1114,7 +1937,10 @@ def user_delete_record(record_id):
 @app.route('/reports')
 @login_required
 def reports():
-    return render_template('reports.html')
+    # ?job=<id>: estado de un PDF encolado desde el formulario sin JavaScript
+    job_id = request.args.get('job')
+    job = report_job_payload(_own_report_job(job_id)) if job_id else None
+    return render_template('reports.html', job=job)
 
 @app.route('/generate_report', methods=['POST'])
 @login_required
@@ -1123,185 +1949,370 @@ def generate_report():
     end_date = datetime.strptime(request.form.get('end_date'), '%Y-%m-%d').date()
     report_type = request.form.get('report_type')
 
-    records = (TimeRecord.query
-               .filter(TimeRecord.user_id == current_user.id,
-                       TimeRecord.date >= start_date,
-                       TimeRecord.date <= end_date)
-               .order_by(TimeRecord.date, TimeRecord.entry_time)
-               .all())
-
-    if report_type == 'csv':
-        return generate_csv_report(records, start_date, end_date)
-    elif report_type == 'pdf':
-        return generate_pdf_report(records, start_date, end_date)
-    else:
+    query = (TimeRecord.query
+             .filter(TimeRecord.user_id == current_user.id,
+                     TimeRecord.date >= start_date,
+                     TimeRecord.date <= end_date)
+             .order_by(TimeRecord.date, TimeRecord.entry_time))
+
+    if report_type not in ('csv', 'pdf'):
         flash('Tipo de reporte no válido', 'error')
         return redirect(url_for('reports'))
 
-def generate_csv_report(records, start_date, end_date):
+    if report_type == 'pdf':
+        # El PDF nunca se maqueta en el hilo de la petición: se encola y la página
+        # de informes muestra el estado hasta que se puede descargar
+        job, error, _ = enqueue_report_job(start_date, end_date)
+        if job is None:
+            flash(error, 'error')
+            return redirect(url_for('reports'))
+        return redirect(url_for('reports', job=job.id))
+
+    cache_key, _ = report_cache_key(current_user, start_date, end_date, report_type)
+    cached = report_cache.get(cache_key)
+    if cached:
+        return send_file(cached, mimetype='text/csv', as_attachment=True,
+                         download_name=f'reporte_{start_date}_{end_date}.csv')
+    return generate_csv_report(query, start_date, end_date, cache_key=cache_key)
+
+# ======= Caché de informes =======
+# La clave incluye una "versión" de los fichajes del rango: nº de filas, suma de ids
+# (cambia al borrar/añadir) y último updated_at (cambia al editar). Editar un fichaje
+# sólo cambia la clave de los rangos que lo contienen; el resto sigue sirviéndose.
+REPORT_CACHE_FORMAT = 1  # subir si cambia el contenido/maquetación de los informes
+report_cache = ReportCache(os.path.join(app.instance_path, 'report_cache'),
+                           max_bytes=int(os.environ.get('REPORT_CACHE_MB', 200)) * 1024 * 1024)
+
+def report_data_version(user_id, start_date, end_date):
+    count, id_sum, last_update = (db.session.query(db.func.count(TimeRecord.id),
+                                                   db.func.coalesce(db.func.sum(TimeRecord.id), 0),
+                                                   db.func.max(TimeRecord.updated_at))
+                                  .filter(TimeRecord.user_id == user_id,
+                                          TimeRecord.date >= start_date,
+                                          TimeRecord.date <= end_date)
+                                  .one())
+    return count, f"{count}:{id_sum}:{as_utc_naive(last_update).isoformat() if last_update else '-'}"
+
+def report_cache_key(user, start_date, end_date, kind):
+    """Devuelve (clave, nº de fichajes del rango).
+    El PDF lleva "Generado el <fecha>" en el pie: su clave incluye el día de hoy."""
+    count, version = report_data_version(user.id, start_date, end_date)
+    generated = now_local().date() if kind == 'pdf' else None
+    raw = "|".join(str(v) for v in (REPORT_CACHE_FORMAT, user.id, user.name, user.email,
+                                    start_date, end_date, kind, TZ, version, generated))
+    return f"{hashlib.sha256(raw.encode('utf-8')).hexdigest()}.{kind}", count
+
+CSV_HEADER = ['Fecha', 'Entrada', 'Salida', 'Duración', 'Ubicación', 'Coordenadas']
+CSV_CHUNK_BYTES = 64 * 1024  # se envía al cliente cada ~64 KB
+CSV_YIELD_PER = 500          # filas por lote leídas de la BD (cursor de servidor en PostgreSQL)
+
+def _csv_row(r):
+    dur = format_seconds_to_hm(record_seconds(r)) if r.exit_time else ''
+    coords = f"{r.latitude:.6f}, {r.longitude:.6f}" if r.latitude is not None and r.longitude is not None else ''
+    return [
+        r.date.strftime('%d/%m/%Y'),
+        fmt_local(r.entry_time, '%H:%M'),
+        fmt_local(r.exit_time, '%H:%M') if r.exit_time else 'En curso',
+        dur,
+        r.location or '',
+        coords
+    ]
+
+def _iter_csv(query, header=CSV_HEADER, row_fn=_csv_row):
+    """Genera el CSV por trozos leyendo la consulta por lotes: memoria constante."""
     output = io.StringIO()
     writer = csv.writer(output)
-    writer.writerow(['Fecha', 'Entrada', 'Salida', 'Duración', 'Ubicación', 'Coordenadas'])
+    writer.writerow(header)
+    for item in query.yield_per(CSV_YIELD_PER):
+        writer.writerow(row_fn(item))
+        if output.tell() >= CSV_CHUNK_BYTES:
+            yield output.getvalue().encode('utf-8')
+            output.seek(0)
+            output.truncate()
+    yield output.getvalue().encode('utf-8')
+
+def _csv_response(chunks, filename):
+    return Response(stream_with_context(chunks), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+def generate_csv_report(query, start_date, end_date, cache_key=None):
+    chunks = _iter_csv(query)
+    if cache_key:
+        chunks = report_cache.tee(cache_key, chunks)
+    return _csv_response(chunks, f'reporte_{start_date}_{end_date}.csv')
+
+PDF_LOGO_PATH = os.path.join(app.root_path, "static", "icon-144x144.png")
+
+def _pdf_rows(records):
+    """Filas del PDF ya formateadas como texto (se pueden enviar a otro proceso)."""
+    rows = []
     for r in records:
-        dur = format_seconds_to_hm((r.exit_time - r.entry_time).total_seconds()) if r.exit_time else ''
-        coords = f"{r.latitude:.6f}, {r.longitude:.6f}" if r.latitude is not None and r.longitude is not None else ''
-        writer.writerow([
-            r.date.strftime('%d/%m/%Y'),
-            fmt_local(r.entry_time, '%H:%M'),
-            fmt_local(r.exit_time, '%H:%M') if r.exit_time else 'En curso',
-            dur,
-            r.location or '',
-            coords
-        ])
-    output.seek(0)
-    return send_file(io.BytesIO(output.getvalue().encode('utf-8')),
-                     mimetype='text/csv',
-                     as_attachment=True,
-                     download_name=f'reporte_{start_date}_{end_date}.csv')
-
-def generate_pdf_report(records, start_date, end_date):
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(
-        buffer, pagesize=A4,
-        leftMargin=2*cm, rightMargin=2*cm,
-        topMargin=2.2*cm, bottomMargin=2*cm
-    )
-    styles = getSampleStyleSheet()
-    styles.add(ParagraphStyle(name="TitleBig", parent=styles["Heading1"], fontName="Helvetica-Bold",
-                              fontSize=18, textColor=colors.HexColor("#111827"), spaceAfter=8))
-    styles.add(ParagraphStyle(name="Meta", parent=styles["Normal"], fontSize=10,
-                              textColor=colors.HexColor("#4B5563"), leading=14, spaceAfter=3))
-    styles.add(ParagraphStyle(name="Cell", parent=styles["Normal"], fontSize=9, leading=12))
-    styles.add(ParagraphStyle(name="CellBold", parent=styles["Normal"], fontName="Helvetica-Bold", fontSize=9, leading=12))
-
-    elements = []
-    title_row = []
-    logo_path = os.path.join(app.root_path, "static", "icon-144x144.png")
-    if os.path.exists(logo_path):
-        title_row.append(Image(logo_path, width=1.2*cm, height=1.2*cm))
-    else:
-        title_row.append(Spacer(1, 1.2*cm))
-    title_row.append(Paragraph("Reporte de fichajes", styles["TitleBig"]))
-    header_tbl = Table([title_row], colWidths=[1.4*cm, doc.width - 1.4*cm])
-    header_tbl.setStyle(TableStyle([("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-                                    ("BOTTOMPADDING", (0, 0), (-1, -1), 6)]))
-    elements.append(header_tbl)
-
-    periodo = f"{start_date.strftime('%d/%m/%Y')} a {end_date.strftime('%d/%m/%Y')}"
-    elements.append(Paragraph(f"<b>Usuario:</b> {current_user.name}", styles["Meta"]))
-    elements.append(Paragraph(f"<b>Período:</b> {periodo}", styles["Meta"]))
-    elements.append(Paragraph(f"<b>Email:</b> {current_user.email}", styles["Meta"]))
-    elements.append(Spacer(1, 6))
-
-    data = [[Paragraph("Fecha", styles["CellBold"]),
-             Paragraph("Entrada", styles["CellBold"]),
-             Paragraph("Salida", styles["CellBold"]),
-             Paragraph("Duración", styles["CellBold"]),
-             Paragraph("Ubicación", styles["CellBold"]),
-             Paragraph("Coordenadas", styles["CellBold"])]]
-
-    total_seconds = 0
-    open_sessions = 0
-    unique_days = set()
-
-    for r in records:
-        unique_days.add(r.date)
         fecha = r.date.strftime("%d/%m/%Y")
         entrada = fmt_local(r.entry_time, "%H:%M") if r.entry_time else "—"
         if r.exit_time:
             salida = fmt_local(r.exit_time, "%H:%M")
-            dur_secs = (r.exit_time - r.entry_time).total_seconds()
-            dur = format_seconds_to_hm(dur_secs)
-            total_seconds += int(dur_secs)
+            dur = format_seconds_to_hm(record_seconds(r))
         else:
             salida = "En curso"
             dur = "En curso"
-            open_sessions += 1
 
-        ubic = Paragraph((r.location or "—"), styles["Cell"])
         coords = "—"
         if r.latitude is not None and r.longitude is not None:
             try:
                 coords = f"{float(r.latitude):.5f}, {float(r.longitude):.5f}"
             except Exception:
                 coords = f"{r.latitude}, {r.longitude}"
+        rows.append((fecha, entrada, salida, dur, r.location or "—", coords))
+    return rows
+
+def _pdf_meta(user, start_date, end_date):
+    summary = report_summary(user.id, start_date, end_date)
+    total_seconds = int(summary["total_seconds"])
+    avg_per_day = int(total_seconds / max(summary["days"], 1))
+    return {
+        "user_name": user.name,
+        "user_email": user.email,
+        "start_date": start_date,
+        "end_date": end_date,
+        "summary_rows": [
+            ("Sesiones cerradas", summary["closed"]),
+            ("Sesiones abiertas", summary["open"]),
+            ("Total trabajado", format_seconds_to_hm(total_seconds)),
+            ("Promedio por día", format_seconds_to_hm(avg_per_day)),
+        ],
+        "logo_path": PDF_LOGO_PATH,
+        "tz": TZ,
+    }
 
-        data.append([Paragraph(fecha, styles["Cell"]),
-                     Paragraph(entrada, styles["Cell"]),
-                     Paragraph(salida, styles["Cell"]),
-                     Paragraph(dur, styles["Cell"]),
-                     ubic,
-                     Paragraph(coords, styles["Cell"])])
-
-    fixed_widths = [2.2*cm, 1.8*cm, 1.8*cm, 2.5*cm, 3.0*cm]
-    auto_width = doc.width - sum(fixed_widths)
-    col_widths = [2.2*cm, 1.8*cm, 1.8*cm, 2.5*cm, auto_width, 3.0*cm]
-    if auto_width < 5*cm:
-        col_widths = [2.0*cm, 1.6*cm, 1.6*cm, 2.2*cm,
-                      doc.width - (2.0*cm + 1.6*cm + 1.6*cm + 2.2*cm + 2.6*cm),
-                      2.6*cm]
-
-    table = Table(data, colWidths=col_widths, repeatRows=1)
-    table.setStyle(TableStyle([
-        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#2563EB")),
-        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
-        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-        ("ALIGN", (0, 0), (-1, 0), "CENTER"),
-        ("TOPPADDING", (0, 0), (-1, 0), 6),
-        ("BOTTOMPADDING", (0, 0), (-1, 0), 6),
-        ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.whitesmoke, colors.HexColor("#F3F4F6")]),
-        ("ALIGN", (0, 1), (0, -1), "CENTER"),
-        ("ALIGN", (1, 1), (3, -1), "CENTER"),
-        ("VALIGN", (0, 1), (-1, -1), "TOP"),
-        ("GRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#E5E7EB")),
-    ]))
-    elements.append(table)
-    elements.append(Spacer(1, 10))
-
-    avg_per_day = int(total_seconds / max(len(unique_days), 1))
-    resumen = [
-        [Paragraph("<b>Sesiones cerradas</b>", styles["Cell"]), Paragraph(str(len([r for r in records if r.exit_time])), styles["Cell"])],
-        [Paragraph("<b>Sesiones abiertas</b>", styles["Cell"]), Paragraph(str(open_sessions), styles["Cell"])],
-        [Paragraph("<b>Total trabajado</b>", styles["Cell"]), Paragraph(format_seconds_to_hm(total_seconds), styles["Cell"])],
-        [Paragraph("<b>Promedio por día</b>", styles["Cell"]), Paragraph(format_seconds_to_hm(avg_per_day), styles["Cell"])],
-    ]
-    resumen_tbl = Table(resumen, colWidths=[5.5*cm, doc.width - 5.5*cm])
-    resumen_tbl.setStyle(TableStyle([
-        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#EFF6FF")),
-        ("BOX", (0, 0), (-1, -1), 0.5, colors.HexColor("#E5E7EB")),
-        ("INNERGRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#E5E7EB")),
-        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-        ("TOPPADDING", (0, 0), (-1, -1), 6),
-        ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
-    ]))
-    elements.append(Paragraph("Resumen", styles["CellBold"]))
-    elements.append(Spacer(1, 4))
-    elements.append(resumen_tbl)
-    elements.append(Spacer(1, 12))
-
-    footer_tbl = Table([[Paragraph('Este Fichador ha sido realizado por @chriismartinezz', styles["Cell"])]],
-                       colWidths=[doc.width])
-    footer_tbl.setStyle(TableStyle([
-        ("ALIGN", (0, 0), (-1, -1), "CENTER"),
-        ("LINEABOVE", (0, 0), (-1, 0), 0.7, colors.HexColor("#9CA3AF")),
-        ("TOPPADDING", (0, 0), (-1, -1), 12),
-        ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
-    ]))
-    elements.append(footer_tbl)
-
-    doc.build(elements, onFirstPage=_pdf_footer, onLaterPages=_pdf_footer)
-
-    buffer.seek(0)
-    fname = f"reporte_{start_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}.pdf"
-    return send_file(buffer, mimetype="application/pdf", as_attachment=True, download_name=fname)
-
-def _pdf_footer(canvas, doc):
-    canvas.saveState()
-    canvas.setFont("Helvetica", 9)
-    canvas.setFillColor(colors.HexColor("#6B7280"))
-    canvas.drawString(doc.leftMargin, 1.2 * cm, f"Generado el {datetime.now(ZONE).strftime('%d/%m/%Y %H:%M')}")
-    canvas.drawRightString(doc.rightMargin + doc.width, 1.2 * cm, f"Página {doc.page}")
-    canvas.restoreState()
+def _pdf_filename(start_date, end_date):
+    return f"reporte_{start_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}.pdf"
+
+# ======= Informes en segundo plano =======
+# La maquetación con reportlab es CPU pura: se hace en un pool de procesos para no
+# bloquear los hilos de gunicorn. Un hilo "dispatcher" por trabajo lee los datos de
+# la BD, manda las filas al pool y guarda el resultado en ReportJob.
+REPORT_DIR = os.path.join(app.instance_path, 'reports')
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', 2))
+REPORT_JOBS_PER_USER = int(os.environ.get('REPORT_JOBS_PER_USER', 2))
+REPORT_JOB_TIMEOUT = int(os.environ.get('REPORT_JOB_TIMEOUT', 300))         # segundos
+REPORT_RETENTION_HOURS = int(os.environ.get('REPORT_RETENTION_HOURS', 24))
+REPORT_ACTIVE = ('queued', 'running')
+
+_report_pool = None
+_report_dispatcher = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix='report')
+_report_pool_lock = threading.Lock()
+
+def report_pool():
+    """Pool de procesos perezoso (se crea en el worker de gunicorn, no en el master)."""
+    global _report_pool
+    with _report_pool_lock:
+        if _report_pool is None:
+            _report_pool = ProcessPoolExecutor(max_workers=REPORT_WORKERS,
+                                               mp_context=multiprocessing.get_context('spawn'))
+        return _report_pool
+
+def _reset_report_pool(pool, kill=False):
+    """Descarta `pool` (si sigue siendo el actual); el siguiente trabajo crea otro.
+    Con kill=True se matan sus procesos: shutdown() sólo cancela lo que no empezó
+    y una maquetación desbocada seguiría consumiendo CPU y memoria. Otro trabajo
+    que estuviera en ese pool termina con BrokenProcessPool."""
+    global _report_pool
+    with _report_pool_lock:
+        if pool is not _report_pool:
+            return  # otro hilo ya lo recreó
+        _report_pool = None
+    procs = list((pool._processes or {}).values()) if kill else []
+    pool.shutdown(wait=False, cancel_futures=True)
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        proc.join(timeout=5)
+        if proc.is_alive():
+            proc.kill()
+            proc.join(timeout=5)
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _elapsed_ms(since):
+    return int((as_utc_naive(utcnow()) - as_utc_naive(since)).total_seconds() * 1000)
+
+def _finish_report_job(job, status, error=None):
+    job.status = status
+    job.error = (error or '')[:500] or None
+    job.finished_at = utcnow()
+    job.duration_ms = _elapsed_ms(job.started_at or job.created_at)
+
+def _run_report_job(job_id):
+    with app.app_context():
+        job = db.session.get(ReportJob, job_id)
+        if job is None or job.status != 'queued':
+            return
+        job.status = 'running'
+        job.started_at = utcnow()
+        db.session.commit()
+        path = None
+        try:
+            user = db.session.get(User, job.user_id)
+            cache_key, _ = report_cache_key(user, job.start_date, job.end_date, job.kind)
+            records = (TimeRecord.query
+                       .filter(TimeRecord.user_id == job.user_id,
+                               TimeRecord.date >= job.start_date,
+                               TimeRecord.date <= job.end_date)
+                       .order_by(TimeRecord.date, TimeRecord.entry_time))
+            rows = _pdf_rows(records.yield_per(CSV_YIELD_PER))
+            meta = _pdf_meta(user, job.start_date, job.end_date)
+            db.session.commit()  # libera la conexión mientras se maqueta
+
+            os.makedirs(REPORT_DIR, exist_ok=True)
+            path = os.path.join(REPORT_DIR, f"{job.id}.pdf")
+            pool = report_pool()
+            try:
+                result = pool.submit(render_pdf_report_file, path, rows, **meta).result(timeout=REPORT_JOB_TIMEOUT)
+            except FuturesTimeout:
+                # Un proceso no se puede interrumpir a medias: se mata el pool y se recrea
+                _reset_report_pool(pool, kill=True)
+                raise RuntimeError(f"Tiempo agotado ({REPORT_JOB_TIMEOUT}s)")
+            except BrokenProcessPool:
+                _reset_report_pool(pool)
+                raise
+
+            report_cache.put(cache_key, path, move=False)
+            job.rows = result["rows"]
+            job.render_ms = result["render_ms"]
+            job.file_path = path
+            _finish_report_job(job, 'done')
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if path:
+                _remove_quietly(path)  # PDF a medias, o trabajo borrado con su usuario
+            job = db.session.get(ReportJob, job_id)
+            if job is None:
+                print(f"🗑️ Report job {job_id} borrado mientras se generaba")
+                return
+            _finish_report_job(job, 'error', str(e) or e.__class__.__name__)
+            print(f"❌ Report job {job_id}: {e!r}")
+            db.session.commit()
+        print(f"📄 Report job {job.id} {job.status} rows={job.rows} total={job.duration_ms}ms render={job.render_ms}ms")
+
+def _expire_stale_report_jobs(user_id):
+    """Trabajos que nunca terminaron (p. ej. reinicio del proceso) pasan a error."""
+    limit = utcnow() - timedelta(seconds=REPORT_JOB_TIMEOUT * 2)
+    stale = (ReportJob.query
+             .filter(ReportJob.user_id == user_id,
+                     ReportJob.status.in_(REPORT_ACTIVE),
+                     ReportJob.created_at < limit)
+             .all())
+    for job in stale:
+        _finish_report_job(job, 'error', 'Trabajo interrumpido')
+    return len(stale)
+
+def _purge_old_report_jobs(user_id):
+    limit = utcnow() - timedelta(hours=REPORT_RETENTION_HOURS)
+    old = (ReportJob.query
+           .filter(ReportJob.user_id == user_id,
+                   ReportJob.status.notin_(REPORT_ACTIVE),
+                   ReportJob.created_at < limit)
+           .all())
+    for job in old:
+        _delete_report_job(job)
+
+def _delete_report_job(job):
+    if job.file_path and os.path.exists(job.file_path):
+        try:
+            os.remove(job.file_path)
+        except OSError as e:
+            print(f"⚠️ No se pudo borrar {job.file_path}: {e}")
+    db.session.delete(job)
+
+def report_job_payload(job):
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "start_date": job.start_date.isoformat(),
+        "end_date": job.end_date.isoformat(),
+        "rows": job.rows,
+        "duration_ms": job.duration_ms,
+        "render_ms": job.render_ms,
+        "error": job.error,
+        "status_url": url_for('report_job_status', job_id=job.id),
+        "download_url": url_for('report_job_download', job_id=job.id) if job.status == 'done' else None,
+    }
+
+def enqueue_report_job(start_date, end_date):
+    """Encola un PDF del usuario actual. Devuelve (job, None, status HTTP) o (None, error, status)."""
+    if end_date < start_date:
+        return None, "La fecha fin es anterior a la de inicio", 400
+
+    _expire_stale_report_jobs(current_user.id)
+    _purge_old_report_jobs(current_user.id)
+    active = (ReportJob.query
+              .filter(ReportJob.user_id == current_user.id, ReportJob.status.in_(REPORT_ACTIVE))
+              .count())
+    if active >= REPORT_JOBS_PER_USER:
+        db.session.commit()
+        return None, f"Ya tienes {active} informe(s) en curso; espera a que terminen", 429
+
+    job = ReportJob(user_id=current_user.id, kind='pdf', start_date=start_date, end_date=end_date)
+    db.session.add(job)
+    cache_key, count = report_cache_key(current_user, start_date, end_date, job.kind)
+    cached = report_cache.get(cache_key)
+    if cached:
+        # Mismos datos que un informe ya generado: se entrega sin pasar por el pool
+        db.session.flush()
+        os.makedirs(REPORT_DIR, exist_ok=True)
+        job.file_path = os.path.join(REPORT_DIR, f"{job.id}.pdf")
+        with cached, open(job.file_path, 'wb') as out:
+            shutil.copyfileobj(cached, out)
+        job.rows = count
+        job.started_at = utcnow()
+        _finish_report_job(job, 'done')
+        db.session.commit()
+        return job, None, 200
+    db.session.commit()
+    _report_dispatcher.submit(_run_report_job, job.id)
+    return job, None, 202
+
+@app.route('/reports/jobs', methods=['POST'])
+@login_required
+def report_job_create():
+    try:
+        start_date = datetime.strptime(request.form.get('start_date', ''), '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.form.get('end_date', ''), '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({"error": "Fechas no válidas"}), 400
+    job, error, status = enqueue_report_job(start_date, end_date)
+    if job is None:
+        return jsonify({"error": error}), status
+    return jsonify(report_job_payload(job)), status
+
+def _own_report_job(job_id):
+    job = db.session.get(ReportJob, job_id)
+    if job is None or job.user_id != current_user.id:
+        abort(404)
+    return job
+
+@app.route('/reports/jobs/<job_id>')
+@login_required
+def report_job_status(job_id):
+    job = _own_report_job(job_id)
+    if job.status in REPORT_ACTIVE and _expire_stale_report_jobs(current_user.id):
+        db.session.commit()
+    return jsonify(report_job_payload(job))
+
+@app.route('/reports/jobs/<job_id>/download')
+@login_required
+def report_job_download(job_id):
+    job = _own_report_job(job_id)
+    if job.status != 'done' or not job.file_path or not os.path.exists(job.file_path):
+        abort(404)
+    return send_file(job.file_path, mimetype="application/pdf", as_attachment=True,
+                     download_name=_pdf_filename(job.start_date, job.end_date))
 
 # ==========================
 # Stats
@@ -1309,15 +2320,66 @@ def _pdf_footer(canvas, doc):
 @app.route('/stats')
 @login_required
 def stats():
-    today = now_local().date()
-    week_start = today - timedelta(days=today.weekday())
-    daily_hours = []
-    for i in range(7):
-        day = week_start + timedelta(days=i)
-        records = TimeRecord.query.filter_by(user_id=current_user.id, date=day).all()
-        day_hours = sum((r.exit_time - r.entry_time).total_seconds() / 3600 for r in records if r.exit_time)
-        daily_hours.append(round(day_hours, 2))
-    return render_template('stats.html', daily_hours=daily_hours)
+    data = stats_buckets(current_user.id, 'week')
+    return render_template('stats.html', daily_hours=data['hours'], stats_ranges=STATS_RANGES)
+
+# Rangos de estadísticas: (etiqueta, agrupación)
+STATS_RANGES = {
+    'week': ('Semana', 'day'),
+    'month': ('Mes', 'day'),
+    'quarter': ('Trimestre', 'week'),
+    'year': ('Año', 'week'),
+}
+
+def _stats_period(range_key, today):
+    if range_key == 'week':
+        start = today - timedelta(days=today.weekday())
+        return start, start + timedelta(days=6)
+    if range_key == 'month':
+        start = today.replace(day=1)
+        next_month = (start + timedelta(days=32)).replace(day=1)
+        return start, next_month - timedelta(days=1)
+    if range_key == 'quarter':
+        first_month = 3 * ((today.month - 1) // 3) + 1
+        start = today.replace(month=first_month, day=1)
+        next_q = (start + timedelta(days=95)).replace(day=1)
+        return start, next_q - timedelta(days=1)
+    start = today.replace(month=1, day=1)
+    return start, today.replace(month=12, day=31)
+
+def stats_buckets(user_id, range_key, today=None):
+    """Horas por día o por semana del periodo, agregadas en la base de datos (1 consulta)."""
+    today = today or now_local().date()
+    start, end = _stats_period(range_key, today)
+    bucket = STATS_RANGES[range_key][1]
+    if bucket == 'day':
+        sums = worked_seconds_by_day(user_id, start, end)
+        keys = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+        labels = ([DAYS_ES[k.weekday()] for k in keys] if range_key == 'week'
+                  else [k.strftime('%d/%m') for k in keys])
+    else:
+        sums = worked_seconds_by_week(user_id, start, end)
+        first = start - timedelta(days=start.weekday())
+        keys = [first + timedelta(weeks=i) for i in range((end - first).days // 7 + 1)]
+        labels = [f"Sem {k.strftime('%d/%m')}" for k in keys]
+    hours = [round(sums.get(k, 0.0) / 3600, 2) for k in keys]
+    return {
+        'range': range_key,
+        'bucket': bucket,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'labels': labels,
+        'hours': hours,
+        'total_hours': round(sum(sums.values()) / 3600, 2),
+    }
+
+@app.route('/api/stats')
+@login_required
+def api_stats():
+    range_key = request.args.get('range', 'week')
+    if range_key not in STATS_RANGES:
+        return jsonify({"error": "Rango no válido", "ranges": list(STATS_RANGES)}), 400
+    return jsonify(stats_buckets(current_user.id, range_key))
 
 # ==========================
 # Admin
@@ -1329,31 +2391,71 @@ def admin():
         flash('No tienes permisos de administrador', 'error')
         return redirect(url_for('dashboard'))
 
-    users = User.query.all()
-    users_with_status = []  # Lista para pasar estado a la plantilla
-    for user in users:
-        # Comprobar si está fichando (active record = exit_time is NULL)
-        active_record = TimeRecord.query.filter_by(user_id=user.id, exit_time=None).first()
-
-        # Determinar el estado
-        if user.status == "En línea":
-            status = "En línea"
-        elif user.status == "Fichando" and active_record:
-            status = "Fichando"
-        else:
-            status = "Desconectado"
-
-        # Añadir la información del estado y si está fichando
-        user_data = {
+    users_with_status = admin_overview()  # Lista para pasar estado a la plantilla
+    return render_template('admin.html', users=users_with_status,  # Pasar la lista con el estado
+                           dashboard_cache_stats=dashboard_cache.stats(),
+                           report_cache_stats=report_cache.stats(),
+                           push_outbox_stats=push_outbox_stats(),
+                           discord_stats=shipper_stats(),
+                           identity_cache_stats=identity_cache.stats(),
+                           presence_stats=presence.stats())
+
+
+def admin_overview(today=None):
+    """Usuarios con fichaje abierto, horas de hoy y estado en UNA consulta (sin N+1)."""
+    today = today or now_local().date()
+    open_sq = (db.session.query(TimeRecord.user_id.label('uid'), db.func.min(TimeRecord.id).label('rid'))
+               .filter(TimeRecord.exit_time.is_(None))
+               .group_by(TimeRecord.user_id)
+               .subquery())
+    today_sq = (db.session.query(TimeRecord.user_id.label('uid'),
+                                 db.func.sum(_duration_seconds_expr()).label('secs'))
+                .filter(TimeRecord.date == today, TimeRecord.exit_time.isnot(None))
+                .group_by(TimeRecord.user_id)
+                .subquery())
+    OpenRecord = db.aliased(TimeRecord)
+    rows = (db.session.query(User, OpenRecord, today_sq.c.secs)
+            .outerjoin(open_sq, open_sq.c.uid == User.id)
+            .outerjoin(OpenRecord, OpenRecord.id == open_sq.c.rid)
+            .outerjoin(today_sq, today_sq.c.uid == User.id)
+            .order_by(User.id)
+            .all())
+
+    users_with_status = []
+    for user, active_record, today_secs in rows:
+        users_with_status.append({
             'user': user,
-            'status': status,  # Estado del usuario
+            'status': presence_status(user, active_record is not None),  # Estado del usuario
             'is_clocked_in': active_record is not None,  # Si está fichando
-            'active_record': active_record  # Opcional, para obtener detalles sobre el fichaje
-        }
+            'active_record': active_record,  # Opcional, para obtener detalles sobre el fichaje
+            'today_seconds': float(today_secs or 0.0),  # Horas cerradas de hoy
+            # Un login reciente puede no estar guardado aún (presence escribe por lotes)
+            'last_login_at': _presence_dt(presence.last_login(user.id)) or user.last_login_at,
+        })
+    return users_with_status
 
-        users_with_status.append(user_data)
 
-    return render_template('admin.html', users=users_with_status)  # Pasar la lista con el estado
+@app.route('/admin/presence')
+@login_required
+def admin_presence():
+    """Foto completa de presencia (carga inicial, resync y fallback por polling)."""
+    if not current_user.is_admin:
+        return jsonify({"error": "forbidden"}), 403
+    users = [presence_payload(item['user'], item['active_record']) for item in admin_overview()]
+    return jsonify(users=users, stream=presence_broker.stats())
+
+@app.route('/admin/presence/stream')
+@login_required
+def admin_presence_stream():
+    """Server-Sent Events con los cambios de presencia. 503 si no hay hueco: el cliente hace polling."""
+    if not current_user.is_admin:
+        return jsonify({"error": "forbidden"}), 403
+    sub = presence_broker.subscribe()
+    if sub is None:
+        return jsonify({"error": "too many streams"}), 503
+    db.session.remove()  # no retener una conexión a la BD mientras dure el stream
+    return Response(presence_broker.stream(sub, max_duration=PRESENCE_STREAM_SECONDS), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/admin/create_user', methods=['POST'])
@@ -1381,6 +2483,7 @@ def admin_create_user():
     )
     db.session.add(new_user)
     db.session.commit()
+    identity_cache.invalidate(new_user.id)  # SQLite puede reutilizar el id de un usuario borrado
 
     print(f"👤 Usuario creado: {name} ({email})")
 
@@ -1423,10 +2526,17 @@ def admin_delete_user(user_id):
         return redirect(url_for('admin'))
 
     user = User.query.get_or_404(user_id)
+    _tombstone_user_records(user_id)
     TimeRecord.query.filter_by(user_id=user_id).delete()
     Schedule.query.filter_by(user_id=user_id).delete()
+    PushOutbox.query.filter_by(user_id=user_id).delete()
+    for job in ReportJob.query.filter_by(user_id=user_id):
+        _delete_report_job(job)  # uno aún en marcha ya no encuentra su fila y borra su PDF
+    _ledger_forget_user(user_id)
     db.session.delete(user)
     db.session.commit()
+    dashboard_cache.bump(user_id)
+    identity_cache.invalidate(user_id)
     flash(f'Usuario {user.name} eliminado correctamente', 'success')
     return redirect(url_for('admin'))
 
@@ -1437,12 +2547,25 @@ def admin_user_records(user_id):
         flash('No tienes permisos de administrador', 'error')
         return redirect(url_for('dashboard'))
     user = User.query.get_or_404(user_id)
-    page = request.args.get('page', 1, type=int)
-    records = (TimeRecord.query
-               .filter_by(user_id=user_id)
-               .order_by(TimeRecord.date.desc(), TimeRecord.entry_time.desc())
-               .paginate(page=page, per_page=10))
-    return render_template('admin_records.html', user=user, records=records)
+    records, filters = records_listing(user_id, request.args)
+    return render_template('admin_records.html', user=user, records=records, filters=filters)
+
+@app.route('/admin/export_csv')
+@login_required
+def admin_export_csv():
+    """Exporta en streaming los fichajes de TODOS los usuarios en un rango."""
+    if not current_user.is_admin:
+        flash('No tienes permisos de administrador', 'error')
+        return redirect(url_for('dashboard'))
+    start_date = _parse_date_arg(request.args.get('start_date')) or date(2000, 1, 1)
+    end_date = _parse_date_arg(request.args.get('end_date')) or now_local().date()
+    query = (db.session.query(TimeRecord, User.email)
+             .join(User, User.id == TimeRecord.user_id)
+             .filter(TimeRecord.date >= start_date, TimeRecord.date <= end_date)
+             .order_by(TimeRecord.user_id, TimeRecord.date, TimeRecord.entry_time))
+    chunks = _iter_csv(query, header=['Usuario'] + CSV_HEADER,
+                       row_fn=lambda row: [row[1]] + _csv_row(row[0]))
+    return _csv_response(chunks, f'fichajes_{start_date}_{end_date}.csv')
 
 @app.route('/admin/edit_record/<int:record_id>', methods=['GET', 'POST'])
 @login_required
@@ -1452,6 +2575,7 @@ def admin_edit_record(record_id):
         return redirect(url_for('dashboard'))
     record = TimeRecord.query.get_or_404(record_id)
     if request.method == 'POST':
+        before = record_state(record)
         entry_time_str = request.form.get('entry_time')
         exit_time_str = request.form.get('exit_time')
 
@@ -1470,6 +2594,7 @@ def admin_edit_record(record_id):
             record.longitude = float(request.form.get('longitude'))
         record.location = request.form.get('location', '')
         record.notes = request.form.get('notes', '')
+        _record_changed(before, record)
         db.session.commit()
         # Log Discord (nuevo)
         log_record("update", record, user=current_user, extra={"Acción": "Admin", "Usuario destino": record.user_id})
@@ -1503,6 +2628,7 @@ def admin_add_record():
         notes=request.form.get('notes', '')
     )
     db.session.add(new_record)
+    _record_changed(None, new_record)
     db.session.commit()
     # Log Discord (nuevo)
     log_record("create", new_record, user=current_user, extra={"Acción": "Admin", "Usuario destino": new_record.user_id})
@@ -1520,6 +2646,7 @@ def admin_delete_record(record_id):
     user_id = record.user_id
     # Log Discord (nuevo) antes de borrar
     log_record("delete", record, user=current_user, extra={"Acción": "Admin", "Usuario destino": record.user_id})
+    _record_changed(record_state(record), None)
     db.session.delete(record)
     db.session.commit()
     flash('Fichaje eliminado correctamente', 'success')
@@ -1528,9 +2655,8 @@ def admin_delete_record(record_id):
 @app.route('/logout')
 @login_required
 def logout():
-    # NUEVO: Actualizar estado a "Desconectado"
-    current_user.status = "Desconectado"
-    db.session.commit()  # Guardar cambios en la base de datos
+    presence.left(current_user.id)  # sin commit: last_seen_at se borra en el siguiente lote
+    publish_presence(current_user, lookup=True)
 
     # NUEVO: Log Discord antes de logout_user
     log_event(
@@ -1570,6 +2696,18 @@ def api_schedules():
         'hours_required': s.hours_required
     } for s in schedules])
 
+@app.route('/api/projection')
+@login_required
+def api_projection():
+    p = user_projection(current_user)
+    end_date = p["estimated_end_date"]
+    return jsonify({
+        'total_hours_required': p["total_hours_required"],
+        'total_hours_worked': round(p["total_hours_worked"], 2),
+        'hours_remaining': round(p["hours_remaining"], 2),
+        'estimated_end_date': end_date.isoformat() if end_date else None
+    })
+
 @app.route('/api/active_record')
 @login_required
 def api_active_record():
@@ -1580,6 +2718,196 @@ def api_active_record():
         'entry_time': active_record.entry_time.isoformat() if active_record else None  # UTC ISO
     })
 
+@app.post('/api/presence/heartbeat')
+@login_required
+def api_presence_heartbeat():
+    """Latido de la PWA (cada PRESENCE_HEARTBEAT s con la app visible): sólo memoria."""
+    if presence.seen(current_user.id):
+        publish_presence(current_user, lookup=True)  # acaba de volver a estar en línea
+    return jsonify(ok=True, interval=PRESENCE_HEARTBEAT)
+
+# ======= Sincronización incremental de fichajes (NDJSON) =======
+#   GET /api/records/changes?since=<cursor>&limit=500[&user_id=N]
+# Sesión de usuario: sólo sus fichajes. Admin o cabecera X-TASKS-TOKEN: todos
+# (opcionalmente filtrados por user_id). Cada línea es un cambio; la última trae
+# el cursor para la siguiente llamada.
+CHANGES_PAGE_MAX = 1000
+
+def record_payload(r):
+    return {
+        "id": r.id,
+        "user_id": r.user_id,
+        "date": r.date.isoformat(),
+        "entry_time": r.entry_time.isoformat() if r.entry_time else None,  # UTC ISO
+        "exit_time": r.exit_time.isoformat() if r.exit_time else None,
+        "location": r.location,
+        "latitude": r.latitude,
+        "longitude": r.longitude,
+        "notes": r.notes,
+        "updated_at": r.updated_at.isoformat() if r.updated_at else None,
+    }
+
+@app.route('/api/records/changes')
+def api_record_changes():
+    if TASKS_TOKEN and request.headers.get('X-TASKS-TOKEN') == TASKS_TOKEN:
+        scope_user = request.args.get('user_id', type=int)
+    elif current_user.is_authenticated:
+        scope_user = request.args.get('user_id', type=int) if current_user.is_admin else current_user.id
+    else:
+        return jsonify({"error": "unauthorized"}), 401
+
+    since = max(request.args.get('since', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', 500, type=int), 1), CHANGES_PAGE_MAX)
+
+    # Normalmente el after_commit ya los numeró: sólo si queda alguno sin seq (la
+    # numeración tras algún commit falló) se toman los locks y se escribe. La
+    # comprobación es una lectura sobre el índice parcial ix_record_change_unassigned.
+    if db.session.query(RecordChange.id).filter(RecordChange.seq.is_(None)).first() is not None:
+        assign_change_seqs()
+    q = RecordChange.query.filter(RecordChange.seq > since)  # sin seq todavía: no se entrega
+    if scope_user is not None:
+        q = q.filter(RecordChange.user_id == scope_user)
+    changes = q.order_by(RecordChange.seq).limit(limit + 1).all()
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    # Varios cambios del mismo fichaje en la página: basta con el último
+    last_change = {c.record_id: c.seq for c in changes}
+    upsert_ids = [c.record_id for c in changes if c.op == 'upsert' and last_change[c.record_id] == c.seq]
+    records_by_id = {r.id: r for r in TimeRecord.query.filter(TimeRecord.id.in_(upsert_ids))} if upsert_ids else {}
+
+    lines = []
+    for c in changes:
+        if last_change[c.record_id] != c.seq:
+            continue
+        line = {"type": "change", "cursor": c.seq, "op": c.op, "record_id": c.record_id,
+                "user_id": c.user_id, "changed_at": c.changed_at.isoformat()}
+        if c.op == 'upsert':
+            r = records_by_id.get(c.record_id)
+            if r is None:
+                continue  # borrado después: su tombstone llega más adelante
+            line["record"] = record_payload(r)
+        lines.append(line)
+
+    next_cursor = changes[-1].seq if changes else since
+    lines.append({"type": "cursor", "next_cursor": next_cursor, "has_more": has_more})
+    body = "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines)
+    return Response(body, mimetype='application/x-ndjson', headers={'X-Next-Cursor': str(next_cursor)})
+
+# ======= Auditoría local =======
+# Cada evento de log_event (login, fichajes, horarios...) se guarda también en
+# audit_log. La petición sólo lo deja en memoria; audit_writer lo inserta por
+# lotes (un INSERT multi-fila por segundo como mucho) desde su propio hilo.
+AUDIT_PAGE_MAX = 200
+
+def _audit_row(event):
+    return {
+        "created_at": event["created_at"],
+        "actor_id": event["actor_id"],
+        "actor": event["actor"][:255] if event["actor"] else None,
+        "action": event["action"][:200],
+        "level": event["level"],
+        "entity_type": event["entity_type"],
+        "entity_id": event["entity_id"] if isinstance(event["entity_id"], int) else None,
+        "ip": (event["ip"] or "")[:64] or None,
+        "method": event["method"],
+        "path": (event["path"] or "")[:255] or None,
+        "details": json.dumps({"description": event["description"] or None, **event["fields"]}, ensure_ascii=False),
+    }
+
+def _write_audit_rows(events):
+    with app.app_context():
+        db.session.execute(AuditLog.__table__.insert(), [_audit_row(e) for e in events])
+        db.session.commit()
+
+def _audit_dead_letter(events, error):
+    """Eventos que la BD rechaza uno a uno: quedan en el log del proceso para no perderlos."""
+    for e in events:
+        print(f"❌ audit-writer descartado ({error!r}): {json.dumps(_audit_row(e), ensure_ascii=False, default=str)}")
+
+audit_writer = BatchWriter(_write_audit_rows, max_batch=200, interval=1.0, name='audit-writer',
+                           dead_letter=_audit_dead_letter)
+register_sink(audit_writer.add)
+atexit.register(audit_writer.flush_now)
+
+def audit_payload(a):
+    return {
+        "id": a.id,
+        "created_at": a.created_at.isoformat(),
+        "actor_id": a.actor_id,
+        "actor": a.actor,
+        "action": a.action,
+        "level": a.level,
+        "entity_type": a.entity_type,
+        "entity_id": a.entity_id,
+        "ip": a.ip,
+        "method": a.method,
+        "path": a.path,
+        "details": json.loads(a.details) if a.details else {},
+    }
+
+def audit_listing(args):
+    """Página de auditoría por clave (created_at, id), de más nuevo a más viejo.
+    Filtros: user_id (quién), entity_type/entity_id (sobre qué), date_from/date_to (locales), q (acción)."""
+    user_id = args.get('user_id', type=int)
+    entity_type = (args.get('entity_type') or '').strip() or None
+    entity_id = args.get('entity_id', type=int)
+    date_from = _parse_date_arg(args.get('date_from'))
+    date_to = _parse_date_arg(args.get('date_to'))
+    text_q = (args.get('q') or '').strip()
+    per_page = min(max(args.get('per_page', 50, type=int), 1), AUDIT_PAGE_MAX)
+
+    q = AuditLog.query
+    if user_id is not None:
+        q = q.filter(AuditLog.actor_id == user_id)
+    if entity_type:
+        q = q.filter(AuditLog.entity_type == entity_type)
+        if entity_id is not None:
+            q = q.filter(AuditLog.entity_id == entity_id)
+    if date_from:
+        q = q.filter(AuditLog.created_at >= datetime.combine(date_from, time(0, 0), tzinfo=ZONE).astimezone(timezone.utc))
+    if date_to:
+        q = q.filter(AuditLog.created_at < datetime.combine(date_to + timedelta(days=1), time(0, 0), tzinfo=ZONE).astimezone(timezone.utc))
+    if text_q:
+        q = q.filter(AuditLog.action.ilike(f"%{text_q}%"))
+
+    page = keyset_paginate(q, [AuditLog.created_at, AuditLog.id],
+                           after=args.get('after'), before=args.get('before'), per_page=per_page)
+    filters = {k: v for k, v in {
+        'user_id': user_id,
+        'entity_type': entity_type,
+        'entity_id': entity_id if entity_type else None,
+        'date_from': date_from.isoformat() if date_from else None,
+        'date_to': date_to.isoformat() if date_to else None,
+        'q': text_q or None,
+        'per_page': per_page if per_page != 50 else None,
+    }.items() if v is not None}
+    return page, filters
+
+@app.route('/admin/audit')
+@login_required
+def admin_audit():
+    if not current_user.is_admin:
+        flash('No tienes permisos de administrador', 'error')
+        return redirect(url_for('dashboard'))
+    page, filters = audit_listing(request.args)
+    users = dict(db.session.query(User.id, User.name))
+    return render_template('admin_audit.html', entries=page, filters=filters, users=users,
+                           writer_stats=audit_writer.stats())
+
+@app.route('/api/admin/audit')
+@login_required
+def api_admin_audit():
+    if not current_user.is_admin:
+        return jsonify({"error": "forbidden"}), 403
+    page, filters = audit_listing(request.args)
+    return jsonify({
+        "items": [audit_payload(a) for a in page.items],
+        "next_cursor": page.next_cursor,
+        "prev_cursor": page.prev_cursor,
+        "filters": filters,
+    })
+
 # ==========================
 # Errores
 # ==========================
@@ -1615,72 +2943,221 @@ def init_db():
         print("✅ Base de datos inicializada correctamente")
 
 
+# ==========================
+# CLI: mantenimiento del ledger
+#   flask --app app ledger-verify [--fix]
+#   flask --app app ledger-rebuild [--user-id N]
+# ==========================
+
+@app.cli.command('ledger-rebuild')
+@click.option('--user-id', type=int, multiple=True, help='Solo estos usuarios (repetible).')
+def ledger_rebuild_command(user_id):
+    """Reconstruye el ledger de horas desde los fichajes."""
+    n = rebuild_ledger(list(user_id) or None)
+    db.session.commit()
+    click.echo(f"✅ Ledger reconstruido para {n} usuario(s)")
+
+@app.cli.command('ledger-verify')
+@click.option('--fix', is_flag=True, help='Reconstruye los usuarios con discrepancias.')
+def ledger_verify_command(fix):
+    """Compara el ledger con los fichajes y muestra las discrepancias."""
+    mismatches = verify_ledger()
+    for uid, day, got, real in mismatches:
+        where = day.isoformat() if day else "TOTAL"
+        click.echo(f"❌ user={uid} {where}: ledger={got:.0f}s real={real:.0f}s")
+    if not mismatches:
+        click.echo("✅ Ledger consistente")
+        return
+    if fix:
+        n = rebuild_ledger({m[0] for m in mismatches})
+        db.session.commit()
+        click.echo(f"🔧 Reconstruido ledger de {n} usuario(s)")
+    else:
+        raise SystemExit(1)
+
+
 # ==========================
 # Jobs (notificaciones)
 # ==========================
-def _job_notify_due_clockin(now=None, force=False):
+class NotifyContext:
+    """Datos de un tick de notificaciones, cargados para todos los usuarios a la vez.
+
+    Un número fijo de consultas (ajustes + usuarios, horarios de hoy, fichajes de
+    hoy y suscripciones push) en vez de varias por usuario. Con due_only sólo se
+    cargan los usuarios cuyo next_due_at ya ha llegado; user_ids lo limita a esos
+    usuarios (planificador embebido).
+    """
+    def __init__(self, now, due_only=True, user_ids=None):
+        self.now = now
+        self.today = now.date()
+        q = (db.session.query(User, NotificationSettings)
+             .join(NotificationSettings, NotificationSettings.user_id == User.id)
+             .filter(NotificationSettings.push_enabled.is_(True)))
+        if due_only:
+            # Rango sobre el índice de next_due_at: sólo quien tiene algo pendiente ya
+            q = q.filter(NotificationSettings.next_due_at <= now.astimezone(timezone.utc))
+        if user_ids is not None:
+            q = q.filter(NotificationSettings.user_id.in_(user_ids))
+        rows = q.order_by(User.id).all()
+        self.users = rows  # [(user, settings)]
+        self.loaded_due = {st.id: st.next_due_at for _, st in rows}  # para el compare-and-set
+        ids = [u.id for u, _ in rows]
+
+        self.schedules = {}
+        self.records = {}
+        self.subs = {}
+        if not ids:
+            return
+        for sch in (Schedule.query
+                    .filter(Schedule.user_id.in_(ids),
+                            Schedule.day_of_week == self.today.weekday(),
+                            Schedule.is_active.is_(True))
+                    .order_by(Schedule.id)):
+            self.schedules.setdefault(sch.user_id, sch)
+        for r in (TimeRecord.query
+                  .filter(TimeRecord.user_id.in_(ids), TimeRecord.date == self.today)
+                  .order_by(TimeRecord.id)):
+            self.records.setdefault(r.user_id, []).append(r)
+        for sub in PushSubscription.query.filter(PushSubscription.user_id.in_(ids),
+                                                 PushSubscription.is_active.is_(True)):
+            self.subs.setdefault(sub.user_id, []).append(sub)
+
+    def open_record(self, user_id):
+        return next((r for r in self.records.get(user_id, ()) if r.exit_time is None), None)
+
+    def reschedule(self):
+        """Recalcula next_due_at de los usuarios evaluados (tras marcar los envíos).
+
+        Se guarda como compare-and-set contra el valor cargado: si otra transacción
+        lo marcó para ya mientras tanto (_mark_notifications_due por un fichaje
+        editado), esa marca se conserva y el aviso se evalúa en el siguiente tick."""
+        t = NotificationSettings.__table__
+        by_loaded, by_null = [], []
+        for u, s in self.users:
+            nxt = _next_notification_at(self.now, s, self.schedules.get(u.id),
+                                        self.records.get(u.id, []), self.open_record(u.id),
+                                        bool(self.subs.get(u.id)))
+            loaded = self.loaded_due.get(s.id)
+            if loaded is None:
+                by_null.append({"sid": s.id, "nxt": nxt})
+            else:
+                by_loaded.append({"sid": s.id, "loaded": loaded, "nxt": nxt})
+        if by_loaded:
+            db.session.execute(t.update()
+                               .where(t.c.id == db.bindparam("sid"), t.c.next_due_at == db.bindparam("loaded"))
+                               .values(next_due_at=db.bindparam("nxt")), by_loaded)
+        if by_null:
+            db.session.execute(t.update()
+                               .where(t.c.id == db.bindparam("sid"), t.c.next_due_at.is_(None))
+                               .values(next_due_at=db.bindparam("nxt")), by_null)
+
+
+def _missed_entry_due(now, s, sch, day_records, open_rec, turn):
+    """¿Toca avisar de que no se ha fichado la entrada del turno 1 o 2?"""
+    start = sch.start_time if turn == 1 else sch.start_time_2
+    planned = datetime.combine(now.date(), start, tzinfo=ZONE)
+    if now < planned + timedelta(minutes=s.minutes_after_start_no_entry) or open_rec:
+        return False
+    if turn == 1:
+        return not day_records
+    start_utc = as_utc_naive(planned)
+    return not any(as_utc_naive(r.entry_time) >= start_utc for r in day_records)
+
+
+def _open_record_due(now, s, sch, open_rec):
+    """¿Toca avisar de un fichaje abierto (abierto hace rato o ya pasó el fin de turno)?"""
+    if open_rec:
+        opened = (as_utc_naive(utcnow()) - as_utc_naive(open_rec.entry_time)).total_seconds()
+        if opened >= s.open_record_minutes * 60:
+            return True
+    if sch:
+        end_candidates = [sch.end_time] + ([sch.end_time_2] if getattr(sch, 'end_time_2', None) else [])
+        for et in end_candidates:
+            if now >= datetime.combine(now.date(), et, tzinfo=ZONE) + timedelta(minutes=s.end_passed_minutes):
+                return True
+    return False
+
+
+def _next_notification_at(now, s, sch, day_records, open_rec, has_subs):
+    """Primer instante (UTC) en que alguno de los avisos del tick podría saltar.
+
+    Mismas condiciones que _missed_entry_due/_open_record_due y las marcas last_*_sent.
+    Si hoy ya no queda nada, mañana a las 00:00 (hora local) para mirar el nuevo día.
+    """
+    today = now.date()
+    tomorrow = datetime.combine(today + timedelta(days=1), time(0, 0), tzinfo=ZONE)
+    if not has_subs:
+        return tomorrow.astimezone(timezone.utc)  # suscribirse vuelve a marcarlo
+
+    candidates = []
+    if sch:
+        grace = timedelta(minutes=s.minutes_after_start_no_entry)
+        if s.last_missed_entry_sent_1 != today and not day_records:
+            candidates.append(datetime.combine(today, sch.start_time, tzinfo=ZONE) + grace)
+        if sch.start_time_2 and sch.end_time_2 and s.last_missed_entry_sent_2 != today and not open_rec:
+            start2 = datetime.combine(today, sch.start_time_2, tzinfo=ZONE)
+            if not any(as_utc_naive(r.entry_time) >= as_utc_naive(start2) for r in day_records):
+                candidates.append(start2 + grace)
+    if s.last_open_record_sent != today:
+        if open_rec:
+            entry = as_utc_naive(open_rec.entry_time).replace(tzinfo=timezone.utc)
+            candidates.append(entry + timedelta(minutes=s.open_record_minutes))
+        if sch:
+            margin = timedelta(minutes=s.end_passed_minutes)
+            for et in [sch.end_time] + ([sch.end_time_2] if sch.end_time_2 else []):
+                candidates.append(datetime.combine(today, et, tzinfo=ZONE) + margin)
+
+    due = min(candidates) if candidates else tomorrow
+    return min(due, tomorrow).astimezone(timezone.utc)
+
+
+def _queue_pending(pending, today, force=False):
+    """Encola las notificaciones del tick (bandeja push) y marca las encoladas."""
+    items = []
+    for s, flag, (u, title, body, data, actions, subs) in pending:
+        kind = flag.replace('last_', '').replace('_sent', '')  # last_missed_entry_sent_1 -> missed_entry_1
+        dedupe_key = None if force else f"{kind}:{u.id}:{today.isoformat()}"
+        items.append((u, kind, dedupe_key, title, body, data, actions, subs))
+    queued = 0
+    for (s, flag, _), ok in zip(pending, enqueue_push_batch(items)):
+        if ok:
+            setattr(s, flag, today)  # se guarda en el mismo commit que las filas de la bandeja
+            queued += 1
+    return queued
+
+
+def _job_notify_due_clockin(now=None, force=False, user_ids=None):
     """
     Verifica si el usuario no ha fichado entrada y envía un recordatorio.
     """
-    now = now or now_local()  # Usar la hora actual o la proporcionada
-    users = User.query.all()  # Obtener todos los usuarios
-    sent = 0  # Contador de notificaciones enviadas
-
-    for u in users:
-        # Obtener las configuraciones de notificación del usuario
-        s = NotificationSettings.query.filter_by(user_id=u.id).first()
-        if not (s and s.push_enabled):  # Si las notificaciones no están habilitadas, continuar con el siguiente usuario
-            continue
+    ctx = NotifyContext(now or now_local(), due_only=not force, user_ids=user_ids)
+    now, today = ctx.now, ctx.today
 
-        # Obtener el horario del usuario para el día actual
-        sch = today_schedule_for(u, now)
-        if not sch or not sch.is_active:  # Si no tiene horario activo para hoy, continuar
+    pending = []  # (settings, flag, notificación)
+    for u, s in ctx.users:
+        sch = ctx.schedules.get(u.id)
+        if not sch:  # Si no tiene horario activo para hoy, continuar
             continue
-
-        # Verificar si el usuario ya tiene un registro de fichaje activo
-        active_rec = active_record_for_today(u)
+        day_records = ctx.records.get(u.id, [])
+        open_rec = ctx.open_record(u.id)
+        subs = ctx.subs.get(u.id, [])
 
         # -------- Turno 1 --------
-        planned_dt1 = datetime.combine(now.date(), sch.start_time, tzinfo=ZONE)  # Hora planificada de entrada para turno 1
-        should1 = False  # Variable para saber si se debe enviar la notificación de entrada
-
-        if now >= planned_dt1 + timedelta(minutes=s.minutes_after_start_no_entry):  # Si ya ha pasado el tiempo de gracia para fichar
-            # Verificar si ya hay algún fichaje para el día de hoy
-            has_any_today = TimeRecord.query.filter_by(user_id=u.id, date=now.date()).first() is not None
-            if not active_rec and not has_any_today:  # Si no tiene un fichaje activo ni uno hecho hoy
-                should1 = True  # Se debería enviar la notificación
-
-        # Si se cumple la condición para el turno 1 y no se ha enviado ya hoy
-        if (force or should1) and (force or getattr(s, 'last_missed_entry_sent_1', None) != now.date()):
-            if send_push_to_user(u, "🔔 No has fichado y ya es hora", "Recuerda fichar la ENTRADA"):
-                s.last_missed_entry_sent_1 = now.date()  # Marcar que se envió el recordatorio hoy
-                db.session.commit()  # Guardar los cambios
-                sent += 1  # Incrementar el contador de notificaciones enviadas
+        should1 = _missed_entry_due(now, s, sch, day_records, open_rec, turn=1)
+        if (force or should1) and (force or s.last_missed_entry_sent_1 != today):
+            pending.append((s, 'last_missed_entry_sent_1',
+                            (u, "🔔 No has fichado y ya es hora", "Recuerda fichar la ENTRADA", None, None, subs)))
 
         # -------- Turno 2 (opcional) --------
-        if getattr(sch, 'start_time_2', None) and getattr(sch, 'end_time_2', None):  # Verificar si hay segundo turno
-            planned_dt2 = datetime.combine(now.date(), sch.start_time_2, tzinfo=ZONE)  # Hora planificada de entrada para turno 2
-            should2 = False  # Variable para saber si se debe enviar la notificación para el segundo turno
-
-            if now >= planned_dt2 + timedelta(minutes=s.minutes_after_start_no_entry):  # Si ha pasado el tiempo de gracia
-                if not active_rec:
-                    # Verificar si hay algún registro de entrada para el segundo tramo del turno
-                    start2_utc = planned_dt2.astimezone(timezone.utc)
-                    has_entry2 = TimeRecord.query.filter(
-                        TimeRecord.user_id == u.id,
-                        TimeRecord.date == now.date(),
-                        TimeRecord.entry_time >= start2_utc
-                    ).first() is not None
-                    if not has_entry2:  # Si no hay entrada registrada para el segundo turno
-                        should2 = True
-
-            # Si se cumple la condición para el segundo turno y no se ha enviado ya hoy
-            if (force or should2) and (force or getattr(s, 'last_missed_entry_sent_2', None) != now.date()):
-                if send_push_to_user(u, "🔔 No has fichado y ya es hora", "Recuerda fichar la ENTRADA (turno de tarde)"):
-                    s.last_missed_entry_sent_2 = now.date()  # Marcar que se envió el recordatorio hoy
-                    db.session.commit()  # Guardar los cambios
-                    sent += 1  # Incrementar el contador de notificaciones enviadas
-
+        if sch.start_time_2 and sch.end_time_2:
+            should2 = _missed_entry_due(now, s, sch, day_records, open_rec, turn=2)
+            if (force or should2) and (force or s.last_missed_entry_sent_2 != today):
+                pending.append((s, 'last_missed_entry_sent_2',
+                                (u, "🔔 No has fichado y ya es hora", "Recuerda fichar la ENTRADA (turno de tarde)", None, None, subs)))
+
+    sent = _queue_pending(pending, today, force)
+    ctx.reschedule()
+    db.session.commit()  # bandeja, marcas last_*_sent y next_due_at en una transacción
     return sent  # Retornar el número de notificaciones enviadas
 def as_utc_naive(dt):
     """Devuelve dt en UTC sin tzinfo (naive).
@@ -1692,100 +3169,109 @@ def as_utc_naive(dt):
     return dt.astimezone(timezone.utc).replace(tzinfo=None)
 
 
-def _job_notify_open_record(now=None, force=False):
+def _job_notify_open_record(now=None, force=False, user_ids=None):
     """
     Verifica si el usuario tiene un fichaje abierto (sin salida registrada)
     y envía un recordatorio para que cierre el fichaje si ya pasó el tiempo.
     """
-    now = now or now_local()  # Usar la hora actual o la proporcionada
-    users = User.query.all()  # Obtener todos los usuarios
-    sent = 0  # Contador de notificaciones enviadas
-
-    for u in users:
-        # Obtener la configuración de notificaciones del usuario
-        s = NotificationSettings.query.filter_by(user_id=u.id).first()
-        if not (s and s.push_enabled):  # Si las notificaciones no están habilitadas, continuar con el siguiente usuario
-            continue
-
-        # Obtener el registro de fichaje activo para hoy
-        rec = active_record_for_today(u)
-        should = False  # Variable para saber si se debe enviar la notificación
-
-        # (1) Verificar si hay un fichaje abierto desde hace >= open_record_minutes
-        if rec:
-            now_utc_naive = datetime.utcnow()  # Obtener la hora actual en UTC sin información de zona horaria
-            entry_utc_naive = as_utc_naive(rec.entry_time)  # Obtener la entrada del fichaje en UTC sin zona horaria
-            if (now_utc_naive - entry_utc_naive).total_seconds() >= s.open_record_minutes * 60:
-                should = True  # Si ha pasado el tiempo de gracia, se debe enviar la notificación
+    ctx = NotifyContext(now or now_local(), due_only=not force, user_ids=user_ids)
+    now, today = ctx.now, ctx.today
+
+    pending = []
+    for u, s in ctx.users:
+        should = _open_record_due(now, s, ctx.schedules.get(u.id), ctx.open_record(u.id))
+        if (force or should) and (force or s.last_open_record_sent != today):
+            pending.append((s, 'last_open_record_sent',
+                            (u, "🕒 Tienes un fichaje abierto", "¿Se te ha pasado cerrar? Revísalo cuando puedas.",
+                             None, None, ctx.subs.get(u.id, []))))
+
+    sent = _queue_pending(pending, today, force)
+    ctx.reschedule()
+    db.session.commit()
+    return sent  # Retornar el número de notificaciones enviadas
 
-        # (2) Verificar si pasó el fin de turno (turno 1 o 2) y ya pasaron los minutos configurados
-        sch = today_schedule_for(u, now)
-        if sch:
-            end_candidates = [sch.end_time]  # Hora de finalización del turno 1
-            if getattr(sch, 'end_time_2', None):  # Verificar si hay un segundo turno
-                end_candidates.append(sch.end_time_2)  # Hora de finalización del turno 2
-
-            # Comprobar si la hora de fin de turno ya pasó, añadiendo el margen de minutos
-            for et in end_candidates:
-                end_dt = datetime.combine(now.date(), et, tzinfo=ZONE) + timedelta(minutes=s.end_passed_minutes)
-                if now >= end_dt:  # Si ya pasó el fin de turno y el tiempo adicional configurado
-                    should = True  # Se debe enviar la notificación
-                    break
-
-        # Si la condición se cumple (o si se forza el envío) y no se ha enviado ya hoy
-        if (force or should) and (force or s.last_open_record_sent != now.date()):
-            if send_push_to_user(u, "🕒 Tienes un fichaje abierto", "¿Se te ha pasado cerrar? Revísalo cuando puedas."):
-                s.last_open_record_sent = now.date()  # Marcar que se envió el recordatorio hoy
-                db.session.commit()  # Guardar los cambios
-                sent += 1  # Incrementar el contador de notificaciones enviadas
 
-    return sent  # Retornar el número de notificaciones enviadas
 
+def _weekly_summary_rows(today, week_start, force, user_id):
+    """(user, settings, total_s, week_s, today_s) de los usuarios con push, en una consulta.
+
+    Los totales salen del ledger: el total acumulado y, agrupando HoursLedgerDay,
+    las horas de esta semana y de hoy."""
+    week = (db.session.query(
+                HoursLedgerDay.user_id.label('user_id'),
+                db.func.sum(HoursLedgerDay.seconds).label('week_s'),
+                db.func.sum(db.case((HoursLedgerDay.date == today, HoursLedgerDay.seconds), else_=0)).label('today_s'))
+            .filter(HoursLedgerDay.date >= week_start, HoursLedgerDay.date <= today)
+            .group_by(HoursLedgerDay.user_id)
+            .subquery())
+    q = (db.session.query(User, NotificationSettings, HoursLedger.total_seconds, week.c.week_s, week.c.today_s)
+         .join(NotificationSettings, NotificationSettings.user_id == User.id)
+         .outerjoin(HoursLedger, HoursLedger.user_id == User.id)
+         .outerjoin(week, week.c.user_id == User.id)
+         .filter(NotificationSettings.push_enabled.is_(True)))
+    if user_id:
+        q = q.filter(User.id == user_id)
+    if not force:
+        q = q.filter(NotificationSettings.weekly_summary_day == today.weekday(),
+                     db.or_(NotificationSettings.last_weekly_sent.is_(None),
+                            NotificationSettings.last_weekly_sent != today))
+    return q.order_by(User.id).all()
 
 
 def _job_weekly_summary(now=None, force=False, user_id=None):
-    # Obtener la hora y fecha actuales
+    """Encola el resumen semanal de los usuarios a los que les toca.
+
+    Número fijo de consultas para todos: usuarios + ajustes + totales del ledger
+    (una consulta agrupada), horarios, días extra y suscripciones."""
     current = now or now_local()
+    today = current.date()
+    week_start = today - timedelta(days=today.weekday())
 
-    # Filtrar usuarios si se pasa un user_id, de lo contrario se obtiene a todos los usuarios
-    qs = User.query
-    if user_id:
-        qs = qs.filter_by(id=user_id)
-    users = qs.all()
+    rows = _weekly_summary_rows(today, week_start, force, user_id)
+
+    # Condición para saber si el resumen semanal debe ser enviado (el día y el
+    # "no enviado hoy" ya los filtra la consulta; aquí falta la hora)
+    rows = [row for row in rows if force or current.time() >= row[1].weekly_summary_time]
+    if not rows:
+        return 0
+    ids = [u.id for u, *_ in rows]
+
+    schedules, extras, subs = {}, {}, {}
+    for sch in Schedule.query.filter(Schedule.user_id.in_(ids), Schedule.is_active.is_(True)):
+        schedules.setdefault(sch.user_id, []).append(sch)
+    for uid, day, hours in (db.session.query(ExtraWorkDay.user_id, ExtraWorkDay.date, ExtraWorkDay.hours_planned)
+                            .filter(ExtraWorkDay.user_id.in_(ids), ExtraWorkDay.date >= week_start)):
+        extras.setdefault(uid, []).append((day, hours))
+    for sub in PushSubscription.query.filter(PushSubscription.user_id.in_(ids),
+                                             PushSubscription.is_active.is_(True)):
+        subs.setdefault(sub.user_id, []).append(sub)
+
+    items = []
+    for u, s, total_s, week_s, today_s in rows:
+        weekly_hours = weekly_schedule_hours(schedules.get(u.id, []))
+        user_extras = extras.get(u.id, [])
+        week_planned = sum(weekly_hours) + sum(h or 0.0 for d, h in user_extras if d <= week_start + timedelta(days=6))
+        p = project_hours(u.total_hours_required, (total_s or 0.0) / 3600, weekly_hours,
+                          [(d, h) for d, h in user_extras if d >= today], today, (today_s or 0.0) / 3600)
+
+        body = f"Esta semana: {(week_s or 0.0) / 3600:.1f} h de {week_planned:.1f} h previstas."
+        body += (f" Te quedan {p['hours_remaining']:.1f} h para finalizar las prácticas"
+                 f" (hechas {p['total_hours_worked']:.1f}/{p['total_hours_required']:.1f}).")
+        if p["estimated_end_date"]:
+            body += f" Fin estimado: {p['estimated_end_date'].strftime('%d/%m/%Y')}."
+        dedupe_key = None if force else f"weekly:{u.id}:{today.isoformat()}"
+        items.append((u, 'weekly', dedupe_key, "📊 Resumen semanal", body, None, None, subs.get(u.id, [])))
 
     sent = 0
-    for u in users:
-        # Obtener la configuración de notificaciones del usuario
-        s = NotificationSettings.query.filter_by(user_id=u.id).first()
-        if not (s and s.push_enabled):
-            continue  # Si las notificaciones no están habilitadas, saltar a otro usuario
-
-        # Comprobar si ya se ha enviado el resumen semanal hoy
-        already_today = (s.last_weekly_sent == current.date())
-        
-        # Condición para saber si el resumen semanal debe ser enviado
-        cond = (
-            current.weekday() == s.weekly_summary_day  # Día correcto de la semana
-            and current.time() >= s.weekly_summary_time  # Hora del día correcta
-            and not already_today  # Asegurarse de que no se haya enviado aún hoy
-        )
-
-        # Si la condición se cumple o se fuerza el envío
-        if force or cond:
-            # Obtener las horas requeridas y trabajadas
-            total_required = getattr(u, "total_hours_required", 150.0)  # Si no está configurado, se usa 150h por defecto
-            done = hours_worked_total(u)  # Total de horas trabajadas
-            remaining = max(total_required - done, 0.0)  # Horas restantes
-
-            # Enviar el resumen semanal al usuario
-            if send_push_to_user(u, "📊 Resumen semanal",
-                                 f"Te quedan {remaining:.1f} h para finalizar las prácticas (hechas {done:.1f}/{total_required:.1f})."):
-                # Actualizar la fecha de envío del resumen semanal
-                s.last_weekly_sent = current.date()
-                db.session.commit()
-                sent += 1  # Incrementar el contador de envíos exitosos
-
-    return sent  # Retornar el número total de resúmenes enviados
+    for (u, s, *_), ok in zip(rows, enqueue_push_batch(items)):
+        # Mismo commit que las filas de la bandeja. Sin suscripciones no hay nada que
+        # entregar y el resumen de hoy también queda consumido (si no, el planificador
+        # embebido lo volvería a intentar cada EMBEDDED_SCHEDULER_RETRY)
+        s.last_weekly_sent = today
+        if ok:
+            sent += 1
+    db.session.commit()
+    return sent  # Retornar el número total de resúmenes encolados
 
 
 @app.get('/me/notify-dry-run')
@@ -1822,36 +3308,19 @@ def me_notify_dry_run():
             is_active=sch.is_active
         )
 
+        day_records = TimeRecord.query.filter_by(user_id=current_user.id, date=now.date()).all()
+
         # turno 1
-        planned1 = datetime.combine(now.date(), sch.start_time, tzinfo=ZONE) + timedelta(minutes=s.minutes_after_start_no_entry)
-        has_any_today = TimeRecord.query.filter_by(user_id=current_user.id, date=now.date()).first() is not None
-        decisions["due_clockin_turn1"] = (now >= planned1 and not active and not has_any_today)
+        decisions["due_clockin_turn1"] = _missed_entry_due(now, s, sch, day_records, active, turn=1)
 
         # turno 2
         if getattr(sch, 'start_time_2', None) and getattr(sch, 'end_time_2', None):
-            planned2 = datetime.combine(now.date(), sch.start_time_2, tzinfo=ZONE) + timedelta(minutes=s.minutes_after_start_no_entry)
-            start2_utc = datetime.combine(now.date(), sch.start_time_2, tzinfo=ZONE).astimezone(timezone.utc)
-            has_entry2 = TimeRecord.query.filter(
-                TimeRecord.user_id == current_user.id,
-                TimeRecord.date == now.date(),
-                TimeRecord.entry_time >= start2_utc
-            ).first() is not None
-            decisions["due_clockin_turn2"] = (now >= planned2 and not active and not has_entry2)
+            decisions["due_clockin_turn2"] = _missed_entry_due(now, s, sch, day_records, active, turn=2)
         else:
             decisions["due_clockin_turn2"] = False
 
         # open_record_should
-        should = False
-        if active:
-            now_utc_naive = datetime.utcnow()
-            entry_utc_naive = as_utc_naive(active.entry_time)
-            if (now_utc_naive - entry_utc_naive).total_seconds() >= s.open_record_minutes * 60:
-                should = True
-        for et in [sch.end_time] + ([sch.end_time_2] if getattr(sch, 'end_time_2', None) else []):
-            end_dt = datetime.combine(now.date(), et, tzinfo=ZONE) + timedelta(minutes=s.end_passed_minutes)
-            if now >= end_dt:
-                should = True
-                break
+        should = _open_record_due(now, s, sch, active)
         decisions["open_record_should"] = should
 
     # weekly_should
@@ -1889,7 +3358,9 @@ def notifications():
         settings.end_passed_minutes = int(request.form.get('end_passed_minutes', 5))
         settings.weekly_summary_day = int(request.form.get('weekly_summary_day', 6))
         settings.weekly_summary_time = datetime.strptime(request.form.get('weekly_summary_time', '18:00'), '%H:%M').time()
+        settings.next_due_at = utcnow()  # márgenes nuevos: el próximo tick lo recalcula
         db.session.commit()
+        embedded_scheduler_poke([current_user.id], weekly=True)
 
         # Log Discord (nuevo)
         log_event("🔔 Ajustes de notificaciones", level="info", user=current_user, fields={
@@ -2043,7 +3514,9 @@ def me_reset_notify_flags():
     s.last_open_record_sent = None
     s.last_missed_entry_sent_1 = None
     s.last_missed_entry_sent_2 = None
+    s.next_due_at = utcnow()
     db.session.commit()
+    embedded_scheduler_poke([current_user.id], weekly=True)
     return jsonify(ok=True)
 
 
@@ -2068,6 +3541,122 @@ def me_notify_debug():
     )
 
 
+# ==========================
+# Planificador embebido (opcional)
+# ==========================
+# Con EMBEDDED_SCHEDULER=1 un hilo del propio worker dispara los avisos de cada
+# usuario a su hora (montículo de next_due_at + resumen semanal) en vez de esperar
+# al cron externo; /tasks/run-tick y /tasks/run-weekly siguen funcionando igual.
+# Sólo un proceso planifica (flock sobre instance/scheduler.lock) y el hilo se
+# arranca en la primera petición, ya dentro del worker (gunicorn --preload importa
+# la app en el master antes del fork y los hilos no sobreviven al fork).
+EMBEDDED_SCHEDULER = os.environ.get('EMBEDDED_SCHEDULER', '0').lower() in ('1', 'true', 'yes')
+EMBEDDED_SCHEDULER_RESYNC = int(os.environ.get('EMBEDDED_SCHEDULER_RESYNC', 900))  # s; recoge cambios de otros procesos
+# Cada resync sólo carga los eventos de los próximos HORIZON segundos (rango sobre el
+# índice de next_due_at); lo que queda más lejos entra en un resync posterior. Los
+# cambios de este proceso llegan al momento con embedded_scheduler_poke.
+EMBEDDED_SCHEDULER_HORIZON = max(int(os.environ.get('EMBEDDED_SCHEDULER_HORIZON', 2 * EMBEDDED_SCHEDULER_RESYNC)),
+                                 EMBEDDED_SCHEDULER_RESYNC + 60)
+EMBEDDED_SCHEDULER_RETRY = 300  # s; si un aviso sigue pendiente tras dispararlo (nada que encolar)
+
+
+def _epoch(dt):
+    """Instante epoch de un datetime de la BD (naive = UTC, ver as_utc_naive)."""
+    return as_utc_naive(dt).replace(tzinfo=timezone.utc).timestamp() if dt else None
+
+
+def _next_weekly_at(now, s):
+    """Próximo instante en que _job_weekly_summary enviaría el resumen a este usuario."""
+    today = now.date()
+    days = (s.weekly_summary_day - today.weekday()) % 7
+    if days == 0 and s.last_weekly_sent == today:
+        days = 7
+    at = datetime.combine(today + timedelta(days=days), s.weekly_summary_time, tzinfo=ZONE)
+    return max(at, now)
+
+
+def _scheduler_events():
+    """Eventos hasta now + EMBEDDED_SCHEDULER_HORIZON (no todos los usuarios en cada resync)."""
+    with app.app_context():
+        now = now_local()
+        until = now + timedelta(seconds=EMBEDDED_SCHEDULER_HORIZON)
+        enabled = NotificationSettings.push_enabled.is_(True)
+        for uid, due in (db.session.query(NotificationSettings.user_id, NotificationSettings.next_due_at)
+                         .filter(enabled,
+                                 db.or_(NotificationSettings.next_due_at.is_(None),
+                                        NotificationSettings.next_due_at <= until.astimezone(timezone.utc)))):
+            yield ('tick', uid), _epoch(due) or now.timestamp()
+        # Resumen semanal: sólo los días de la semana que caen dentro del horizonte
+        days = {(now.date() + timedelta(days=i)).weekday() for i in range((until.date() - now.date()).days + 1)}
+        for s in NotificationSettings.query.filter(enabled, NotificationSettings.weekly_summary_day.in_(days),
+                                                   NotificationSettings.weekly_summary_time.isnot(None)):
+            at = _next_weekly_at(now, s)
+            if at <= until:
+                yield ('weekly', s.user_id), at.timestamp()
+
+
+def _scheduler_fire(key):
+    """Ejecuta los avisos de un usuario y devuelve su próximo evento (epoch) o None."""
+    kind, uid = key
+    with app.app_context():
+        now = now_local()
+        if kind == 'tick':
+            _job_notify_due_clockin(now, user_ids=[uid])
+            _job_notify_open_record(now, user_ids=[uid])
+        else:
+            _job_weekly_summary(now, user_id=uid)
+        s = NotificationSettings.query.filter_by(user_id=uid).first()
+        if not (s and s.push_enabled):
+            return None  # al reactivarlas, el guardado de ajustes lo vuelve a programar
+        nxt = _epoch(s.next_due_at) if kind == 'tick' else _next_weekly_at(now, s).timestamp()
+        if nxt is None or nxt <= now.timestamp():
+            return now.timestamp() + EMBEDDED_SCHEDULER_RETRY  # sigue pendiente (nada encolado): más tarde
+        return nxt
+
+
+embedded_scheduler = None
+if EMBEDDED_SCHEDULER:
+    embedded_scheduler = EmbeddedScheduler(
+        _scheduler_fire, _scheduler_events,
+        lock_path=os.path.join(app.instance_path, 'scheduler.lock'),
+        resync_seconds=EMBEDDED_SCHEDULER_RESYNC)
+
+
+def embedded_scheduler_poke(user_ids, weekly=False):
+    """Reevalúa ya a estos usuarios (sólo si este proceso es el que planifica)."""
+    if embedded_scheduler is None:
+        return
+    keys = [('tick', uid) for uid in user_ids]
+    if weekly:
+        keys += [('weekly', uid) for uid in user_ids]
+    embedded_scheduler.poke(keys)
+
+
+@app.before_request
+def _start_background_threads():
+    # Hilos del propio worker (no del master de gunicorn --preload)
+    if not push_outbox_worker.running:
+        push_outbox_worker.start()
+    if embedded_scheduler is not None and not embedded_scheduler.running:
+        embedded_scheduler.start()
+
+
+@app.get('/tasks/push-outbox')
+def tasks_push_outbox():
+    _check_cron_token()
+    if request.args.get('drain') == '1':
+        deliver_push_outbox()  # entrega ya un lote (sin esperar al hilo)
+    return jsonify(push_outbox_stats())
+
+
+@app.get('/tasks/scheduler')
+def tasks_scheduler_status():
+    _check_cron_token()
+    if embedded_scheduler is None:
+        return jsonify(enabled=False)
+    return jsonify(enabled=True, pid=os.getpid(), **embedded_scheduler.stats())
+
+
 # ==========================
 # Main / Render
 # ==========================
@@ -0,0 +1,45 @@
+# scripts/bench_pdf_report.py
+# Mide tiempo y pico de memoria (tracemalloc) al maquetar el PDF de fichajes.
+#   python scripts/bench_pdf_report.py [filas ...]
+import os, sys, tempfile, time, tracemalloc
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.pdf_report import render_pdf_report
+
+LOGO = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'icon-144x144.png')
+
+
+def fake_rows(n):
+    start = date(2024, 1, 1)
+    rows = []
+    for i in range(n):
+        d = start + timedelta(days=i // 3)
+        loc = 'Oficina central' if i % 4 else 'Calle de Alcalá 123, 28009 Madrid, España'
+        rows.append((d.strftime('%d/%m/%Y'), '09:00', '14:00', '5h 0m', loc, '40.41678, -3.70379'))
+    return rows
+
+
+def run(n, large):
+    rows = fake_rows(n)
+    meta = dict(user_name='Bench', user_email='bench@example.com',
+                start_date=date(2024, 1, 1), end_date=date(2024, 1, 1) + timedelta(days=n // 3),
+                summary_rows=[('Sesiones cerradas', n), ('Sesiones abiertas', 0)],
+                logo_path=LOGO)
+    with tempfile.TemporaryFile() as out:
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        render_pdf_report(out, rows, large=large, **meta)
+        elapsed = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        size = out.tell()
+    return elapsed, peak, size
+
+
+sizes = [int(a) for a in sys.argv[1:]] or [100, 10000]
+print(f"{'filas':>7} {'modo':>8} {'tiempo':>9} {'pico mem':>10} {'PDF':>9}")
+for n in sizes:
+    for large in (False, True):
+        elapsed, peak, size = run(n, large)
+        print(f"{n:>7} {'grande' if large else 'normal':>8} {elapsed:>8.2f}s {peak / 1e6:>8.1f}MB {size / 1e3:>7.0f}KB")
@@ -0,0 +1,83 @@
+# scripts/bench_vapid.py
+# CPU por push: firmando el JWT VAPID en cada envío (como antes) vs. cabecera cacheada.
+# No hace red: la petición HTTP se sustituye por una sesión falsa que responde 201.
+#   python scripts/bench_vapid.py [envíos]
+import base64, os, sys, time
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from py_vapid import Vapid
+from pywebpush import webpush
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.push_sender import VapidSigner
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+
+class FakeResponse:
+    status_code = 201
+    reason = 'Created'
+    text = ''
+
+
+class FakeSession:
+    def post(self, *args, **kwargs):
+        return FakeResponse()
+
+
+def b64(raw):
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+v = Vapid()
+v.generate_keys()
+private_key = b64(v.private_key.private_numbers().private_value.to_bytes(32, 'big'))
+
+client = ec.generate_private_key(ec.SECP256R1())
+sub = {
+    "endpoint": "https://fcm.googleapis.com/fcm/send/bench",
+    "keys": {
+        "p256dh": b64(client.public_key().public_bytes(serialization.Encoding.X962,
+                                                       serialization.PublicFormat.UncompressedPoint)),
+        "auth": b64(os.urandom(16)),
+    },
+}
+data = '{"title": "🔔 No has fichado y ya es hora", "body": "Recuerda fichar la ENTRADA"}'
+session = FakeSession()
+
+
+def per_push(fn):
+    fn()  # calentamiento
+    t0 = time.process_time()
+    for _ in range(N):
+        fn()
+    return (time.process_time() - t0) / N * 1000
+
+
+def sign_each_time():
+    webpush(sub, data=data, vapid_private_key=private_key, vapid_claims={"sub": "mailto:bench@example.com"},
+            ttl=1800, requests_session=session)
+
+
+signer = VapidSigner(private_key, "mailto:bench@example.com")
+
+
+def cached_header():
+    webpush(sub, data=data, ttl=1800, headers=dict(signer.headers_for(sub["endpoint"])),
+            requests_session=session)
+
+
+def header_only_before():
+    Vapid.from_string(private_key=private_key).sign({"sub": "mailto:bench@example.com",
+                                                     "aud": "https://fcm.googleapis.com",
+                                                     "exp": int(time.time()) + 43200})
+
+
+def header_only_after():
+    signer.headers_for(sub["endpoint"])
+
+
+print(f"{N} envíos, CPU por push (ms)")
+print(f"  cabecera VAPID   antes {per_push(header_only_before):7.3f}   después {per_push(header_only_after):7.3f}")
+print(f"  push completo    antes {per_push(sign_each_time):7.3f}   después {per_push(cached_header):7.3f}")
+print(f"  firmas: {signer.stats()}")
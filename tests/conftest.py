@@ -0,0 +1,111 @@
+# tests/conftest.py
+"""App sobre una SQLite temporal y utilidades para contar consultas."""
+import os
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import time, timedelta
+
+import pytest
+
+_TMP = tempfile.mkdtemp(prefix="fichador-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_TMP, 'test.db')}"
+os.environ.setdefault("DISCORD_SPOOL_DIR", os.path.join(_TMP, "discord_spool"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as fichador  # noqa: E402  (DATABASE_URL tiene que estar puesto antes)
+
+
+@pytest.fixture(scope="session")
+def app_module():
+    return fichador
+
+
+@pytest.fixture
+def admin_client(app_module):
+    A = app_module
+    with A.app.app_context():
+        admin = A.User.query.filter_by(is_admin=True).first()
+        uid = admin.id
+    client = A.app.test_client()
+    with client.session_transaction() as sess:
+        sess["_user_id"] = str(uid)
+        sess["_fresh"] = True
+    return client
+
+
+@pytest.fixture
+def make_users(app_module):
+    """Crea n usuarios con push, horario de hoy (dos turnos ya pasados) y, la mitad,
+    un fichaje abierto: lo necesario para que el panel y los avisos los recorran."""
+    A = app_module
+    created = []
+
+    def make(n):
+        with A.app.app_context():
+            now = A.now_local()
+            for _ in range(n):
+                i = len(created)
+                u = A.User(email=f"qc{i}@example.com", name=f"Usuario {i}", password="x", is_first_login=False)
+                A.db.session.add(u)
+                A.db.session.flush()
+                created.append(u.id)
+                A.db.session.add(A.NotificationSettings(user_id=u.id, push_enabled=True))
+                A.db.session.add(A.PushSubscription(user_id=u.id, endpoint=f"https://push.example/{u.id}",
+                                                    p256dh="k", auth="a"))
+                A.db.session.add(A.Schedule(user_id=u.id, day_of_week=now.weekday(),
+                                            start_time=time(0, 0), end_time=time(0, 1),
+                                            start_time_2=time(0, 2), end_time_2=time(0, 3),
+                                            hours_required=1, is_active=True))
+                if i % 2:
+                    A.db.session.add(A.TimeRecord(user_id=u.id, date=now.date(),
+                                                  entry_time=A.utcnow() - timedelta(hours=1)))
+            A.db.session.commit()
+        return len(created)
+
+    yield make
+    with A.app.app_context():
+        for table in reversed(A.db.metadata.sorted_tables):
+            if "user_id" in table.c:
+                A.db.session.execute(table.delete().where(table.c.user_id.in_(created)))
+        A.User.query.filter(A.User.id.in_(created)).delete(synchronize_session=False)
+        A.db.session.commit()
+
+
+@pytest.fixture
+def count_queries(app_module):
+    """Cuenta las sentencias SQL del hilo del test (los hilos de fondo no cuentan).
+    Uso: with count_queries() as q: ...; q.total, q.selects"""
+    A = app_module
+
+    class Counter:
+        def __init__(self):
+            self.statements = []
+
+        @property
+        def total(self):
+            return len(self.statements)
+
+        @property
+        def selects(self):
+            return sum(1 for s in self.statements if s.lstrip().upper().startswith("SELECT"))
+
+    @contextmanager
+    def counting():
+        counter = Counter()
+        me = threading.get_ident()
+
+        def listener(conn, cursor, statement, *args):
+            if threading.get_ident() == me:
+                counter.statements.append(statement)
+
+        with A.app.app_context():
+            engine = A.db.engine
+        A.db.event.listen(engine, "before_cursor_execute", listener)
+        try:
+            yield counter
+        finally:
+            A.db.event.remove(engine, "before_cursor_execute", listener)
+
+    return counting
@@ -0,0 +1,35 @@
+# tests/test_query_counts.py
+"""Regresión N+1: el número de consultas no debe crecer con el número de usuarios."""
+
+
+def _admin_queries(client, count_queries):
+    client.get("/admin")  # calienta cachés (identidad, etc.)
+    with count_queries() as q:
+        r = client.get("/admin")
+    assert r.status_code == 200
+    return q.total
+
+
+def test_admin_panel_query_count_is_constant(admin_client, make_users, count_queries):
+    make_users(3)
+    small = _admin_queries(admin_client, count_queries)
+    make_users(30)
+    large = _admin_queries(admin_client, count_queries)
+    assert large == small
+
+
+def _tick_selects(A, count_queries):
+    with count_queries() as q:
+        with A.app.app_context():
+            A._job_notify_due_clockin(force=True)
+            A._job_notify_open_record(force=True)
+    return q.selects
+
+
+def test_notification_tick_select_count_is_constant(app_module, make_users, count_queries):
+    A = app_module
+    make_users(3)
+    small = _tick_selects(A, count_queries)
+    make_users(30)
+    large = _tick_selects(A, count_queries)
+    assert large == small
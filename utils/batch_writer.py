@@ -0,0 +1,154 @@
+# utils/batch_writer.py
+"""Escritura diferida por lotes.
+
+`add()` sólo guarda el elemento en memoria (lo llama la petición); un hilo llama
+a `flush(items)` con todo lo acumulado cada `interval` segundos, o antes si se
+llega a `max_batch`. Si `flush` falla el lote se reintenta delante de lo nuevo,
+esperando cada vez más; tras `max_attempts` fallos seguidos se escribe fila a fila
+y sólo las filas que fallan solas van a `dead_letter(items, error)` (por defecto
+se cuentan y se imprimen). Si fallan todas, es la BD la que está caída: se
+conservan y se sigue reintentando. Con más de `max_pending` elementos esperando
+se descartan los más antiguos (y se cuentan). Al apagar, `flush_now()` escribe
+lo que quede.
+"""
+import os
+import threading
+import time
+
+MAX_BACKOFF = 60  # s entre reintentos como mucho
+
+
+class BatchWriter:
+    def __init__(self, flush, max_batch=200, interval=1.0, max_pending=10000, name="batch-writer",
+                 max_attempts=5, dead_letter=None):
+        self.flush = flush
+        self.max_batch = max_batch
+        self.interval = interval
+        self.max_pending = max_pending
+        self.name = name
+        self.max_attempts = max_attempts
+        self.dead_letter = dead_letter
+        self._items = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # un solo flush a la vez (hilo o apagado)
+        self._wake = threading.Event()
+        self._pid = None
+        self._attempts = 0  # fallos seguidos del lote de cabeza
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.dead = 0
+        self.errors = 0
+        self.last_error = None
+
+    def _ensure_thread(self):
+        # Tras un fork (gunicorn --preload) el hilo del padre no existe
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._items = []
+            self._attempts = 0
+            threading.Thread(target=self._run, name=self.name, daemon=True).start()
+            self._pid = os.getpid()
+
+    def add(self, item):
+        self._ensure_thread()
+        with self._lock:
+            self._items.append(item)
+            over = len(self._items) - self.max_pending
+            if over > 0:
+                del self._items[:over]
+                self.dropped += over
+            full = len(self._items) >= self.max_batch
+        if full:
+            self._wake.set()
+
+    def _take(self):
+        with self._lock:
+            items, self._items = self._items, []
+        return items
+
+    def _write_chunk(self, chunk):
+        self.flush(chunk)
+        self.written += len(chunk)
+        self.batches += 1
+
+    def _isolate(self, chunk, error):
+        """Fila a fila: devuelve las que hay que reintentar (todas si ninguna entra)."""
+        bad = []
+        for item in chunk:
+            try:
+                self._write_chunk([item])
+            except Exception as e:
+                bad.append(item)
+                error = e
+        if len(bad) == len(chunk) > 1:
+            return chunk  # no entra ninguna: BD caída, no filas malas
+        if bad:
+            self.dead += len(bad)
+            if self.dead_letter is not None:
+                try:
+                    self.dead_letter(bad, error)
+                except Exception as e:
+                    print(f"❌ {self.name} dead_letter: {e!r}")
+            else:
+                print(f"❌ {self.name}: {len(bad)} elementos descartados ({error!r})")
+        return []
+
+    def _write(self, items):
+        done = 0
+        try:
+            while done < len(items):
+                chunk = items[done:done + self.max_batch]
+                self._write_chunk(chunk)
+                done += len(chunk)
+                self._attempts = 0
+        except Exception as e:
+            self.errors += 1
+            self.last_error = repr(e)
+            print(f"❌ {self.name}: {e!r}")
+            rest = items[done:]
+            self._attempts += 1
+            if self._attempts >= self.max_attempts:
+                chunk = rest[:self.max_batch]
+                retry = self._isolate(chunk, e)
+                if not retry:
+                    self._attempts = 0
+                rest = retry + rest[len(chunk):]
+            with self._lock:  # se reintenta lo que faltaba, delante de lo nuevo
+                self._items[:0] = rest
+            return not rest
+        return True
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            items = self._take()
+            if items:
+                with self._flush_lock:
+                    if not self._write(items):
+                        time.sleep(min(self.interval * 2 ** self._attempts, MAX_BACKOFF))
+
+    def flush_now(self):
+        """Escribe ya lo pendiente (p. ej. al apagar el proceso)."""
+        if self._pid != os.getpid():
+            return True
+        with self._flush_lock:
+            items = self._take()
+            return self._write(items) if items else True
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._items)
+        return {
+            "pending": pending,
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "dead": self.dead,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
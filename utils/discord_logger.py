@@ -1,10 +1,12 @@
 # utils/discord_logger.py
-import os, time, threading, json
+import os, time, threading, json, queue, atexit
 from datetime import datetime, timezone
 import requests
 from flask import request, has_request_context
 from flask_login import current_user
 
+from utils.disk_spool import DiskSpool
+
 WEBHOOK_URL = os.getenv("DISCORD_WEBHOOK_URL")
 
 PALETTE = {
@@ -15,24 +17,343 @@ PALETTE = {
     "neutral":  0x95A5A6,
 }
 
-def _send_async(payload: dict):
-    if not WEBHOOK_URL:
-        print("[discord-logger] Falta DISCORD_WEBHOOK_URL; omito")
-        return
-    def _go():
+# ---- Envío: spool en disco y un único hilo con sesión persistente ----
+# Cada evento se escribe primero en un spool local (append-only, por segmentos,
+# ver utils/disk_spool.py) y un hilo lo reenvía al webhook agrupando hasta 10
+# embeds por mensaje (límite de Discord), respetando el rate limit con un token
+# bucket alimentado por las cabeceras X-RateLimit-*. Si Discord está caído o la
+# URL falta o es incorrecta, los eventos esperan en disco y se reenvían cuando
+# vuelva (también tras reiniciar el worker). Sin spool (disco no escribible) se
+# usa una cola en memoria acotada; también para los eventos cuya escritura en el
+# spool falla (disco lleno, permisos), que se envían aparte sin esperar al disco.
+SPOOL_DIR = os.getenv("DISCORD_SPOOL_DIR") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "instance", "discord_spool")
+SPOOL_MAX_MB = float(os.getenv("DISCORD_SPOOL_MB", 50))
+SEGMENT_BYTES = 1024 * 1024
+QUEUE_MAX = int(os.getenv("DISCORD_QUEUE_MAX", 1000))
+EMBEDS_PER_MESSAGE = 10
+CHARS_PER_MESSAGE = 6000  # Discord: suma de textos de todos los embeds de un mensaje
+BATCH_WAIT = 0.5       # s que se esperan más eventos para llenar el mensaje
+SYNC_INTERVAL = 0.5    # s entre fsync del spool (por lotes)
+MAX_RETRIES = 3
+RETRY_MAX_WAIT = 300   # s; tope del backoff mientras el webhook falla
+FLUSH_TIMEOUT = 5.0    # s como máximo al apagar
+
+
+class _TokenBucket:
+    """Por defecto 5 peticiones cada 2 s (webhooks); las cabeceras lo corrigen."""
+
+    def __init__(self, capacity=5, per_seconds=2.0):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def update(self, headers):
+        try:
+            remaining = headers.get("X-RateLimit-Remaining")
+            reset_after = headers.get("X-RateLimit-Reset-After")
+            if remaining is not None:
+                self.tokens = min(self.tokens, float(remaining))
+                if float(remaining) <= 0 and reset_after is not None:
+                    self.block(float(reset_after))
+        except ValueError:
+            pass
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class WebhookUnavailable(Exception):
+    """El webhook no acepta mensajes ahora (red, 5xx, 429 persistente, URL mal puesta)."""
+
+
+class DiscordShipper:
+    def __init__(self, url, spool_dir=SPOOL_DIR, maxsize=QUEUE_MAX):
+        self.url = url
+        self.spool_dir = spool_dir
+        self.maxsize = maxsize
+        self.spool = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+        self.enqueued = 0
+        self.dropped = 0
+        self.spool_fallbacks = 0
+        self.messages = 0
+        self.embeds = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self.outages = 0
+        self.last_error = None
+
+    def _ensure_thread(self):
+        # Tras un fork (gunicorn --preload) el hilo y los flock del padre no valen: se recrea todo
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            try:
+                self.spool = DiskSpool(self.spool_dir, SEGMENT_BYTES, SPOOL_MAX_MB * 1024 * 1024)
+            except OSError as e:
+                print(f"[discord-logger] Spool no disponible ({e}); uso cola en memoria")
+                self.spool = None
+            self._queue = queue.Queue(self.maxsize)
+            self._session = requests.Session()
+            self._bucket = _TokenBucket()
+            self._wake = threading.Event()
+            threading.Thread(target=self._run, name="discord-logger", daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(self, payload: dict):
+        self._ensure_thread()
+        try:
+            if self.spool is not None:
+                try:
+                    self.spool.append(payload)
+                except OSError as e:
+                    # Antes que perderlo, a la cola en memoria (el hilo vacía ambas)
+                    with self._lock:
+                        self.spool_fallbacks += 1
+                    self.last_error = repr(e)
+                    self._queue.put_nowait(payload)
+            else:
+                self._queue.put_nowait(payload)
+        except queue.Full as e:  # se pierde el evento, no la petición
+            with self._lock:
+                self.dropped += 1
+            print(f"[discord-logger] Evento descartado: {e!r}")
+            return
+        with self._lock:
+            self.enqueued += 1
+        self._wake.set()
+
+    # ---- hilo de envío ----
+    def _sleep(self, seconds):
+        """Espera en el hilo de envío sin retrasar el fsync del spool."""
+        deadline = time.monotonic() + seconds
+        while True:
+            if self.spool is not None:
+                self.spool.sync()
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return
+            time.sleep(min(left, SYNC_INTERVAL))
+
+    def _pack(self, items):
+        """Cuántos de `items` (payloads en orden) caben en un mensaje y el mensaje."""
+        first = items[0]
+        n = 1
+        if first.get("content") is None:
+            key = (first.get("username"), first.get("avatar_url"))
+            count = len(first["embeds"])
+            chars = sum(_embed_chars(e) for e in first["embeds"])
+            for p in items[1:]:
+                size = sum(_embed_chars(e) for e in p["embeds"])
+                # Sólo se agrupan eventos sin texto y del mismo remitente
+                if (p.get("content") is not None or (p.get("username"), p.get("avatar_url")) != key
+                        or count + len(p["embeds"]) > EMBEDS_PER_MESSAGE
+                        or chars + size > CHARS_PER_MESSAGE):
+                    break
+                count += len(p["embeds"])
+                chars += size
+                n += 1
+        return n, dict(first, embeds=[e for p in items[:n] for e in p["embeds"]])
+
+    def _run(self):
+        backoff = 1.0
+        while True:
+            try:
+                if self.spool is None:
+                    sent = self._drain_queue()
+                else:
+                    sent = self._drain_spool()
+                    if not self._queue.empty():  # eventos que no se pudieron escribir en disco
+                        sent += self._drain_queue()
+                backoff = 1.0
+                if not sent:
+                    self._wake.wait(SYNC_INTERVAL)
+                    self._wake.clear()
+            except WebhookUnavailable as e:
+                # Los eventos siguen en el spool: se reintenta con backoff creciente
+                self.outages += 1
+                self.last_error = str(e)
+                print(f"[discord-logger] Webhook no disponible, reintento en {backoff:.0f}s: {e}")
+                self._sleep(backoff)
+                backoff = min(backoff * 2, RETRY_MAX_WAIT)
+            except Exception as e:
+                self.last_error = repr(e)
+                print(f"[discord-logger] Error en el hilo de envío: {e!r}")
+                self._sleep(1)
+
+    def _drain_spool(self):
+        self.spool.sync()  # fsync por lotes, fuera de las peticiones
+        if not self.url or not self.spool.try_lead():
+            return 0  # sin URL (o lee otro proceso): los eventos esperan en disco
+        items = self.spool.read(EMBEDS_PER_MESSAGE)
+        if items and len(items) < EMBEDS_PER_MESSAGE:
+            self._sleep(BATCH_WAIT)  # deja que lleguen más para llenar el mensaje
+            items = self.spool.read(EMBEDS_PER_MESSAGE)
+        if not items:
+            return 0
+        n, message = self._pack([payload for _, payload in items])
+        # Posición a confirmar tras cada embed (sólo el último de cada evento): si el
+        # lote se reenvía uno a uno y el webhook cae a medias, no se repiten los enviados
+        marks = [pos if i == len(payload["embeds"]) - 1 else None
+                 for pos, payload in items[:n] for i in range(len(payload["embeds"]))]
+        self._deliver(message, done=lambda i: marks[i] and self.spool.commit(marks[i]))
+        self.spool.commit(items[n - 1][0])
+        return n
+
+    def _drain_queue(self):
+        if not self.url:
+            return 0
         try:
-            r = requests.post(WEBHOOK_URL, json=payload, timeout=6)
+            items = [self._queue.get(timeout=SYNC_INTERVAL)]
+        except queue.Empty:
+            return 0
+        deadline = time.monotonic() + BATCH_WAIT
+        while len(items) < EMBEDS_PER_MESSAGE:
+            try:
+                items.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        while items:
+            n, message = self._pack(items)
+            try:
+                self._deliver(message)
+            except WebhookUnavailable:
+                self.failed += len(message["embeds"])  # sin spool no hay dónde guardarlos
+            finally:
+                for _ in items[:n]:
+                    self._queue.task_done()
+            items = items[n:]
+        return 1
+
+    def _deliver(self, message, done=None):
+        """Envía el mensaje. Un 4xx (salvo 429) descarta el mensaje: reintentarlo no lo arreglaría,
+        excepto 401/403/404, que indican una URL mal configurada y esperan en el spool.
+        Si Discord rechaza un mensaje con varios embeds se reenvían de uno en uno, para
+        descartar sólo los que de verdad son inválidos; tras cada uno se llama a done(i)."""
+        for attempt in range(MAX_RETRIES + 1):
+            wait = self._bucket.wait_time()
+            while wait > 0:
+                self._sleep(wait)
+                wait = self._bucket.wait_time()
+            self._bucket.take()
+            try:
+                r = self._session.post(self.url, json=message, timeout=6)
+            except requests.RequestException as e:
+                raise WebhookUnavailable(f"{e.__class__.__name__}: {e}")
+            self._bucket.update(r.headers)
             if r.status_code == 429:
+                self.rate_limited += 1
                 retry = 1.0
                 try: retry = float(r.json().get("retry_after", 1.0))
                 except Exception: pass
-                time.sleep(retry)
-                requests.post(WEBHOOK_URL, json=payload, timeout=6)
-            else:
-                r.raise_for_status()
+                self._bucket.block(retry)
+                continue
+            if r.status_code >= 500 and attempt < MAX_RETRIES:
+                self._bucket.block(2 ** attempt)
+                continue
+            if r.status_code >= 500 or r.status_code in (401, 403, 404):
+                raise WebhookUnavailable(f"HTTP {r.status_code}")
+            if r.status_code >= 400 and len(message["embeds"]) > 1:
+                print(f"[discord-logger] Lote rechazado (HTTP {r.status_code}), reenvío uno a uno")
+                for i, embed in enumerate(message["embeds"]):
+                    self._deliver(dict(message, embeds=[embed]))
+                    if done is not None:
+                        done(i)
+                return
+            if r.status_code >= 400:
+                self.failed += len(message["embeds"])
+                print(f"[discord-logger] Mensaje rechazado (HTTP {r.status_code}): {r.text[:200]}")
+                return
+            self.messages += 1
+            self.embeds += len(message["embeds"])
+            return
+        raise WebhookUnavailable("rate limit persistente (429)")
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Al apagar: fsync del spool y espera a vaciar la cola en memoria. True si no queda nada."""
+        if self._pid != os.getpid():
+            return True
+        if self.spool is not None:
+            self.spool.sync()  # lo pendiente en disco se reenvía al arrancar de nuevo
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stats(self):
+        mine = self._pid == os.getpid()
+        spool = self.spool.stats() if mine and self.spool is not None else None
+        return {
+            "queued": (spool["pending_bytes"] if spool else self._queue.qsize()) if mine else 0,
+            "spool": spool,
+            "max_queue": self.maxsize,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "spool_fallbacks": self.spool_fallbacks,
+            "messages": self.messages,
+            "embeds": self.embeds,
+            "failed": self.failed,
+            "rate_limited": self.rate_limited,
+            "outages": self.outages,
+            "last_error": self.last_error,
+        }
+
+
+# Aunque falte DISCORD_WEBHOOK_URL los eventos se guardan: se envían al configurarla
+_shipper = DiscordShipper(WEBHOOK_URL)
+atexit.register(_shipper.flush)
+
+def _embed_chars(embed):
+    """Caracteres que Discord cuenta para el tope por mensaje."""
+    n = len(embed.get("title") or "") + len(embed.get("description") or "")
+    n += len((embed.get("footer") or {}).get("text") or "") + len((embed.get("author") or {}).get("name") or "")
+    for f in embed.get("fields") or ():
+        n += len(f.get("name") or "") + len(f.get("value") or "")
+    return n
+
+def shipper_stats():
+    return _shipper.stats()
+
+def _send_async(payload: dict):
+    if not WEBHOOK_URL:
+        print("[discord-logger] Falta DISCORD_WEBHOOK_URL; queda en el spool")
+    _shipper.submit(payload)
+
+# ---- Otros destinos (p. ej. la tabla de auditoría local) ----
+# Cada sink recibe el evento ya estructurado (dict) en el hilo de la petición:
+# debe ser rápido (encolar, no escribir en BD directamente).
+_sinks = []
+
+def register_sink(fn):
+    _sinks.append(fn)
+    return fn
+
+def _emit(event: dict):
+    for sink in _sinks:
+        try:
+            sink(event)
         except Exception as e:
-            print(f"[discord-logger] Error webhook: {e}")
-    threading.Thread(target=_go, daemon=True).start()
+            print(f"[discord-logger] Error en sink {getattr(sink, '__name__', sink)}: {e!r}")
 
 def _actor_name(u):
     try:
@@ -43,7 +364,8 @@ def _actor_name(u):
 def log_event(title: str, description: str = "", *, level="info",
               fields: dict | None = None, user=None, content: str | None = None,
               username: str | None = "Fichador · Auditoría", avatar_url: str | None = None,
-              footer: str | None = None, color=None):
+              footer: str | None = None, color=None, entity: tuple | None = None):
+    """entity: (tipo, id) del objeto afectado, p. ej. ("record", 12), para poder filtrar."""
     color = color or PALETTE.get(level, PALETTE["neutral"])
     ip, endpoint, method = "server", "-", "-"
     if has_request_context():
@@ -70,6 +392,20 @@ def log_event(title: str, description: str = "", *, level="info",
     if username: payload["username"] = username
     if avatar_url: payload["avatar_url"] = avatar_url
     _send_async(payload)
+    if _sinks:
+        entity_type, entity_id = entity if entity else (None, None)
+        _emit({
+            "created_at": datetime.now(timezone.utc),
+            "level": level,
+            "action": title,
+            "description": description,
+            "actor_id": getattr(user, "id", None),
+            "actor": _actor_name(user) if user is not None else None,
+            "entity_type": entity_type,
+            "entity_id": entity_id,
+            "fields": {k: (None if v is None else str(v)) for k, v in (fields or {}).items()},
+            "ip": ip, "method": method, "path": endpoint,
+        })
 
 # Atajos específicos
 def log_clock(action: str, record, *, user=None):
@@ -89,7 +425,7 @@ def log_clock(action: str, record, *, user=None):
                   "⌛ Duración": dur, "📍 Ubicación": loc}
     except Exception:
         fields = {"Detalle": "No se pudieron leer todos los campos del registro."}
-    log_event(title, level="success", fields=fields, user=user)
+    log_event(title, level="success", fields=fields, user=user, entity=("record", getattr(record, "id", None)))
 
 def log_record(action: str, record, *, user=None, extra: dict | None = None):
     emojis = {"create": "📝", "update": "✏️", "delete": "🗑️"}
@@ -103,7 +439,8 @@ def log_record(action: str, record, *, user=None, extra: dict | None = None):
     }
     if extra: fields.update(extra)
     log_event(f"{emojis.get(action,'ℹ️')} Registro: {action.upper()}",
-              level=levels.get(action, "info"), fields=fields, user=user)
+              level=levels.get(action, "info"), fields=fields, user=user,
+              entity=("record", getattr(record, "id", None)))
 
 def log_schedule(action: str, schedule, *, user=None, extra: dict | None = None):
     emojis = {"create": "🧭", "update": "🧰", "delete": "🗑️"}
@@ -118,4 +455,5 @@ def log_schedule(action: str, schedule, *, user=None, extra: dict | None = None)
     }
     if extra: fields.update(extra)
     log_event(f"{emojis.get(action,'📅')} Horario: {action.upper()}",
-              level=levels.get(action, "info"), fields=fields, user=user)
+              level=levels.get(action, "info"), fields=fields, user=user,
+              entity=("schedule", getattr(schedule, "id", None)))
@@ -0,0 +1,204 @@
+# utils/disk_spool.py
+"""Cola duradera en disco: ficheros de segmento append-only (una línea JSON por registro).
+
+- `append()` escribe la línea y la pasa al sistema operativo (sobrevive a que el
+  proceso muera); el fsync a disco se hace por lotes con `sync()`, que llama el
+  hilo lector, así una petición nunca espera a un fsync.
+- Los segmentos rotan al llegar a `segment_bytes` (el que se cierra se pasa a
+  disco en ese momento, una vez por segmento); si el total pasa de
+  `max_bytes` se borran los más antiguos (se cuentan como descartados).
+- El lector avanza con `read()` y confirma con `commit(pos)`: el punto de control
+  se guarda de forma atómica y los segmentos ya consumidos se borran. Tras un
+  reinicio se sigue desde el último commit (entrega al menos una vez).
+- Varios procesos pueden escribir a la vez (flock en cada escritura); leer debe
+  hacerlo sólo uno (ver `try_lead`).
+"""
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin exclusión entre procesos (sólo desarrollo)
+    fcntl = None
+
+SEGMENT_SUFFIX = ".log"
+CHECKPOINT = "checkpoint.json"
+
+
+class DiskSpool:
+    def __init__(self, directory, segment_bytes=1024 * 1024, max_bytes=50 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = int(segment_bytes)
+        self.max_bytes = int(max_bytes)
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._lock_fd = os.open(os.path.join(directory, "write.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        self._lead_fd = None
+        self._seg = None
+        self._fd = None
+        self._dirty = False
+        self.appended = 0
+        self.synced_at = None
+        self.dropped_segments = 0
+        self.corrupt = 0
+
+    # ---- segmentos ----
+    def _segments(self):
+        segs = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    segs.append(int(name[:-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    pass
+        return sorted(segs)
+
+    def _path(self, seg):
+        return os.path.join(self.directory, f"{seg:010d}{SEGMENT_SUFFIX}")
+
+    def _open_segment(self, seg):
+        if self._fd is not None:
+            if self._dirty:  # sync() sólo ve el segmento actual: la cola del anterior se baja ya
+                os.fsync(self._fd)
+                self._dirty = False
+            os.close(self._fd)
+        self._fd = os.open(self._path(seg), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._seg = seg
+
+    def _enforce_cap(self, segs):
+        sizes = {}
+        for seg in segs:
+            try:
+                sizes[seg] = os.path.getsize(self._path(seg))
+            except FileNotFoundError:
+                pass
+        total = sum(sizes.values())
+        for seg in sorted(sizes)[:-1]:  # el segmento actual nunca se borra
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(seg))
+            except FileNotFoundError:
+                pass
+            total -= sizes[seg]
+            self.dropped_segments += 1
+
+    # ---- escritura ----
+    def append(self, record):
+        line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                # Otro proceso puede haber rotado: se escribe siempre en el último segmento
+                if self._seg is None or os.path.exists(self._path(self._seg + 1)):
+                    segs = self._segments()
+                    self._open_segment(segs[-1] if segs else 1)
+                if os.fstat(self._fd).st_size + len(line) > self.segment_bytes and os.fstat(self._fd).st_size:
+                    self._open_segment(self._seg + 1)
+                    self._enforce_cap(self._segments())
+                os.write(self._fd, line)
+                self._dirty = True
+                self.appended += 1
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def sync(self):
+        """fsync de lo escrito desde la última vez (lo llama el hilo lector, no las peticiones)."""
+        with self._lock:
+            if not self._dirty or self._fd is None:
+                return
+            fd = self._fd
+            self._dirty = False
+        os.fsync(fd)
+        self.synced_at = time.time()
+
+    # ---- lectura ----
+    def try_lead(self):
+        """Sólo un proceso lee y confirma: flock no bloqueante sobre read.lock."""
+        if self._lead_fd is not None:
+            return True
+        fd = os.open(os.path.join(self.directory, "read.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+        self._lead_fd = fd
+        return True
+
+    def _checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT)) as f:
+                cp = json.load(f)
+            return int(cp["segment"]), int(cp["offset"])
+        except (FileNotFoundError, ValueError, KeyError):
+            return 0, 0
+
+    def read(self, limit):
+        """Hasta `limit` registros desde el punto de control: lista de (pos, registro)."""
+        seg, offset = self._checkpoint()
+        out = []
+        for s in self._segments():
+            if s < seg:
+                continue
+            if s > seg:  # segmento anterior agotado (o borrado por el tope de tamaño)
+                seg, offset = s, 0
+            with open(self._path(seg), "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # línea a medio escribir: se leerá en la próxima pasada
+                    offset += len(line)
+                    try:
+                        out.append(((seg, offset), json.loads(line)))
+                    except ValueError:
+                        self.corrupt += 1
+                        continue
+                    if len(out) >= limit:
+                        return out
+        return out
+
+    def commit(self, pos):
+        """Confirma todo lo leído hasta `pos` y borra los segmentos ya consumidos."""
+        seg, offset = pos
+        path = os.path.join(self.directory, CHECKPOINT)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"segment": seg, "offset": offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        for s in self._segments():
+            if s < seg:
+                try:
+                    os.remove(self._path(s))
+                except FileNotFoundError:
+                    pass
+
+    def pending_bytes(self):
+        seg, offset = self._checkpoint()
+        total = 0
+        for s in self._segments():
+            if s < seg:
+                continue
+            try:
+                total += os.path.getsize(self._path(s)) - (offset if s == seg else 0)
+            except FileNotFoundError:
+                pass
+        return max(total, 0)
+
+    def stats(self):
+        return {
+            "segments": len(self._segments()),
+            "pending_bytes": self.pending_bytes(),
+            "max_bytes": self.max_bytes,
+            "appended": self.appended,
+            "dropped_segments": self.dropped_segments,
+            "corrupt": self.corrupt,
+            "synced_at": self.synced_at,
+        }
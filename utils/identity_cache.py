@@ -0,0 +1,83 @@
+# utils/identity_cache.py
+"""Caché en memoria del proceso con TTL corto para la identidad del usuario logueado.
+
+Guarda una copia desacoplada (sin sesión) de cada usuario durante `ttl`
+segundos. Igual que SnapshotCache, cada clave tiene una versión que
+`invalidate()` incrementa: una carga que empezó antes de una escritura no puede
+guardar datos viejos (`put` con versión caducada se ignora). Los objetos
+guardados no se modifican nunca; quien los usa trabaja sobre una copia (en
+app.py, `db.session.merge(..., load=False)`).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class IdentityCache:
+    def __init__(self, ttl=60, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max(1, int(max_entries))
+        self._entries = OrderedDict()  # clave -> (caduca, versión, objeto)
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def version(self, key):
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, version, obj = entry
+                if expires > now and version == self._versions.get(key, 0):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return obj
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, version, obj):
+        with self._lock:
+            if version != self._versions.get(key, 0):
+                return  # hubo una escritura mientras se cargaba
+            self._entries[key] = (time.monotonic() + self.ttl, version, obj)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for key in self._entries:
+                self._versions[key] = self._versions.get(key, 0) + 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,106 @@
+# utils/keyset.py
+"""Paginación por clave (keyset / seek) para listados ordenados de más nuevo a más viejo.
+
+En vez de OFFSET + COUNT(*), cada página se pide "a partir de" la última fila
+vista, así la página N cuesta lo mismo que la primera si hay un índice con las
+columnas de orden. El cursor es opaco para el cliente (base64 de JSON).
+"""
+import base64
+import json
+from datetime import date, datetime
+
+from sqlalchemy import literal, tuple_
+
+
+class KeysetPage:
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None, total=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total  # sólo si se pidió el conteo
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(values):
+    packed = []
+    for v in values:
+        if isinstance(v, datetime):
+            packed.append(["t", v.isoformat()])
+        elif isinstance(v, date):
+            packed.append(["d", v.isoformat()])
+        else:
+            packed.append(["v", v])
+    raw = json.dumps(packed, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """Devuelve la tupla de valores o None si el cursor no es válido."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = []
+        for tag, v in json.loads(raw):
+            if tag == "t":
+                values.append(datetime.fromisoformat(v))
+            elif tag == "d":
+                values.append(date.fromisoformat(v))
+            else:
+                values.append(v)
+        return tuple(values)
+    except Exception:
+        return None
+
+
+def keyset_paginate(query, columns, *, after=None, before=None, per_page=10):
+    """Pagina `query` en orden descendente por `columns` (la última debe ser única, p. ej. id).
+
+    after/before: cursores (texto) devueltos en una página anterior.
+    """
+    after_vals = decode_cursor(after)
+    before_vals = decode_cursor(before)
+    if after_vals is not None and len(after_vals) != len(columns):
+        after_vals = None
+    if before_vals is not None and len(before_vals) != len(columns):
+        before_vals = None
+
+    key = tuple_(*columns)
+    if after_vals is not None:
+        query = query.filter(key < _bound(columns, after_vals)).order_by(*(c.desc() for c in columns))
+    elif before_vals is not None:
+        query = query.filter(key > _bound(columns, before_vals)).order_by(*(c.asc() for c in columns))
+    else:
+        query = query.order_by(*(c.desc() for c in columns))
+
+    rows = query.limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before_vals is not None:
+        rows.reverse()
+
+    def cursor_of(row):
+        return encode_cursor([getattr(row, c.key) for c in columns])
+
+    if before_vals is not None:
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = after_vals is not None, more
+    return KeysetPage(
+        rows,
+        per_page,
+        next_cursor=cursor_of(rows[-1]) if rows and has_next else None,
+        prev_cursor=cursor_of(rows[0]) if rows and has_prev else None,
+    )
+
+
+def _bound(columns, values):
+    return tuple_(*(literal(v, c.type) for c, v in zip(columns, values)))
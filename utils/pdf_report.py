@@ -0,0 +1,230 @@
+# utils/pdf_report.py
+"""Maquetación del PDF de fichajes con reportlab.
+
+No depende de Flask ni de la BD: recibe las filas ya formateadas como texto,
+así puede ejecutarse en un proceso aparte (ver los report jobs de app.py).
+
+Modo "grande" (automático a partir de LARGE_REPORT_ROWS filas): la tabla se
+parte por meses y en trozos de CHUNK_ROWS filas, y las celdas simples van como
+texto plano en vez de `Paragraph`. Así reportlab no tiene que partir una tabla
+gigante entre páginas (coste cuadrático) ni crear seis objetos por fichaje.
+"""
+import io
+import os
+from datetime import datetime
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import cm
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
+
+HEADER = ["Fecha", "Entrada", "Salida", "Duración", "Ubicación", "Coordenadas"]
+LARGE_REPORT_ROWS = 1000  # a partir de aquí se usa el modo grande
+CHUNK_ROWS = 250          # filas por tabla en el modo grande
+WRAP_CHARS = 28           # ubicaciones más largas se envuelven con Paragraph
+
+MONTHS_ES = ["Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio",
+             "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
+
+
+def _build_styles():
+    styles = getSampleStyleSheet()
+    styles.add(ParagraphStyle(name="TitleBig", parent=styles["Heading1"], fontName="Helvetica-Bold",
+                              fontSize=18, textColor=colors.HexColor("#111827"), spaceAfter=8))
+    styles.add(ParagraphStyle(name="Meta", parent=styles["Normal"], fontSize=10,
+                              textColor=colors.HexColor("#4B5563"), leading=14, spaceAfter=3))
+    styles.add(ParagraphStyle(name="Cell", parent=styles["Normal"], fontSize=9, leading=12))
+    styles.add(ParagraphStyle(name="CellBold", parent=styles["Normal"], fontName="Helvetica-Bold", fontSize=9, leading=12))
+    styles.add(ParagraphStyle(name="Month", parent=styles["Heading3"], fontSize=11, spaceBefore=8, spaceAfter=4,
+                              keepWithNext=1))
+    return styles
+
+
+# Se construyen una vez por proceso y se reutilizan en todos los informes
+STYLES = _build_styles()
+
+DATA_TABLE_STYLE = TableStyle([
+    ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#2563EB")),
+    ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+    ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+    ("ALIGN", (0, 0), (-1, 0), "CENTER"),
+    ("TOPPADDING", (0, 0), (-1, 0), 6),
+    ("BOTTOMPADDING", (0, 0), (-1, 0), 6),
+    ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.whitesmoke, colors.HexColor("#F3F4F6")]),
+    ("ALIGN", (0, 1), (0, -1), "CENTER"),
+    ("ALIGN", (1, 1), (3, -1), "CENTER"),
+    ("VALIGN", (0, 1), (-1, -1), "TOP"),
+    ("GRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#E5E7EB")),
+])
+
+# Celdas de texto plano: mismo cuerpo de letra que el estilo "Cell"
+PLAIN_TABLE_STYLE = TableStyle(DATA_TABLE_STYLE.getCommands() + [
+    ("FONTSIZE", (0, 1), (-1, -1), 9),
+    ("LEADING", (0, 1), (-1, -1), 12),
+])
+
+
+def _header_cells():
+    # Objetos nuevos por tabla: los Paragraph guardan estado al maquetarse
+    return [Paragraph(h, STYLES["CellBold"]) for h in HEADER]
+
+
+@lru_cache(maxsize=4)
+def _logo_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _logo(path):
+    if path and os.path.exists(path):
+        return Image(io.BytesIO(_logo_bytes(path)), width=1.2*cm, height=1.2*cm)
+    return Spacer(1, 1.2*cm)
+
+
+def _col_widths(doc):
+    fixed_widths = [2.2*cm, 1.8*cm, 1.8*cm, 2.5*cm, 3.0*cm]
+    auto_width = doc.width - sum(fixed_widths)
+    col_widths = [2.2*cm, 1.8*cm, 1.8*cm, 2.5*cm, auto_width, 3.0*cm]
+    if auto_width < 5*cm:
+        col_widths = [2.0*cm, 1.6*cm, 1.6*cm, 2.2*cm,
+                      doc.width - (2.0*cm + 1.6*cm + 1.6*cm + 2.2*cm + 2.6*cm),
+                      2.6*cm]
+    return col_widths
+
+
+def _data_table(rows, col_widths):
+    data = [_header_cells()]
+    for row in rows:
+        data.append([Paragraph(cell, STYLES["Cell"]) for cell in row])
+    table = Table(data, colWidths=col_widths, repeatRows=1)
+    table.setStyle(DATA_TABLE_STYLE)
+    return table
+
+
+def _plain_row(row):
+    fecha, entrada, salida, dur, ubic, coords = row
+    if len(ubic) > WRAP_CHARS:
+        ubic = Paragraph(ubic, STYLES["Cell"])
+    return [fecha, entrada, salida, dur, ubic, coords]
+
+
+def _month_label(fecha):
+    # fecha en formato dd/mm/YYYY
+    try:
+        return f"{MONTHS_ES[int(fecha[3:5]) - 1]} {fecha[6:]}"
+    except (ValueError, IndexError):
+        return fecha
+
+
+def _chunked_tables(rows, col_widths, chunk_rows=CHUNK_ROWS):
+    """Genera los flowables del modo grande: un título por mes y tablas de <= chunk_rows filas."""
+    month, chunk = None, []
+
+    def flush():
+        table = Table([_header_cells()] + chunk, colWidths=col_widths, repeatRows=1)
+        table.setStyle(PLAIN_TABLE_STYLE)
+        return table
+
+    for row in rows:
+        label = _month_label(row[0])
+        if label != month:
+            if chunk:
+                yield flush()
+                chunk = []
+            month = label
+            yield Paragraph(label, STYLES["Month"])
+        chunk.append(_plain_row(row))
+        if len(chunk) >= chunk_rows:
+            yield flush()
+            chunk = []
+    if chunk:
+        yield flush()
+
+
+def render_pdf_report(out, rows, *, user_name, user_email, start_date, end_date,
+                      summary_rows, logo_path=None, tz="Europe/Madrid", large=None):
+    """Escribe el PDF en `out` (ruta o fichero binario).
+
+    rows:         tuplas (fecha, entrada, salida, duración, ubicación, coordenadas) en texto,
+                  ordenadas por fecha.
+    summary_rows: pares (etiqueta, valor) del bloque "Resumen".
+    large:        fuerza (True/False) el modo grande; por defecto según LARGE_REPORT_ROWS.
+    """
+    if large is None:
+        large = len(rows) >= LARGE_REPORT_ROWS
+    zone = ZoneInfo(tz)
+    doc = SimpleDocTemplate(
+        out, pagesize=A4,
+        leftMargin=2*cm, rightMargin=2*cm,
+        topMargin=2.2*cm, bottomMargin=2*cm
+    )
+    styles = STYLES
+
+    elements = []
+    title_row = [_logo(logo_path), Paragraph("Reporte de fichajes", styles["TitleBig"])]
+    header_tbl = Table([title_row], colWidths=[1.4*cm, doc.width - 1.4*cm])
+    header_tbl.setStyle(TableStyle([("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+                                    ("BOTTOMPADDING", (0, 0), (-1, -1), 6)]))
+    elements.append(header_tbl)
+
+    periodo = f"{start_date.strftime('%d/%m/%Y')} a {end_date.strftime('%d/%m/%Y')}"
+    elements.append(Paragraph(f"<b>Usuario:</b> {user_name}", styles["Meta"]))
+    elements.append(Paragraph(f"<b>Período:</b> {periodo}", styles["Meta"]))
+    elements.append(Paragraph(f"<b>Email:</b> {user_email}", styles["Meta"]))
+    elements.append(Spacer(1, 6))
+
+    col_widths = _col_widths(doc)
+    if large:
+        elements.extend(_chunked_tables(rows, col_widths))
+    else:
+        elements.append(_data_table(rows, col_widths))
+    elements.append(Spacer(1, 10))
+
+    resumen = [[Paragraph(f"<b>{label}</b>", styles["Cell"]), Paragraph(str(value), styles["Cell"])]
+               for label, value in summary_rows]
+    resumen_tbl = Table(resumen, colWidths=[5.5*cm, doc.width - 5.5*cm])
+    resumen_tbl.setStyle(TableStyle([
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#EFF6FF")),
+        ("BOX", (0, 0), (-1, -1), 0.5, colors.HexColor("#E5E7EB")),
+        ("INNERGRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#E5E7EB")),
+        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+        ("TOPPADDING", (0, 0), (-1, -1), 6),
+        ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
+    ]))
+    elements.append(Paragraph("Resumen", styles["CellBold"]))
+    elements.append(Spacer(1, 4))
+    elements.append(resumen_tbl)
+    elements.append(Spacer(1, 12))
+
+    footer_tbl = Table([[Paragraph('Este Fichador ha sido realizado por @chriismartinezz', styles["Cell"])]],
+                       colWidths=[doc.width])
+    footer_tbl.setStyle(TableStyle([
+        ("ALIGN", (0, 0), (-1, -1), "CENTER"),
+        ("LINEABOVE", (0, 0), (-1, 0), 0.7, colors.HexColor("#9CA3AF")),
+        ("TOPPADDING", (0, 0), (-1, -1), 12),
+        ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
+    ]))
+    elements.append(footer_tbl)
+
+    generated = datetime.now(zone).strftime('%d/%m/%Y %H:%M')
+
+    def _pdf_footer(canvas, doc):
+        canvas.saveState()
+        canvas.setFont("Helvetica", 9)
+        canvas.setFillColor(colors.HexColor("#6B7280"))
+        canvas.drawString(doc.leftMargin, 1.2 * cm, f"Generado el {generated}")
+        canvas.drawRightString(doc.rightMargin + doc.width, 1.2 * cm, f"Página {doc.page}")
+        canvas.restoreState()
+
+    doc.build(elements, onFirstPage=_pdf_footer, onLaterPages=_pdf_footer)
+    return len(rows)
+
+
+def render_pdf_report_file(path, rows, **meta):
+    """Punto de entrada para el pool de procesos: escribe en `path` y mide el tiempo."""
+    t0 = datetime.now()
+    n = render_pdf_report(path, rows, **meta)
+    return {"rows": n, "render_ms": int((datetime.now() - t0).total_seconds() * 1000)}
@@ -0,0 +1,171 @@
+# utils/presence.py
+"""Presencia en memoria: quién está en línea, sin escribir en la BD en cada evento.
+
+- `seen(uid)` (login o latido de la PWA) y `left(uid)` (logout) sólo tocan un
+  diccionario; un usuario está en línea si se le vio hace menos de `online_ttl`
+  segundos y no ha cerrado sesión después.
+- Un hilo llama cada `flush_interval` segundos a `flush(rows)` con el último
+  estado de los usuarios que cambiaron: filas (uid, visto, login) en epoch, con
+  visto=None tras un logout y login=None si no hubo login nuevo. Si falla se
+  reintenta en la siguiente vuelta.
+- En esa misma vuelta llama a `on_expire(uids)` con los usuarios que han dejado
+  de estar en línea por no mandar latidos (para avisar al panel admin).
+- Con varios procesos cada uno sólo conoce a sus usuarios: quien consulta puede
+  pasar en `is_online(uid, persisted=...)` la última marca guardada en la BD.
+"""
+import os
+import threading
+import time
+
+
+class PresenceTracker:
+    def __init__(self, flush, on_expire=None, online_ttl=150, flush_interval=30, name="presence"):
+        self.flush = flush
+        self.on_expire = on_expire
+        self.online_ttl = online_ttl
+        self.flush_interval = flush_interval
+        self.name = name
+        self._seen = {}     # uid -> epoch del último latido (None = sesión cerrada)
+        self._login = {}    # uid -> epoch del último login aún no guardado
+        self._dirty = set()
+        self._online = set()  # usuarios en línea según la última comprobación
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self.heartbeats = 0
+        self.flushes = 0
+        self.written = 0
+        self.expired = 0
+        self.errors = 0
+        self.last_error = None
+
+    def _ensure_thread(self):
+        # Tras un fork (gunicorn --preload) el hilo del padre no existe
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._seen, self._login, self._dirty, self._online = {}, {}, set(), set()
+            threading.Thread(target=self._run, name=self.name, daemon=True).start()
+            self._pid = os.getpid()
+
+    def _alive(self, seen, now):
+        return seen is not None and now - seen < self.online_ttl
+
+    def seen(self, uid, login=False):
+        """Marca al usuario como visto ahora. Devuelve True si acaba de pasar a en línea."""
+        self._ensure_thread()
+        now = time.time()
+        with self._lock:
+            was_online = self._alive(self._seen.get(uid), now)
+            self._seen[uid] = now
+            if login:
+                self._login[uid] = now
+            self._dirty.add(uid)
+            self._online.add(uid)
+            self.heartbeats += 1
+        return not was_online
+
+    def left(self, uid):
+        """Logout explícito. Devuelve True si estaba en línea."""
+        self._ensure_thread()
+        now = time.time()
+        with self._lock:
+            was_online = self._alive(self._seen.get(uid), now)
+            self._seen[uid] = None
+            self._dirty.add(uid)
+            self._online.discard(uid)
+        return was_online
+
+    def is_online(self, uid, persisted=None, now=None):
+        """En línea según este proceso o, si aquí no hay datos, según `persisted`
+        (epoch guardado en la BD por cualquier proceso)."""
+        now = now or time.time()
+        with self._lock:
+            if uid in self._seen:
+                local = self._seen[uid]
+                if local is None:  # logout en este proceso: sólo cuenta un latido posterior
+                    return False
+                return self._alive(max(local, persisted or 0), now)
+        return self._alive(persisted, now)
+
+    def last_seen(self, uid):
+        with self._lock:
+            return self._seen.get(uid)
+
+    def last_login(self, uid):
+        """Login aún no guardado en la BD (o None)."""
+        with self._lock:
+            return self._login.get(uid)
+
+    def _take(self):
+        with self._lock:
+            rows = [(uid, self._seen.get(uid), self._login.get(uid)) for uid in self._dirty]
+            self._dirty = set()
+        return rows
+
+    def _write(self, rows):
+        try:
+            self.flush(rows)
+        except Exception as e:
+            self.errors += 1
+            self.last_error = repr(e)
+            print(f"❌ {self.name}: {e!r}")
+            with self._lock:  # se reintenta; los cambios nuevos ya están en los diccionarios
+                self._dirty.update(uid for uid, _, _ in rows)
+            return False
+        with self._lock:
+            for uid, _, login in rows:
+                if login is not None and self._login.get(uid) == login:
+                    del self._login[uid]
+        self.flushes += 1
+        self.written += len(rows)
+        return True
+
+    def _expire(self):
+        now = time.time()
+        with self._lock:
+            gone = [uid for uid in self._online if not self._alive(self._seen.get(uid), now)]
+            self._online.difference_update(gone)
+            self.expired += len(gone)
+        if gone and self.on_expire is not None:
+            try:
+                self.on_expire(gone)
+            except Exception as e:
+                print(f"⚠️ {self.name} on_expire: {e!r}")
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            with self._flush_lock:
+                rows = self._take()
+                if rows:
+                    self._write(rows)
+            self._expire()
+
+    def flush_now(self):
+        """Guarda ya lo pendiente (p. ej. al apagar el proceso)."""
+        if self._pid != os.getpid():
+            return True
+        with self._flush_lock:
+            rows = self._take()
+            return self._write(rows) if rows else True
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            online = sum(1 for s in self._seen.values() if self._alive(s, now))
+            pending = len(self._dirty)
+        return {
+            "online": online,
+            "online_ttl": self.online_ttl,
+            "flush_interval": self.flush_interval,
+            "pending": pending,
+            "heartbeats": self.heartbeats,
+            "flushes": self.flushes,
+            "written": self.written,
+            "expired": self.expired,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
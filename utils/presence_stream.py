@@ -0,0 +1,100 @@
+# utils/presence_stream.py
+"""Pub/sub en memoria para el feed de presencia del panel admin (Server-Sent Events).
+
+- `publish()` sólo emite si el estado del usuario cambió (deltas).
+- Cada suscriptor tiene una cola acotada: si se llena (pestaña lenta) se descartan
+  los eventos pendientes y se le manda `resync` para que recargue la foto completa.
+- `stream()` envía heartbeats para mantener viva la conexión y corta tras
+  `max_duration` segundos; EventSource reconecta solo y así no se eternizan hilos.
+"""
+import json
+import queue
+import threading
+import time
+
+
+class Subscription:
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.lagged = False
+
+
+class PresenceBroker:
+    def __init__(self, queue_size=100, max_subscribers=4):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self._subs = set()
+        self._last = {}  # user_id -> último estado publicado
+        self._lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self):
+        """Devuelve una suscripción o None si se alcanzó el máximo (el cliente hará polling)."""
+        with self._lock:
+            if len(self._subs) >= self.max_subscribers:
+                return None
+            sub = Subscription(self.queue_size)
+            self._subs.add(sub)
+            return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subs.discard(sub)
+
+    def publish(self, user_id, state):
+        """Publica el estado de un usuario si cambió respecto al último enviado."""
+        with self._lock:
+            if self._last.get(user_id) == state:
+                return False
+            self._last[user_id] = state
+            subs = list(self._subs)
+            self.published += 1
+        event = ("presence", state)
+        lagged = 0
+        for sub in subs:
+            try:
+                sub.queue.put_nowait(event)
+            except queue.Full:
+                sub.lagged = True
+                lagged += 1
+        if lagged:
+            with self._lock:
+                self.dropped += lagged
+        return True
+
+    def stream(self, sub, heartbeat=15, max_duration=600, retry_ms=3000):
+        """Generador de texto SSE para una suscripción."""
+        deadline = time.monotonic() + max_duration
+        try:
+            yield f"retry: {retry_ms}\n\n"
+            while time.monotonic() < deadline:
+                if sub.lagged:
+                    sub.lagged = False
+                    _drain(sub.queue)
+                    yield _sse("resync", {})
+                    continue
+                try:
+                    kind, data = sub.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                yield _sse(kind, data)
+        finally:
+            self.unsubscribe(sub)
+
+    def stats(self):
+        with self._lock:
+            return {"subscribers": len(self._subs), "published": self.published, "dropped": self.dropped}
+
+
+def _drain(q):
+    while True:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            return
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
@@ -0,0 +1,86 @@
+# utils/projection.py
+"""Proyección de la fecha estimada de fin de prácticas.
+
+En lugar de recorrer día a día hasta 3 años, se aprovecha que el horario fijo
+se repite cada semana: los tramos sin días extra se saltan por semanas completas
+y sólo se recorre día a día el resto (< 7 días). Los días extra se aplican como
+ajustes puntuales, así el coste depende del número de días extra y no de las
+horas que falten.
+"""
+from datetime import timedelta
+
+DEFAULT_HORIZON_DAYS = 365 * 3
+# Tolerancia (horas) para que los redondeos de float no muevan la fecha un día
+_EPS = 1e-6
+
+
+def estimate_end_date(hours_remaining, weekly_hours, extra_days=(), *, today,
+                      today_hours=0.0, horizon_days=DEFAULT_HORIZON_DAYS):
+    """Devuelve la fecha en la que se agotan `hours_remaining` o None.
+
+    weekly_hours: 7 valores (0=Lunes ... 6=Domingo) con las horas del horario fijo.
+    extra_days:   iterable de (fecha, horas) planificadas; se suman si se repite fecha.
+    today_hours:  horas ya fichadas hoy, que se descuentan de la jornada de hoy.
+    horizon_days: mismo límite de seguridad que el cálculo original (3 años).
+    """
+    remaining = float(hours_remaining or 0.0)
+    if remaining <= 0 or horizon_days <= 0:
+        return None
+
+    weekly = [float(h or 0.0) for h in weekly_hours]
+    week_total = sum(weekly)
+    last_day = today + timedelta(days=horizon_days - 1)
+
+    extras = {}
+    for day, hours in extra_days:
+        if today <= day <= last_day and hours:
+            extras[day] = extras.get(day, 0.0) + float(hours)
+    if week_total <= 0 and not extras:
+        return None
+
+    # Hoy: horario + extra, sin contar dos veces lo ya fichado
+    hours_today = weekly[today.weekday()] + extras.pop(today, 0.0)
+    if today_hours > 0:
+        hours_today = max(hours_today - today_hours, 0.0)
+    if hours_today > 0:
+        remaining -= hours_today
+        if remaining <= _EPS:
+            return today
+
+    cursor = today + timedelta(days=1)
+    for day in sorted(extras):
+        end, remaining = _consume_weekly(cursor, (day - cursor).days, remaining, weekly, week_total)
+        if end:
+            return end
+        remaining -= weekly[day.weekday()] + extras[day]
+        if remaining <= _EPS:
+            return day
+        cursor = day + timedelta(days=1)
+
+    end, _ = _consume_weekly(cursor, (last_day - cursor).days + 1, remaining, weekly, week_total)
+    return end
+
+
+def _consume_weekly(start, n_days, remaining, weekly, week_total):
+    """Consume el horario fijo durante `n_days` desde `start`.
+
+    Devuelve (fecha_fin, None) si el saldo se agota en el tramo o (None, saldo)."""
+    if n_days <= 0 or week_total <= 0:
+        return None, remaining
+
+    # Semanas completas que seguro no agotan el saldo (queda > 0 tras saltarlas)
+    weeks = min(n_days // 7, int(remaining // week_total))
+    if weeks and remaining - weeks * week_total <= _EPS:
+        weeks -= 1
+    remaining -= weeks * week_total
+    day = start + timedelta(days=weeks * 7)
+
+    # Resto: como mucho una semana (más el sobrante del tramo)
+    for _ in range(n_days - weeks * 7):
+        hours = weekly[day.weekday()]
+        if hours > 0:
+            remaining -= hours
+            if remaining <= _EPS:
+                return day, None
+        day += timedelta(days=1)
+    return None, remaining
@@ -0,0 +1,77 @@
+# utils/push_outbox.py
+"""Hilo de entrega de la bandeja de salida de notificaciones push.
+
+La tabla (PushOutbox en app.py) es la fuente de verdad: los jobs sólo encolan
+filas y este hilo las entrega en segundo plano. `drain()` (lo pone app.py)
+procesa un lote de filas vencidas y devuelve cuántas ha tratado; el hilo lo
+repite mientras haya trabajo y después duerme hasta `wake()` (alguien ha
+encolado) o hasta `interval` segundos (reintentos con backoff pendientes).
+"""
+import random
+import threading
+import time
+
+
+def backoff_delay(attempts, base=30, cap=900, jitter=0.2):
+    """Segundos hasta el siguiente intento: base·2^(intentos-1), con tope y algo de azar
+    para que los reintentos de muchas suscripciones no coincidan."""
+    delay = min(cap, base * (2 ** max(attempts - 1, 0)))
+    return delay * (1 + random.uniform(-jitter, jitter))
+
+
+class OutboxWorker:
+    def __init__(self, drain, interval=30):
+        self.drain = drain
+        self.interval = interval
+        self._wake = threading.Event()
+        self._thread = None
+        self._stop = False
+        self.runs = 0
+        self.processed = 0
+        self.errors = 0
+        self.last_run = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="push-outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop:
+            self._wake.clear()
+            try:
+                while not self._stop:
+                    n = self.drain()
+                    self.runs += 1
+                    self.processed += n
+                    if not n:
+                        break
+            except Exception as e:  # un fallo de BD o red no debe matar el hilo
+                self.errors += 1
+                print(f"❌ Bandeja push: {e!r}")
+            self.last_run = time.time()
+            self._wake.wait(self.interval)
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "runs": self.runs,
+            "processed": self.processed,
+            "errors": self.errors,
+            "last_run": self.last_run,
+        }
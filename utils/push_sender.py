@@ -0,0 +1,167 @@
+# utils/push_sender.py
+"""Envío de Web Push en paralelo.
+
+- Un pool de hilos acotado manda todas las notificaciones de un tick a la vez,
+  así un endpoint lento no retrasa a los demás.
+- Una `requests.Session` por origen del servicio push (FCM, Mozilla, Apple...)
+  reutiliza las conexiones HTTPS (keep-alive) entre envíos.
+- Cada petición tiene timeout y el lote entero un plazo máximo; el resultado es
+  uno por suscripción, en el mismo orden que la entrada.
+- `VapidSigner` carga la clave VAPID una sola vez y reutiliza la cabecera
+  Authorization firmada de cada servicio push (audiencia) hasta poco antes de
+  que caduque, en vez de parsear la clave y firmar un JWT por cada envío.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from py_vapid import Vapid
+from pywebpush import webpush, WebPushException
+
+
+class PushMessage:
+    def __init__(self, key, endpoint, p256dh, auth, data, headers=None, ttl=0):
+        self.key = key  # identificador de quien llama (p. ej. id de la suscripción)
+        self.endpoint = endpoint
+        self.p256dh = p256dh
+        self.auth = auth
+        self.data = data
+        self.headers = headers or {}
+        self.ttl = ttl
+
+
+class PushResult:
+    def __init__(self, key, endpoint, ok, status=None, error=None, elapsed_ms=0, rejected=False):
+        self.key = key
+        self.endpoint = endpoint
+        self.ok = ok
+        self.status = status      # código HTTP del servicio push (None si no hubo respuesta)
+        self.error = error
+        self.elapsed_ms = elapsed_ms
+        self.rejected = rejected  # el servicio push respondió con error (WebPushException)
+
+    def __repr__(self):
+        return f"<PushResult {self.key} ok={self.ok} status={self.status}>"
+
+
+def _origin(endpoint):
+    u = urlparse(endpoint)
+    return f"{u.scheme}://{u.netloc}"
+
+
+class VapidSigner:
+    """Cabeceras VAPID cacheadas por audiencia (origen del servicio push)."""
+
+    def __init__(self, private_key, subject, ttl=12 * 3600, refresh_margin=600):
+        # Mismos formatos que acepta pywebpush: ruta a fichero PEM o clave en texto (raw/DER b64)
+        if os.path.isfile(private_key):
+            self.vapid = Vapid.from_file(private_key_file=private_key)
+        else:
+            self.vapid = Vapid.from_string(private_key=private_key)
+        self.subject = subject
+        self.ttl = min(int(ttl), 24 * 3600)  # el estándar no admite más de 24 h
+        self.refresh_margin = refresh_margin
+        self._cache = {}  # aud -> (exp, headers)
+        self._lock = threading.Lock()
+        self.signed = 0
+        self.reused = 0
+
+    def headers_for(self, endpoint):
+        aud = _origin(endpoint)
+        now = int(time.time())
+        with self._lock:
+            cached = self._cache.get(aud)
+            if cached and cached[0] - self.refresh_margin > now:
+                self.reused += 1
+                return cached[1]
+        exp = now + self.ttl
+        headers = self.vapid.sign({"sub": self.subject, "aud": aud, "exp": exp})
+        with self._lock:
+            self._cache[aud] = (exp, headers)
+            self.signed += 1
+        return headers
+
+    def stats(self):
+        with self._lock:
+            return {"audiences": len(self._cache), "signed": self.signed, "reused": self.reused}
+
+
+class PushSender:
+    def __init__(self, max_workers=8, timeout=10, batch_timeout=60):
+        self.max_workers = max_workers
+        self.timeout = timeout              # por petición (conexión + respuesta)
+        self.batch_timeout = batch_timeout  # plazo para el lote completo
+        self._sessions = {}
+        self._executor = None
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+
+    def _session(self, origin):
+        with self._lock:
+            session = self._sessions.get(origin)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+                session.mount(origin, adapter)
+                self._sessions[origin] = session
+            return session
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='push')
+            return self._executor
+
+    def _send_one(self, msg, signer):
+        t0 = time.monotonic()
+        try:
+            # La cabecera VAPID ya va firmada: sin vapid_claims, pywebpush no vuelve a firmar
+            resp = webpush(
+                subscription_info={"endpoint": msg.endpoint, "keys": {"p256dh": msg.p256dh, "auth": msg.auth}},
+                data=msg.data,
+                ttl=msg.ttl,
+                headers={**msg.headers, **signer.headers_for(msg.endpoint)},
+                timeout=self.timeout,
+                requests_session=self._session(_origin(msg.endpoint)),
+            )
+            return PushResult(msg.key, msg.endpoint, True, status=resp.status_code,
+                              elapsed_ms=int((time.monotonic() - t0) * 1000))
+        except WebPushException as e:
+            status = e.response.status_code if e.response is not None else None
+            return PushResult(msg.key, msg.endpoint, False, status=status, error=str(e).splitlines()[0],
+                              elapsed_ms=int((time.monotonic() - t0) * 1000), rejected=True)
+        except requests.RequestException as e:
+            return PushResult(msg.key, msg.endpoint, False, error=f"{e.__class__.__name__}: {e}",
+                              elapsed_ms=int((time.monotonic() - t0) * 1000))
+
+    def send_many(self, messages, signer):
+        """Envía todos los mensajes en paralelo y devuelve un PushResult por mensaje."""
+        messages = list(messages)
+        if not messages:
+            return []
+        pool = self._pool()
+        futures = [pool.submit(self._send_one, m, signer) for m in messages]
+        wait(futures, timeout=self.batch_timeout)
+        results = []
+        for msg, fut in zip(messages, futures):
+            if fut.done():
+                try:
+                    results.append(fut.result())
+                except Exception as e:  # error inesperado en el hilo: se informa, no se propaga
+                    results.append(PushResult(msg.key, msg.endpoint, False, error=repr(e)))
+            else:
+                results.append(PushResult(msg.key, msg.endpoint, False, error="batch timeout"))
+        ok = sum(1 for r in results if r.ok)
+        with self._lock:
+            self.sent += ok
+            self.failed += len(results) - ok
+        return results
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._sessions), "sent": self.sent, "failed": self.failed}
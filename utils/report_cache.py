@@ -0,0 +1,172 @@
+# utils/report_cache.py
+"""Caché en disco de informes generados (PDF/CSV), direccionada por contenido.
+
+La clave la calcula quien llama e incluye la "versión" de los datos del rango
+(ver `report_cache_key` en app.py): si cambia un fichaje del rango la clave es
+otra, así que nunca hace falta invalidar; las entradas viejas simplemente dejan
+de pedirse y salen por LRU. El tamaño total está acotado por `max_bytes`; el
+orden LRU es el mtime de cada fichero (se actualiza en cada acierto), así que
+funciona igual con varios procesos compartiendo el directorio.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+TMP_SUFFIX = ".tmp"
+TMP_MAX_AGE = 3600  # ficheros temporales huérfanos (proceso muerto a medias)
+
+
+def link_or_copy(src, dst):
+    """Hardlink (sin copiar bytes) si el sistema de ficheros lo permite; si no, copia."""
+    try:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ReportCache:
+    def __init__(self, directory, max_bytes=200 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Fichero cacheado ya abierto ('rb') o None. Un acierto lo marca como usado
+        recientemente. Se devuelve abierto y no la ruta: si otro proceso lo expulsa
+        justo después, el descriptor sigue leyendo el contenido. Quien llama lo cierra."""
+        path = self._path(key)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass  # expulsado ya: el fichero abierto sigue valiendo
+        with self._lock:
+            self.hits += 1
+        return f
+
+    def temp_path(self):
+        """Fichero temporal dentro del directorio de la caché (para poder moverlo sin copiar)."""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix=TMP_SUFFIX)
+        os.close(fd)
+        return path
+
+    def put(self, key, src, move=True):
+        """Guarda `src` con la clave dada. move=False deja el original (hardlink o copia).
+
+        Devuelve la ruta en caché, o None si el fichero no cabe.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        if move:
+            os.replace(src, path)
+        else:
+            tmp = self.temp_path()
+            link_or_copy(src, tmp)
+            os.replace(tmp, path)
+        with self._lock:
+            self.stores += 1
+        self._evict(keep=key)
+        return path if os.path.exists(path) else None
+
+    def tee(self, key, chunks):
+        """Reenvía los trozos (bytes) de `chunks` y a la vez los guarda en caché.
+
+        Sólo se guarda si el generador se consume entero (una descarga cortada no deja
+        un fichero a medias).
+        """
+        tmp = self.temp_path()
+        complete = False
+        try:
+            with open(tmp, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            if complete:
+                self.put(key, tmp)
+            else:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+    def _entries(self):
+        entries = []
+        now = time.time()
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.endswith(TMP_SUFFIX):
+                if now - st.st_mtime > TMP_MAX_AGE:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        return entries
+
+    def _evict(self, keep=None):
+        """Borra los ficheros menos usados hasta quedar por debajo de max_bytes."""
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            # la entrada recién guardada se borra la última (sólo si no cabe ni sola)
+            entries.sort(key=lambda e: (e[2] == keep, e[0]))
+            for _, size, name in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            for _, _, name in self._entries():
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        entries = self._entries()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(entries),
+                "bytes": sum(size for _, size, _ in entries),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "stores": self.stores,
+                "evictions": self.evictions,
+            }
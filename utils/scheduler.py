@@ -0,0 +1,203 @@
+# utils/scheduler.py
+"""Planificador embebido: montículo de temporizadores + un único líder entre procesos.
+
+- Los eventos son (clave, instante epoch); el hilo duerme hasta el más próximo
+  (o hasta que llega uno más temprano con `poke`/`schedule`) y lo dispara.
+- `fire(clave)` ejecuta el trabajo y devuelve el siguiente instante de esa clave
+  (o None para olvidarla). `load()` devuelve todos los eventos desde la BD; se
+  llama al hacerse líder y cada `resync_seconds` para recoger cambios hechos por
+  otros procesos.
+- Liderazgo con `fcntl.flock` sobre un fichero: sólo un worker de gunicorn
+  planifica; los demás reintentan cada `leader_retry` segundos por si el líder muere.
+"""
+import heapq
+import itertools
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin exclusión entre procesos (sólo desarrollo)
+    fcntl = None
+
+
+class LeaderLock:
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self):
+        if self._fd is not None:
+            return True
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)  # cerrar libera el flock
+            self._fd = None
+
+
+class TimerHeap:
+    """Montículo con una entrada vigente por clave (las viejas se descartan al sacarlas)."""
+
+    def __init__(self):
+        self._heap = []
+        self._when = {}
+        self._seq = itertools.count()
+
+    def schedule(self, key, when):
+        self._when[key] = when
+        heapq.heappush(self._heap, (when, next(self._seq), key))
+
+    def cancel(self, key):
+        self._when.pop(key, None)
+
+    def clear(self):
+        self._heap.clear()
+        self._when.clear()
+
+    def next_time(self):
+        while self._heap:
+            when, _, key = self._heap[0]
+            if self._when.get(key) == when:
+                return when
+            heapq.heappop(self._heap)  # entrada obsoleta
+        return None
+
+    def pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, _, key = heapq.heappop(self._heap)
+            if self._when.get(key) == when:
+                del self._when[key]
+                due.append(key)
+        return due
+
+    def __len__(self):
+        return len(self._when)
+
+
+class EmbeddedScheduler:
+    def __init__(self, fire, load, lock_path, resync_seconds=60, leader_retry=30, max_sleep=300):
+        self.fire = fire
+        self.load = load
+        self.lock = LeaderLock(lock_path)
+        self.resync_seconds = resync_seconds
+        self.leader_retry = leader_retry
+        self.max_sleep = max_sleep
+        self._timers = TimerHeap()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stop = False
+        self.is_leader = False
+        self.fired = 0
+        self.errors = 0
+        self.last_resync = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="embedded-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self.lock.release()
+        self.is_leader = False
+
+    def schedule(self, key, when):
+        with self._cond:
+            self._timers.schedule(key, when)
+            self._cond.notify()
+
+    def poke(self, keys):
+        """Programa las claves para ya (p. ej. tras un cambio que afecta a ese usuario)."""
+        if not self.is_leader:
+            return
+        now = time.time()
+        with self._cond:
+            for key in keys:
+                self._timers.schedule(key, now)
+            self._cond.notify()
+
+    def _resync(self):
+        events = list(self.load())
+        with self._cond:
+            self._timers.clear()
+            for key, when in events:
+                if when is not None:
+                    self._timers.schedule(key, when)
+        self.last_resync = time.time()
+
+    def _run(self):
+        while not self._stop:
+            if not self.is_leader:
+                if not self.lock.acquire():
+                    with self._cond:
+                        self._cond.wait(self.leader_retry)
+                    continue
+                self.is_leader = True
+                print(f"⏰ Planificador embebido activo (pid {os.getpid()})")
+            try:
+                if self.last_resync is None or time.time() - self.last_resync >= self.resync_seconds:
+                    self._resync()
+                with self._cond:
+                    now = time.time()
+                    nxt = self._timers.next_time()
+                    wake_at = min(nxt if nxt is not None else now + self.max_sleep,
+                                  self.last_resync + self.resync_seconds)
+                    if wake_at > now and not self._stop:
+                        self._cond.wait(wake_at - now)
+                    due = self._timers.pop_due(time.time())
+                for key in due:
+                    self._fire(key)
+            except Exception as e:  # un fallo de BD no debe matar el hilo
+                self.errors += 1
+                print(f"❌ Planificador embebido: {e!r}")
+                with self._cond:
+                    self._cond.wait(5)
+
+    def _fire(self, key):
+        try:
+            nxt = self.fire(key)
+            self.fired += 1
+        except Exception as e:
+            self.errors += 1
+            print(f"❌ Planificador embebido, evento {key}: {e!r}")
+            nxt = time.time() + 60  # se reintenta en un minuto
+        if nxt is not None:
+            self.schedule(key, nxt)
+
+    def stats(self):
+        with self._cond:
+            nxt = self._timers.next_time()
+            return {
+                "running": self.running,
+                "leader": self.is_leader,
+                "events": len(self._timers),
+                "next_at": nxt,
+                "fired": self.fired,
+                "errors": self.errors,
+                "last_resync": self.last_resync,
+            }
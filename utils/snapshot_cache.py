@@ -0,0 +1,72 @@
+# utils/snapshot_cache.py
+"""Caché LRU por usuario para datos calculados (p. ej. el resumen del dashboard).
+
+Cada usuario tiene un número de versión que las rutas de escritura incrementan
+con `bump()`. Una entrada sólo se sirve si se guardó con la versión vigente, así
+que un cálculo que empezó antes de una escritura nunca deja datos viejos.
+La caché vive en memoria del proceso (Render arranca un único worker).
+"""
+import threading
+from collections import OrderedDict
+
+
+class SnapshotCache:
+    def __init__(self, max_entries=512):
+        self.max_entries = max(1, int(max_entries))
+        self._entries = OrderedDict()  # user_id -> (version, key, value)
+        self._versions = {}            # user_id -> int
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def version(self, user_id):
+        with self._lock:
+            return self._versions.get(user_id, 0)
+
+    def bump(self, user_id):
+        """Invalida el snapshot de un usuario (llamar en cada escritura que le afecte)."""
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def get(self, user_id, key):
+        """Devuelve el valor si coincide versión y clave (p. ej. la fecha de hoy)."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] == self._versions.get(user_id, 0) and entry[1] == key:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            return None
+
+    def put(self, user_id, version, key, value):
+        """Guarda el valor calculado con `version` (obtenida antes de calcular)."""
+        with self._lock:
+            if version != self._versions.get(user_id, 0):
+                return  # hubo una escritura mientras se calculaba
+            self._entries[user_id] = (version, key, value)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }